@@ -0,0 +1,126 @@
+"""Group fan-out throughput of the in-memory and local broker channel layers.
+
+Sends ``--messages`` group messages to a group of ``--channels`` channels and
+reports how fast they are delivered, first with every receiver in this
+process (both layers), then with receivers in ``--processes`` other worker
+processes (local broker only, since the in-memory layer can't cross them).
+
+    python benchmarks/channel_layer_throughput.py --messages 5000 --processes 4
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from channels.layers import InMemoryChannelLayer  # noqa: E402
+
+from kds_app.channel_layer import LocalBrokerChannelLayer  # noqa: E402
+
+GROUP = 'benchmark'
+
+
+async def receive_all(layer, channel, count, latencies):
+    for _ in range(count):
+        message = await layer.receive(channel)
+        latencies.append(time.time() - message['sent'])
+
+
+async def join(layer, channels):
+    names = [await layer.new_channel() for _ in range(channels)]
+    for name in names:
+        await layer.group_add(GROUP, name)
+    return names
+
+
+async def send_all(layer, messages):
+    for i in range(messages):
+        await layer.group_send(GROUP, {'type': 'benchmark', 'n': i, 'sent': time.time()})
+
+
+async def run_local(layer, messages, channels):
+    """Receivers in this process; returns (seconds, latencies)"""
+    names = await join(layer, channels)
+    latencies = []
+    started = time.perf_counter()
+    receivers = [asyncio.ensure_future(receive_all(layer, name, messages, latencies)) for name in names]
+    await send_all(layer, messages)
+    await asyncio.gather(*receivers)
+    return time.perf_counter() - started, latencies
+
+
+def receiver_process(path, messages, channels, ready, results):
+    async def main():
+        layer = LocalBrokerChannelLayer(path=path, capacity=messages + 1)
+        names = await join(layer, channels)
+        ready.put(True)
+        latencies = []
+        await asyncio.gather(*(receive_all(layer, name, messages, latencies) for name in names))
+        results.put(latencies)
+        await layer.close()
+    asyncio.run(main())
+
+
+async def run_multiprocess(layer, path, messages, channels, processes):
+    """Receivers in other processes; returns (seconds, latencies)"""
+    context = multiprocessing.get_context('spawn')
+    ready, results = context.Queue(), context.Queue()
+    # Connect first, so this process hosts the broker
+    await layer.group_send(GROUP, {'type': 'benchmark.warmup', 'sent': time.time()})
+    workers = [
+        context.Process(target=receiver_process, args=(path, messages, channels, ready, results))
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for _ in workers:
+        await asyncio.get_running_loop().run_in_executor(None, ready.get)
+    started = time.perf_counter()
+    await send_all(layer, messages)
+    latencies = []
+    for _ in workers:
+        latencies += await asyncio.get_running_loop().run_in_executor(None, results.get)
+    elapsed = time.perf_counter() - started
+    for worker in workers:
+        worker.join()
+    return elapsed, latencies
+
+
+def report(name, messages, elapsed, latencies):
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0
+    print(
+        f"{name:<34} {messages / elapsed:>10.0f} {len(latencies) / elapsed:>14.0f} "
+        f"{statistics.median(latencies) * 1000:>9.2f} {p99 * 1000:>9.2f}"
+    )
+
+
+async def main(args):
+    path = os.path.join(tempfile.mkdtemp(), 'channels.sock')
+    print(f"{args.messages} group messages, {args.channels} channels per process\n")
+    print(f"{'layer':<34} {'sends/s':>10} {'deliveries/s':>14} {'p50 ms':>9} {'p99 ms':>9}")
+
+    layer = InMemoryChannelLayer(capacity=args.messages + 1)
+    report('in-memory, 1 process', args.messages, *await run_local(layer, args.messages, args.channels))
+
+    layer = LocalBrokerChannelLayer(path=path, capacity=args.messages + 1)
+    report('local broker, 1 process', args.messages, *await run_local(layer, args.messages, args.channels))
+    await layer.flush()
+
+    if args.processes:
+        elapsed, latencies = await run_multiprocess(layer, path, args.messages, args.channels, args.processes)
+        report(f'local broker, {args.processes} receiver processes', args.messages, elapsed, latencies)
+    await layer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--channels', type=int, default=20, help="group members per process")
+    parser.add_argument('--processes', type=int, default=2, help="receiver processes for the cross-process run")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,337 @@
+"""End-to-end load test of the KDS: POS clients, kitchen displays and cooks.
+
+Runs the ASGI application from ``kds_project/asgi.py`` in this process, with
+its storage in a temporary directory. ``--counters`` counters each get a
+display holding a ``ws/kitchen/?counter_id=`` socket, ``--pos`` POS clients
+post ``--orders`` orders to ``orders/create/``, and a cook per counter taps
+each item ready through ``orders/update-item-status/`` ``--cook-delay-ms``
+after its ticket shows up.
+
+Latencies are reported as p50/p95/p99 in milliseconds:
+
+* ``create_request`` / ``tap_request``: the HTTP round trip
+* ``ticket_visible``: order posted -> ticket received by the counter's display
+* ``tap_visible``: tap posted -> the change received by the counter's display
+
+Results are saved as JSON (``--output``, by default under
+``benchmarks/results/``); pass an earlier file as ``--baseline`` to compare.
+
+    python benchmarks/end_to_end_load.py --orders 1000 --pos 8 --counters 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TIMEOUT = 30  # seconds to wait for any single response
+
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+
+    def pick(fraction):
+        return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 3)
+
+    return {
+        'count': len(values),
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'max': round(values[-1] * 1000, 3),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def http_request(app, method, path, body=None):
+    """One HTTP request to the ASGI app; returns (status, decoded JSON body)"""
+    from asgiref.testing import ApplicationCommunicator
+
+    content = json.dumps(body).encode() if body is not None else b''
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': method, 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+        'query_string': b'', 'root_path': '',
+        'headers': [
+            (b'host', b'localhost'),
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(content)).encode()),
+        ],
+        'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+    }
+    communicator = ApplicationCommunicator(app, scope)
+    await communicator.send_input({'type': 'http.request', 'body': content})
+    response = await communicator.receive_output(TIMEOUT)
+    content = b''
+    while True:
+        message = await communicator.receive_output(TIMEOUT)
+        content += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    await communicator.send_input({'type': 'http.disconnect'})
+    await communicator.wait(TIMEOUT)
+    return response['status'], json.loads(content) if content else None
+
+
+class Run:
+    """State shared by the simulated clients of one run"""
+
+    def __init__(self, app, args):
+        self.app = app
+        self.args = args
+        self.latencies = {name: [] for name in ('create_request', 'ticket_visible', 'tap_request', 'tap_visible')}
+        self.errors = 0
+        self.orders_sent = {}  # notes token -> time posted
+        self.tickets_expected = 0
+        self.tickets_seen = set()  # (counter_id, order_id)
+        self.taps_sent = {}  # (order_id, item_index) -> time posted
+        self.taps_expected = 0
+        self.taps_seen = set()
+        self.posting_done = False
+        self.done = asyncio.Event()
+
+    def check_done(self):
+        if (self.posting_done and len(self.tickets_seen) >= self.tickets_expected
+                and len(self.taps_seen) >= self.taps_expected):
+            self.done.set()
+
+    async def pos(self, client, orders, counters):
+        interval = self.args.pos / self.args.rate if self.args.rate else 0
+        for n in range(orders):
+            started = time.perf_counter()
+            token = f'bench-{client}-{n}'
+            self.orders_sent[token] = started
+            items = [
+                {'name': f'Item {i}', 'category': f'station-{random.choice(counters)}', 'quantity': 1, 'price': 5}
+                for i in range(random.randint(1, self.args.items))
+            ]
+            status, order = await http_request(self.app, 'POST', '/api/kds/orders/create/', {
+                'table_number': f'T-{client}', 'notes': token, 'items': items
+            })
+            self.latencies['create_request'].append(time.perf_counter() - started)
+            if status != 201:
+                self.errors += 1
+                continue
+            counters_involved = {item['assigned_counter'] for item in order['items']}
+            self.tickets_expected += len(counters_involved)
+            self.taps_expected += len(order['items'])
+            if interval:
+                await asyncio.sleep(max(0.0, interval - (time.perf_counter() - started)))
+
+    async def tap(self, order_id, item_index):
+        await asyncio.sleep(self.args.cook_delay_ms / 1000)
+        started = time.perf_counter()
+        self.taps_sent[(order_id, item_index)] = started
+        status, _ = await http_request(self.app, 'POST', '/api/kds/orders/update-item-status/', {
+            'order_id': order_id, 'item_index': item_index, 'status': 'ready'
+        })
+        self.latencies['tap_request'].append(time.perf_counter() - started)
+        if status != 200:
+            self.errors += 1
+            self.taps_expected -= 1
+            self.check_done()
+
+    def ticket(self, counter_id, order, cook):
+        """A display received ``order`` (its counter's items); time it and have the cook tap it"""
+        key = (counter_id, order['id'])
+        if key in self.tickets_seen or order.get('notes') not in self.orders_sent:
+            return
+        self.tickets_seen.add(key)
+        self.latencies['ticket_visible'].append(time.perf_counter() - self.orders_sent[order['notes']])
+        for item in order['items']:
+            if item.get('status') != 'ready':
+                cook.append(asyncio.ensure_future(self.tap(order['id'], int(item['id'].rsplit('_', 1)[1]))))
+
+    def tapped(self, order_id, item_index):
+        key = (order_id, item_index)
+        if key in self.taps_sent and key not in self.taps_seen:
+            self.taps_seen.add(key)
+            self.latencies['tap_visible'].append(time.perf_counter() - self.taps_sent[key])
+
+    async def display(self, counter_id, ready):
+        """A kitchen display and the cook reading it"""
+        from asgiref.testing import ApplicationCommunicator
+
+        communicator = ApplicationCommunicator(self.app, {
+            'type': 'websocket', 'path': '/ws/kitchen/', 'raw_path': b'/ws/kitchen/',
+            'query_string': f'counter_id={counter_id}'.encode(),
+            'headers': [(b'host', b'localhost')], 'subprotocols': [],
+            'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+        })
+        await communicator.send_input({'type': 'websocket.connect'})
+        accepted = await communicator.receive_output(TIMEOUT)
+        assert accepted['type'] == 'websocket.accept', accepted
+        cook = []
+        try:
+            while True:
+                message = await communicator.receive_output(None)
+                if message['type'] != 'websocket.send':
+                    break
+                frame = json.loads(message['text'])
+                if frame['type'] == 'initial_data':
+                    ready.set()
+                events = frame['events'] if frame['type'] == 'batch' else [frame]
+                for event in events:
+                    if event['type'] in ('new_order', 'order_update'):
+                        self.ticket(counter_id, event['order'], cook)
+                        if event['type'] == 'order_update':
+                            for index, item in enumerate(event['order']['items']):
+                                if item.get('status') == 'ready':
+                                    self.tapped(event['order']['id'], int(item['id'].rsplit('_', 1)[1]))
+                    elif event['type'] == 'order_patch':
+                        self.tapped(event['order_id'], event['item_index'])
+                    elif event['type'] == 'ping':
+                        await communicator.send_input({'type': 'websocket.receive', 'text': '{"type":"pong"}'})
+                self.check_done()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for task in cook:
+                task.cancel()
+            await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+
+
+async def run(args):
+    from kds_project.asgi import application
+    from kds_app.metrics import metrics
+
+    run = Run(application, args)
+    counters = []
+    for n in range(args.counters):
+        status, body = await http_request(application, 'POST', '/api/kds/counters/create/', {
+            'name': f'Station {n + 1}', 'pin': str(1000 + n)
+        })
+        assert status == 201, body
+        counters.append(body['counter_id'])
+        await http_request(application, 'POST', f"/api/kds/counters/{body['counter_id']}/categories/", {
+            'categories': [f"station-{body['counter_id']}"]
+        })
+
+    displays = []
+    for counter_id in counters:
+        ready = asyncio.Event()
+        displays.append(asyncio.ensure_future(run.display(counter_id, ready)))
+        await asyncio.wait_for(ready.wait(), TIMEOUT)
+
+    started = time.perf_counter()
+    shares = [args.orders // args.pos + (1 if i < args.orders % args.pos else 0) for i in range(args.pos)]
+    await asyncio.gather(*(run.pos(client, orders, counters) for client, orders in enumerate(shares)))
+    posted = time.perf_counter() - started
+    run.posting_done = True
+    run.check_done()
+    try:
+        await asyncio.wait_for(run.done.wait(), args.timeout)
+        timed_out = False
+    except asyncio.TimeoutError:
+        timed_out = True
+    elapsed = time.perf_counter() - started
+    for task in displays:
+        task.cancel()
+    await asyncio.gather(*displays, return_exceptions=True)
+
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+        'duration_seconds': round(elapsed, 3),
+        'orders_per_second': round(args.orders / posted, 1),
+        'taps_per_second': round(len(run.latencies['tap_request']) / elapsed, 1),
+        'errors': run.errors,
+        'timed_out': timed_out,
+        'tickets': {'expected': run.tickets_expected, 'seen': len(run.tickets_seen)},
+        'taps': {'expected': run.taps_expected, 'seen': len(run.taps_seen)},
+        'latency_ms': {name: percentiles(values) for name, values in run.latencies.items()},
+        'server_metrics': metrics.snapshot(),
+    }
+
+
+def report(results, baseline=None):
+    print(f"orders/s {results['orders_per_second']}  taps/s {results['taps_per_second']}  "
+          f"errors {results['errors']}{'  TIMED OUT' if results['timed_out'] else ''}")
+    print(f"{'latency (ms)':<16} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for name, stats in results['latency_ms'].items():
+        if not stats['count']:
+            continue
+        print(f"{name:<16} {stats['count']:>7} " + ' '.join(f"{stats[key]:>9.2f}" for key in ('p50', 'p95', 'p99', 'max')))
+        before = (baseline or {}).get('latency_ms', {}).get(name)
+        if before and before.get('count'):
+            print(f"{'  vs baseline':<16} {'':>7} " + ' '.join(
+                f"{(stats[key] - before[key]) / before[key] * 100 if before[key] else 0:>+8.0f}%"
+                for key in ('p50', 'p95', 'p99', 'max')
+            ))
+
+
+def main(args):
+    # Everything the server writes goes to a scratch directory
+    workdir = tempfile.mkdtemp(prefix='kds-bench-')
+    os.environ.update({
+        'DJANGO_SETTINGS_MODULE': 'kds_project.settings',
+        'KDS_STORAGE_BACKEND': {
+            'json': 'kds_app.storage.json_file.JSONFileBackend',
+            'sqlite': 'kds_app.storage.sqlite.SQLiteBackend',
+        }[args.backend],
+        'KDS_STORAGE_DURABILITY': args.durability,
+        'KDS_DATA_FILE': os.path.join(workdir, 'orders_data.json'),
+        'KDS_JOURNAL_FILE': os.path.join(workdir, 'orders_journal.jsonl'),
+        'KDS_SQLITE_DATABASE': os.path.join(workdir, 'orders.sqlite3'),
+        'KDS_COUNTERS_FILE': os.path.join(workdir, 'counters.json'),
+        'KDS_ARCHIVE_DIR': os.path.join(workdir, 'order_archive'),
+        'KDS_ARCHIVE_INTERVAL_SECONDS': '0',
+        'KDS_CHANNEL_LAYER': 'memory',
+    })
+    import django
+    django.setup()
+
+    random.seed(args.seed)
+    results = asyncio.run(run(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    output = args.output or os.path.join(
+        ROOT, 'benchmarks', 'results', f"end_to_end_{datetime.now():%Y%m%d_%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved to {output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=500, help="orders posted in total")
+    parser.add_argument('--pos', type=int, default=4, help="concurrent POS clients")
+    parser.add_argument('--counters', type=int, default=4, help="counters, each with one display and one cook")
+    parser.add_argument('--items', type=int, default=4, help="most items per order")
+    parser.add_argument('--rate', type=float, default=0, help="orders per second across all POS (0: as fast as possible)")
+    parser.add_argument('--cook-delay-ms', type=float, default=0, help="time a cook takes before tapping an item")
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--durability', choices=('none', 'batch', 'sync'), default='batch')
+    parser.add_argument('--timeout', type=float, default=60, help="seconds to wait for the last tickets and taps")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="results file (default: benchmarks/results/end_to_end_<time>.json)")
+    parser.add_argument('--baseline', help="earlier results file to compare against")
+    main(parser.parse_args())
@@ -0,0 +1,89 @@
+"""Write throughput of the order storage backends at each durability level.
+
+Runs ``--threads`` threads that each create ``--writes`` orders and mark
+their first item ready, against a fresh store in a temporary directory, for
+every backend/persistence combination and durability level, and reports
+writes per second and per-write latency. Put ``--dir`` on the disk the server
+uses: fsync costs depend entirely on it.
+
+    python benchmarks/storage_durability.py --writes 200 --threads 8
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kds_app.storage.base import DURABILITY_LEVELS  # noqa: E402
+from kds_app.storage.json_file import JSONFileBackend  # noqa: E402
+from kds_app.storage.sqlite import SQLiteBackend  # noqa: E402
+
+STORES = {
+    'json snapshot': lambda path, durability: JSONFileBackend({
+        'DATA_FILE': os.path.join(path, 'orders.json'),
+        'PERSISTENCE': 'snapshot',
+        'DURABILITY': durability,
+    }),
+    'json journal': lambda path, durability: JSONFileBackend({
+        'DATA_FILE': os.path.join(path, 'orders.json'),
+        'JOURNAL_FILE': os.path.join(path, 'orders.jsonl'),
+        'PERSISTENCE': 'journal',
+        'DURABILITY': durability,
+    }),
+    'sqlite': lambda path, durability: SQLiteBackend({
+        'DATABASE': os.path.join(path, 'orders.sqlite3'),
+        'DURABILITY': durability,
+    }),
+}
+
+
+def writer(backend, writes, latencies):
+    for _ in range(writes):
+        started = time.perf_counter()
+        order_id = backend.create_order({'items': [{'name': 'Burger', 'assigned_counter': 1}]})
+        latencies.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        backend.patch_item_status(order_id, 0, 'ready')
+        latencies.append(time.perf_counter() - started)
+
+
+def run(store, durability, writes, threads, directory):
+    """Returns (seconds, latencies)"""
+    with tempfile.TemporaryDirectory(dir=directory) as path:
+        backend = STORES[store](path, durability)
+        latencies = []
+        workers = [threading.Thread(target=writer, args=(backend, writes, latencies)) for _ in range(threads)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        backend.close()
+    return elapsed, latencies
+
+
+def main(args):
+    print(f"{args.threads} threads x {args.writes} orders (2 writes each) in {args.dir or tempfile.gettempdir()}\n")
+    print(f"{'store':<14} {'durability':<10} {'writes/s':>10} {'p50 ms':>9} {'p99 ms':>9}")
+    for store in STORES:
+        for durability in DURABILITY_LEVELS:
+            elapsed, latencies = run(store, durability, args.writes, args.threads, args.dir)
+            latencies.sort()
+            p99 = latencies[int(len(latencies) * 0.99) - 1]
+            print(
+                f"{store:<14} {durability:<10} {len(latencies) / elapsed:>10.0f} "
+                f"{statistics.median(latencies) * 1000:>9.2f} {p99 * 1000:>9.2f}"
+            )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writes', type=int, default=200, help="orders created per thread")
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--dir', default=None, help="directory to put the stores in (default: system temp)")
+    main(parser.parse_args())
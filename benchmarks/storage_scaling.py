@@ -0,0 +1,256 @@
+"""How order storage operations scale with the number of stored orders.
+
+For each backend and each ``--sizes`` store size, fills a fresh store in a
+temporary directory with that many orders (all but the last ``--live`` of
+them already served, like a day's history) and times every
+``OrderDataStorage`` operation the server leans on. It reports microseconds
+per operation and the peak memory one operation allocates (tracemalloc).
+The ``growth`` column is the time at the largest size over the time at the
+smallest: roughly 1 for operations that don't depend on history, and about
+the size ratio for ones that scan it.
+
+Backends are presets (``json``, ``json-journal``, ``sqlite``) or the dotted
+path of any ``OrderStorageBackend`` subclass; ``--option KEY=VALUE`` adds to
+their ``OPTIONS``. Results are saved as JSON with ``--output``. With
+``--baseline`` the run fails (exit status 1) if an operation got more than
+``--threshold`` times slower than in that earlier run, and with
+``--max-growth`` if its growth exceeds that factor.
+
+    python benchmarks/storage_scaling.py --sizes 100 1000 10000 100000
+    python benchmarks/storage_scaling.py --output base.json
+    python benchmarks/storage_scaling.py --baseline base.json --threshold 1.5
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from django.utils.module_loading import import_string  # noqa: E402
+
+from kds_app.data_storage import OrderDataStorage  # noqa: E402
+from kds_app.storage import set_backend  # noqa: E402
+
+PRESETS = {
+    'json': ('kds_app.storage.json_file.JSONFileBackend', {'PERSISTENCE': 'snapshot'}),
+    'json-journal': ('kds_app.storage.json_file.JSONFileBackend', {'PERSISTENCE': 'journal'}),
+    'sqlite': ('kds_app.storage.sqlite.SQLiteBackend', {}),
+}
+
+COUNTERS = 8
+CHUNK = 1000  # orders created per create_orders call while filling
+
+
+def make_backend(name, path, options):
+    dotted, preset_options = PRESETS.get(name, (name, {}))
+    backend_class = import_string(dotted)
+    return backend_class(dict({
+        'DATA_FILE': os.path.join(path, 'orders_data.json'),
+        'JOURNAL_FILE': os.path.join(path, 'orders_journal.jsonl'),
+        'DATABASE': os.path.join(path, 'orders.sqlite3'),
+    }, **preset_options, **options))
+
+
+def order_data(rng, ready=False):
+    return {
+        'table_number': f'T-{rng.randint(1, 40)}',
+        'items': [
+            {
+                'name': f'Item {i}', 'category': 'bench', 'quantity': 1, 'price': 5,
+                'assigned_counter': rng.randint(1, COUNTERS),
+                **({'status': 'ready'} if ready else {})
+            }
+            for i in range(rng.randint(1, 4))
+        ]
+    }
+
+
+def fill(size, live, rng):
+    """Store ``size`` orders; all but the last ``live`` are served"""
+    history = max(0, size - live)
+    for start in range(0, size, CHUNK):
+        count = min(CHUNK, size - start)
+        created = OrderDataStorage.create_orders([
+            order_data(rng, ready=start + i < history) for i in range(count)
+        ])
+        for order in created:
+            if int(order['id']) <= history:
+                OrderDataStorage.update_order_status(order['id'], 'served')
+    OrderDataStorage.flush()
+    return history
+
+
+def operations(size, history, rng):
+    """name -> zero-argument callable doing one operation"""
+    statuses = ['pending', 'in_progress', 'ready']
+
+    def update_item_status():
+        order_id = str(rng.randint(history + 1, size)) if size > history else '1'
+        OrderDataStorage.update_item_status(order_id, 0, rng.choice(statuses))
+
+    return {
+        'get_order': lambda: OrderDataStorage.get_order(str(rng.randint(1, size))),
+        'get_orders_by_status': lambda: OrderDataStorage.get_orders_by_status('pending'),
+        'get_ready_to_serve_orders': OrderDataStorage.get_ready_to_serve_orders,
+        'orders_by_counter': lambda: OrderDataStorage.get_orders_for_counter(rng.randint(1, COUNTERS)),
+        'update_item_status': update_item_status,
+        'create_order': lambda: OrderDataStorage.create_order(order_data(rng)),
+    }
+
+
+def measure(operation, seconds, min_reps):
+    """Return (microseconds per call, repetitions, peak KiB allocated by one call)"""
+    for _ in range(min_reps):
+        operation()
+    reps = 0
+    started = time.perf_counter()
+    while reps < min_reps or time.perf_counter() - started < seconds:
+        operation()
+        reps += 1
+    elapsed = time.perf_counter() - started
+
+    # Memory separately: tracing slows everything down
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        operation()
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+    return elapsed / reps * 1e6, reps, max(0, peak) / 1024
+
+
+def run_backend(name, args):
+    results = {}
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory(dir=args.dir) as path:
+            set_backend(make_backend(name, path, args.options))
+            rng = random.Random(args.seed)
+            started = time.perf_counter()
+            history = fill(size, args.live, rng)
+            print(f"  {size} orders stored in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+            results[size] = {}
+            for operation_name, operation in operations(size, history, rng).items():
+                us, reps, peak_kib = measure(operation, args.seconds, args.min_reps)
+                results[size][operation_name] = {'us_per_op': round(us, 2), 'reps': reps, 'peak_kib': round(peak_kib, 1)}
+            # Don't time the next size against this one's background writes
+            OrderDataStorage.flush()
+            set_backend(None)
+    return results
+
+
+def growth(by_size, operation):
+    sizes = sorted(by_size, key=int)
+    first, last = by_size[sizes[0]][operation]['us_per_op'], by_size[sizes[-1]][operation]['us_per_op']
+    return last / first if first else 0
+
+
+def report(results):
+    for backend, by_size in results.items():
+        sizes = sorted(by_size, key=int)
+        print(f"\n{backend}: us/op (peak KiB)")
+        print(f"{'operation':<26}" + ''.join(f"{size:>20}" for size in sizes) + f"{'growth':>9}")
+        for operation in by_size[sizes[0]]:
+            cells = ''.join(
+                f"{by_size[size][operation]['us_per_op']:>11.1f} ({by_size[size][operation]['peak_kib']:>6.0f})"
+                for size in sizes
+            )
+            print(f"{operation:<26}{cells}{growth(by_size, operation):>8.1f}x")
+
+
+def check(results, baseline, args):
+    """Descriptions of every operation over the thresholds"""
+    failures = []
+    for backend, by_size in results.items():
+        for size, operations_run in by_size.items():
+            before = (baseline or {}).get(backend, {}).get(str(size), {})
+            for operation, stats in operations_run.items():
+                old = before.get(operation)
+                # Ignore differences too small to be more than noise
+                if (old and stats['us_per_op'] > old['us_per_op'] * args.threshold
+                        and stats['us_per_op'] - old['us_per_op'] > args.min_delta_us):
+                    failures.append(
+                        f"{backend} {operation} at {size} orders: "
+                        f"{old['us_per_op']:.1f} -> {stats['us_per_op']:.1f} us/op"
+                    )
+        if args.max_growth and len(by_size) > 1:
+            for operation in next(iter(by_size.values())):
+                if growth(by_size, operation) > args.max_growth:
+                    failures.append(f"{backend} {operation} grows {growth(by_size, operation):.1f}x with history")
+    return failures
+
+
+def main(args):
+    results = {}
+    for name in args.backends:
+        print(f"{name}:", file=sys.stderr)
+        results[name] = run_backend(name, args)
+    # Sizes as strings, as they come back from JSON
+    results = json.loads(json.dumps(results))
+    report(results)
+
+    if args.output:
+        try:
+            commit = subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True
+            ).stdout.strip() or None
+        except OSError:
+            commit = None
+        with open(args.output, 'w') as f:
+            json.dump({
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'git_commit': commit,
+                'config': vars(args),
+                'results': results,
+            }, f, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    failures = check(results, baseline, args)
+    if failures:
+        print("\nFAILED:\n" + '\n'.join(failures))
+        sys.exit(1)
+
+
+def option(text):
+    key, _, value = text.partition('=')
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backends', nargs='+', default=list(PRESETS),
+                        help="presets (%s) or dotted backend class paths" % ', '.join(PRESETS))
+    parser.add_argument('--option', dest='options', type=option, action='append', default=[],
+                        help="backend OPTIONS entry, KEY=VALUE (VALUE parsed as JSON if it can be)")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--live', type=int, default=50, help="orders still in the kitchen; the rest are served")
+    parser.add_argument('--seconds', type=float, default=0.2, help="time spent on each operation per size")
+    parser.add_argument('--min-reps', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--dir', default=None, help="directory to put the stores in (default: system temp)")
+    parser.add_argument('--output', help="save results to this JSON file")
+    parser.add_argument('--baseline', help="results file of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help="fail if an operation is this many times slower than in the baseline")
+    parser.add_argument('--min-delta-us', type=float, default=20,
+                        help="ignore slowdowns smaller than this many microseconds")
+    parser.add_argument('--max-growth', type=float, default=None,
+                        help="fail if an operation gets this many times slower from the smallest size to the largest")
+    args = parser.parse_args()
+    args.options = dict(args.options)
+    main(args)
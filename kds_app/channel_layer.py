@@ -0,0 +1,457 @@
+import asyncio
+import json
+import os
+import random
+import string
+import struct
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.core.exceptions import ImproperlyConfigured
+
+from .file_lock import InterProcessLock
+
+# Frames are a 4-byte big-endian length followed by that many bytes of JSON
+HEADER = struct.Struct('!I')
+MAX_FRAME_BYTES = 16 * 1024 * 1024
+
+# Deliveries to a worker that has this much unread data queued are dropped
+MAX_BUFFERED_BYTES = 8 * 1024 * 1024
+
+# How often the broker forgets expired group memberships, in seconds
+SWEEP_INTERVAL = 60
+
+# How long a worker keeps retrying to reach or take over the broker, in seconds
+CONNECT_TIMEOUT = 5
+
+# Longest pause between attempts to get back to a broker that went away, in seconds
+RECONNECT_MAX_DELAY = 5
+
+
+def encode_frame(payload: Dict) -> bytes:
+    body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return HEADER.pack(len(body)) + body
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Dict:
+    """Read one frame; raises IncompleteReadError when the peer goes away"""
+    size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if size > MAX_FRAME_BYTES:
+        raise ConnectionError(f"Channel layer frame of {size} bytes is too large")
+    return json.loads(await reader.readexactly(size))
+
+
+def channel_client(channel: str) -> Optional[str]:
+    """Id of the worker that created a process-specific channel, e.g. ``specific.<id>!abc``"""
+    if '!' not in channel:
+        return None
+    return channel[:channel.index('!')].rsplit('.', 1)[-1]
+
+
+class ChannelBroker:
+    """Group membership and fan-out shared by the workers of one host.
+
+    Each worker holds one connection, and says which channel names it owns
+    with a ``hello``. A ``group_send`` becomes one ``deliver`` frame per
+    worker with members in the group, listing that worker's channels, so a
+    message crosses each connection once however many displays it reaches.
+
+    Memberships end ``group_expiry`` seconds after they were added, or as
+    soon as the worker that owns the channel disconnects.
+    """
+
+    def __init__(self, group_expiry: int):
+        self.group_expiry = group_expiry
+        # Group -> channel -> time it was added
+        self.groups: Dict[str, Dict[str, float]] = {}
+        # Worker id -> connection
+        self.clients: Dict[str, asyncio.StreamWriter] = {}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client = None
+        try:
+            while True:
+                op = await read_frame(reader)
+                kind = op['op']
+                if kind == 'hello':
+                    client = op['client']
+                    self.clients[client] = writer
+                elif kind == 'group_add':
+                    self.groups.setdefault(op['group'], {})[op['channel']] = op['added']
+                elif kind == 'group_discard':
+                    self.discard(op['group'], op['channel'])
+                elif kind == 'group_send':
+                    self.group_send(op['group'], op['message'])
+                elif kind == 'send':
+                    self.deliver(channel_client(op['channel']), [op['channel']], op['message'])
+                elif kind == 'flush':
+                    self.groups = {}
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            if client is not None and self.clients.get(client) is writer:
+                del self.clients[client]
+                self.forget_client(client)
+            writer.close()
+
+    def discard(self, group: str, channel: str):
+        members = self.groups.get(group)
+        if members:
+            members.pop(channel, None)
+            if not members:
+                del self.groups[group]
+
+    def forget_client(self, client: str):
+        """Drop every membership of a worker that went away"""
+        for group in list(self.groups):
+            for channel in [channel for channel in self.groups[group] if channel_client(channel) == client]:
+                self.discard(group, channel)
+
+    def sweep(self):
+        """Drop memberships older than ``group_expiry``"""
+        cutoff = time.time() - self.group_expiry
+        for group in list(self.groups):
+            for channel, added in list(self.groups[group].items()):
+                if added < cutoff:
+                    self.discard(group, channel)
+
+    def group_send(self, group: str, message: Dict):
+        members = self.groups.get(group)
+        if not members:
+            return
+        cutoff = time.time() - self.group_expiry
+        by_client: Dict[str, List[str]] = {}
+        for channel, added in list(members.items()):
+            if added < cutoff:
+                self.discard(group, channel)
+            else:
+                by_client.setdefault(channel_client(channel), []).append(channel)
+        for client, channels in by_client.items():
+            self.deliver(client, channels, message)
+
+    def deliver(self, client: Optional[str], channels: List[str], message: Dict):
+        writer = self.clients.get(client)
+        if writer is None or writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() > MAX_BUFFERED_BYTES:
+            # The worker stopped reading; like a full channel, the message is dropped
+            return
+        writer.write(encode_frame({'op': 'deliver', 'channels': channels, 'message': message}))
+
+    async def run_sweeper(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            self.sweep()
+
+
+class LocalBrokerChannelLayer(BaseChannelLayer):
+    """Channel layer for several worker processes on one host, without Redis.
+
+    Workers talk to a ``ChannelBroker`` over the Unix domain socket at
+    ``path``. The first worker to start hosts the broker, holding
+    ``<path>.lock`` for as long as it runs; if it exits, the others
+    reconnect right away and one of them takes over. Messages sent while
+    that happens are lost, and memberships are re-added from each worker's
+    own record.
+
+    Each worker runs its broker connection (and the broker, if it hosts it)
+    on a background thread, so the layer can be used from any event loop,
+    including the short-lived ones of ``async_to_sync``. Messages for a
+    channel are queued on the event loop that created it.
+
+    Only process-specific channels (from ``new_channel``) reach other
+    workers; plain channel names stay local to the process, as with
+    ``InMemoryChannelLayer``. Messages must be JSON serializable.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(
+        self,
+        path='kds_channels.sock',
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        **kwargs
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        if not hasattr(asyncio, 'start_unix_server'):
+            raise ImproperlyConfigured("LocalBrokerChannelLayer needs Unix domain sockets")
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.path = path
+        self.group_expiry = group_expiry
+        self.client_id = uuid.uuid4().hex[:16]
+
+        # Channel -> queue and the event loop it belongs to
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._loops: Dict[str, asyncio.AbstractEventLoop] = {}
+        self._receiving: Dict[str, int] = {}
+        # Channel -> group -> time added, to re-add after reconnecting
+        self._memberships: Dict[str, Dict[str, float]] = {}
+
+        self._start_lock = threading.Lock()
+        self._io_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._connect_lock: Optional[asyncio.Lock] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._broker: Optional[ChannelBroker] = None
+        self._broker_lock: Optional[InterProcessLock] = None
+        self._server = None
+        self._tasks = set()
+        self._reconnecting: Optional[asyncio.Task] = None
+
+    # Broker connection, all run on the background loop
+
+    def _io(self) -> asyncio.AbstractEventLoop:
+        if self._io_loop is None:
+            with self._start_lock:
+                if self._io_loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(
+                        target=loop.run_forever,
+                        name='channel-layer-io',
+                        daemon=True
+                    ).start()
+                    self._io_loop = loop
+        return self._io_loop
+
+    async def _on_io(self, coro):
+        """Run ``coro`` on the background loop and wait for it from the current one"""
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self._io()))
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _connection(self) -> asyncio.StreamWriter:
+        writer = self._writer
+        if writer is not None and not writer.is_closing():
+            return writer
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer is None or self._writer.is_closing():
+                await self._connect()
+            return self._writer
+
+    async def _connect(self):
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if await self._host_broker():
+                    continue
+                if time.monotonic() > deadline:
+                    raise
+                # Another worker holds the broker lock and is starting it up
+                await asyncio.sleep(0.05)
+
+        writer.write(encode_frame({'op': 'hello', 'client': self.client_id}))
+        cutoff = time.time() - self.group_expiry
+        for channel, groups in list(self._memberships.items()):
+            for group, added in list(groups.items()):
+                if added >= cutoff:
+                    writer.write(encode_frame({'op': 'group_add', 'group': group, 'channel': channel, 'added': added}))
+        await writer.drain()
+        self._writer = writer
+        self._spawn(self._read_deliveries(reader, writer))
+
+    async def _host_broker(self) -> bool:
+        """Start the broker in this process if no other worker runs it"""
+        if self._server is not None:
+            return False
+        lock = InterProcessLock(f"{self.path}.lock")
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            # A socket file left behind by a broker that died
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        broker = ChannelBroker(self.group_expiry)
+        self._server = await asyncio.start_unix_server(broker.handle, path=self.path)
+        os.chmod(self.path, 0o600)
+        self._broker = broker
+        self._broker_lock = lock
+        self._spawn(broker.run_sweeper())
+        return True
+
+    async def _read_deliveries(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                frame = await read_frame(reader)
+                by_loop: Dict[asyncio.AbstractEventLoop, List[str]] = {}
+                for channel in frame['channels']:
+                    loop = self._loops.get(channel)
+                    if loop is not None:
+                        by_loop.setdefault(loop, []).append(channel)
+                for loop, channels in by_loop.items():
+                    try:
+                        loop.call_soon_threadsafe(self._enqueue, channels, frame['message'])
+                    except RuntimeError:
+                        pass  # the loop has been closed
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+            if self._writer is writer:
+                # Don't wait for our next send: displays that only receive
+                # need their memberships on the new broker now
+                self._reconnecting = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self):
+        """Get back to a broker, taking it over if needed, until it works"""
+        delay = 0.05
+        while True:
+            try:
+                await self._connection()
+                return
+            except OSError as e:
+                print(f"Error reconnecting to the channel broker: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    async def _send_op(self, op: Dict):
+        writer = await self._connection()
+        writer.write(encode_frame(op))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            # The broker went away under us: the op is lost, like any sent
+            # during a takeover, and the reader reconnects
+            writer.close()
+
+    # Local queues, run on the loop that owns the channel
+
+    def _queue(self, channel: str) -> asyncio.Queue:
+        queue = self._queues.get(channel)
+        if queue is None:
+            queue = self._queues[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return queue
+
+    def _enqueue(self, channels: List[str], message: Dict):
+        expires = time.time() + self.expiry
+        for channel in channels:
+            try:
+                self._queue(channel).put_nowait((expires, dict(message)))
+            except asyncio.QueueFull:
+                pass  # a full channel drops group messages
+
+    def _clean_expired(self):
+        """Drop expired messages, and the queues of channels nobody receives from.
+
+        A channel that has no queue and is in no group is forgotten, so
+        messages for it from other workers are dropped from then on.
+        """
+        now = time.time()
+        for channel, queue in list(self._queues.items()):
+            while not queue.empty() and queue._queue[0][0] < now:
+                queue.get_nowait()
+            if queue.empty() and not self._receiving.get(channel):
+                del self._queues[channel]
+                if channel not in self._memberships:
+                    self._loops.pop(channel, None)
+
+    # Channel layer API
+
+    async def new_channel(self, prefix='specific.'):
+        """Return a new process-specific channel, owned by the current event loop"""
+        channel = '%s%s!%s' % (
+            prefix if prefix.endswith('.') else prefix + '.',
+            self.client_id,
+            ''.join(random.choice(string.ascii_letters) for _ in range(12))
+        )
+        self._loops[channel] = asyncio.get_running_loop()
+        return channel
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        client = channel_client(channel)
+        if client is None or client == self.client_id:
+            if channel not in self._loops:
+                self._loops[channel] = asyncio.get_running_loop()
+            try:
+                self._queue(channel).put_nowait((time.time() + self.expiry, dict(message)))
+            except asyncio.QueueFull:
+                raise ChannelFull(channel)
+            return
+        await self._on_io(self._send_op({'op': 'send', 'channel': channel, 'message': message}))
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        self._clean_expired()
+        self._loops.setdefault(channel, asyncio.get_running_loop())
+        queue = self._queue(channel)
+        self._receiving[channel] = self._receiving.get(channel, 0) + 1
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires >= time.time():
+                    return message
+        finally:
+            self._receiving[channel] -= 1
+            if not self._receiving[channel]:
+                del self._receiving[channel]
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        added = time.time()
+        self._memberships.setdefault(channel, {})[group] = added
+        await self._on_io(self._send_op({'op': 'group_add', 'group': group, 'channel': channel, 'added': added}))
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        groups = self._memberships.get(channel)
+        if groups is not None:
+            groups.pop(group, None)
+            if not groups:
+                del self._memberships[channel]
+        await self._on_io(self._send_op({'op': 'group_discard', 'group': group, 'channel': channel}))
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        await self._on_io(self._send_op({'op': 'group_send', 'group': group, 'message': message}))
+
+    async def flush(self):
+        self._queues = {}
+        self._memberships = {}
+        await self._on_io(self._send_op({'op': 'flush'}))
+
+    async def close(self):
+        """Disconnect from the broker, and stop it if this worker hosts it"""
+        if self._io_loop is not None:
+            await self._on_io(self._close())
+
+    async def _close(self):
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+            self._reconnecting = None
+        if self._writer is not None:
+            writer, self._writer = self._writer, None
+            writer.close()
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._broker.clients.values()):
+                writer.close()
+            await self._server.wait_closed()
+            for task in list(self._tasks):
+                task.cancel()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self._broker_lock.release()
+            self._server = None
+            self._broker = None
+            self._broker_lock = None
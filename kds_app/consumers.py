@@ -1,11 +1,99 @@
+import asyncio
 import json
+import math
+from urllib.parse import parse_qs
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
-# from channels.db import database_sync_to_async  # Not needed for file-based storage
-from .data_storage import OrderDataStorage
+from .data_storage import OrderDataStorage, call_storage
+from .metrics import metrics, monitor_event_loop
+from .notifications import (
+    counter_group_name, dispatcher, encode_frame, notify_order_update, notify_order_updates, replay_buffer,
+    unbatch
+)
+from .storage.base import filter_order_for_counter
+
+
+# Messages that carry the whole current state of an order (or its removal)
+# and so make any earlier queued message about that order redundant
+SUPERSEDING_MESSAGES = ('new_order', 'order_update', 'order_deleted')
+
+
+def update_order_status(order_id, status):
+    """Set an order's status and queue its broadcast, as the HTTP endpoint does"""
+    if not status or not OrderDataStorage.update_order_status(order_id, status):
+        return False
+    try:
+        notify_order_update(OrderDataStorage.get_order(order_id))
+    except Exception as e:
+        print(f"Error notifying WebSocket clients: {e}")
+    return True
+
+
+def update_item_statuses(changes):
+    """Apply item status changes and queue their broadcast, as the HTTP endpoint does.
+
+    Runs on a storage thread, so the broadcast is queued right after the
+    commit, in order with every other write's notifications.
+    """
+    orders = OrderDataStorage.patch_item_statuses(changes)
+    if orders is not None:
+        try:
+            notify_order_updates(orders)
+        except Exception as e:
+            print(f"Error notifying WebSocket clients: {e}")
+    return orders
+
+
+def websocket_settings():
+    config = {
+        'COALESCE_WINDOW_MS': 15, 'COALESCE_MAX_LATENCY_MS': 60, 'SEND_QUEUE_LIMIT': 100,
+        'HEARTBEAT_INTERVAL_SECONDS': 20, 'HEARTBEAT_TIMEOUT_SECONDS': 60
+    }
+    config.update(getattr(settings, 'KDS_WEBSOCKET', {}))
+    return config
 
 
 class OrderConsumer(AsyncWebsocketConsumer):
+    """Kitchen display connection for one counter.
+
+    Order events from the group are held for up to COALESCE_WINDOW_MS
+    after the latest one (never more than COALESCE_MAX_LATENCY_MS after
+    the first), then sent as one ``batch`` frame. While they wait, a newer
+    full update or deletion of an order drops the queued events about it.
+    
+    Handlers only queue events; a single flush at a time writes to the
+    socket, so a slow display never holds up the channel layer. While a
+    send is in progress, new events wait in the queue. When more than
+    SEND_QUEUE_LIMIT are waiting, the events about each order are merged
+    into one refresh of the order read from storage at send time. If that
+    is not enough, the queue is dropped and the display is sent a full
+    ``initial_data`` snapshot instead.
+    
+    Every HEARTBEAT_INTERVAL_SECONDS the display is sent a ``ping``, after
+    whatever is being sent to it at the time. One that has not answered
+    (with ``pong`` or anything else) HEARTBEAT_TIMEOUT_SECONDS after the
+    ping went out is taken out of its group and closed, so broadcasts stop
+    being encoded and queued for sleeping tablets, while a display that is
+    merely slow to take a large send is kept.
+    
+    The group membership is renewed every half ``group_expiry`` of the
+    channel layer, heartbeat or not, so long-lived displays keep getting
+    broadcasts.
+    """
+    
     async def connect(self):
+        # Order events waiting to be sent as one batch
+        self.outbox = []
+        self.outbox_started = None
+        self.outbox_timer = None
+        self.flush_task = None
+        self.send_lock = asyncio.Lock()
+        # Send a full snapshot instead of the queued events
+        self.resync = False
+        self.heartbeat_task = None
+        self.counted = False
+        self.alive = True
+        
         # Get counter ID from query parameters
         self.counter_id = self.scope['query_string'].decode('utf-8')
         if 'counter_id=' in self.counter_id:
@@ -13,9 +101,23 @@ class OrderConsumer(AsyncWebsocketConsumer):
         else:
             self.counter_id = None
         
+        # Store version the client already has, to send only what changed since,
+        # and the last broadcast it saw, to replay just the ones it missed
+        query = parse_qs(self.scope['query_string'].decode('utf-8'))
+        try:
+            since = int(query['since'][0])
+        except (KeyError, ValueError):
+            since = None
+        try:
+            last_seq = int(query['last_seq'][0])
+        except (KeyError, ValueError):
+            last_seq = None
+        epoch = query.get('epoch', [None])[0]
+        
         # Create counter-specific room group
         if self.counter_id:
-            self.room_group_name = f'kitchen_display_counter_{self.counter_id}'
+            self.room_group_name = counter_group_name(self.counter_id)
+            await replay_buffer.follow(self.counter_id)
         else:
             self.room_group_name = 'kitchen_display_all'
         
@@ -27,42 +129,127 @@ class OrderConsumer(AsyncWebsocketConsumer):
         
         await self.accept()
         
-        # Send current orders filtered by counter to the newly connected client
-        current_orders = self.get_current_orders_for_counter()
+        metrics.add_gauge('ws_connections', 1, counter=self.counter_id)
+        self.counted = True
+        # When the oldest ping the display hasn't answered yet was sent
+        self.unanswered_since = None
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
+        
+        # Let sync views hand their notifications to this event loop
+        dispatcher.bind_loop(asyncio.get_running_loop())
+        monitor_event_loop(asyncio.get_running_loop())
+        
+        if self.counter_id and last_seq is not None and epoch == replay_buffer.epoch:
+            missed = replay_buffer.frames_after(self.counter_id, last_seq)
+            if missed is not None:
+                # Frames are already JSON, so the replay is built without re-encoding them
+                seq, frames = missed
+                await self.send(text_data=(
+                    f'{{"type":"resume","epoch":"{replay_buffer.epoch}","seq":{seq},"events":['
+                    + ','.join(frames) + ']}'
+                ))
+                return
+        
+        # Events arriving meanwhile are sent after the initial data
+        async with self.send_lock:
+            await self.send_initial_data(since)
+    
+    async def send_initial_data(self, since):
+        """Send current orders (or changes since the client's version) filtered by counter"""
+        # Broadcasts after this seq reach us through the group, so read it before the orders
+        seq = replay_buffer.last_seq(self.counter_id) if self.counter_id else 0
+        
+        changes = await self.get_changes_for_counter(since)
         await self.send(text_data=json.dumps({
             'type': 'initial_data',
-            'orders': current_orders
+            'orders': changes['orders'],
+            'deleted': changes['deleted'],
+            'full': changes['full'],
+            'version': changes['version'],
+            'epoch': replay_buffer.epoch,
+            'seq': seq
         }))
     
     async def disconnect(self, close_code):
+        await self.leave()
+        if self.heartbeat_task is not None and self.heartbeat_task is not asyncio.current_task():
+            self.heartbeat_task.cancel()
+    
+    async def leave(self):
+        """Stop receiving broadcasts and stop counting this connection"""
+        self.alive = False
+        self.discard_outbox()
+        if self.counted:
+            metrics.add_gauge('ws_connections', -1, counter=self.counter_id)
+            self.counted = False
+        
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
     
+    async def heartbeat(self):
+        """Ping the display, drop it once it leaves a ping unanswered for too long,
+        and renew its group membership before the layer's group expiry ends it"""
+        config = websocket_settings()
+        interval = config['HEARTBEAT_INTERVAL_SECONDS']
+        loop = asyncio.get_running_loop()
+        timeout = config['HEARTBEAT_TIMEOUT_SECONDS']
+        ping = json.dumps({'type': 'ping', 'interval': interval})
+        # By the clock, like the replay follower, since a display may stay up for days
+        renew_every = getattr(self.channel_layer, 'group_expiry', 86400) / 2
+        renewed = pinged = loop.time()
+        while True:
+            next_ping = pinged + interval if interval > 0 else math.inf
+            await asyncio.sleep(max(0, min(next_ping, renewed + renew_every) - loop.time()))
+            now = loop.time()
+            if now >= renewed + renew_every and self.alive:
+                try:
+                    await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+                except Exception as e:
+                    print(f"Error renewing group membership: {e}")
+                renewed = loop.time()
+            if now < next_ping:
+                continue
+            pinged = now
+            unanswered_since = self.unanswered_since
+            if unanswered_since is not None and now - unanswered_since > timeout:
+                metrics.inc('ws_connections_reaped_total', counter=self.counter_id)
+                await self.leave()
+                await self.close()
+                return
+            # Queued behind a send in progress, so a display busy catching up
+            # still gets it, and the wait for its answer starts once it is out
+            async with self.send_lock:
+                await self.send(text_data=ping)
+            if self.unanswered_since is None:
+                self.unanswered_since = loop.time()
+    
     async def receive(self, text_data):
+        # Anything from the display answers our pings
+        self.unanswered_since = None
         try:
             data = json.loads(text_data)
             message_type = data.get('type')
             
-            if message_type == 'update_order_status':
-                order_id = data.get('order_id')
-                status = data.get('status')
-                
-                # Update order status
-                success = self.update_order_status(order_id, status)
-                
-                if success:
-                    # Broadcast the update to all connected clients
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'order_status_update',
-                            'order_id': order_id,
-                            'status': status
-                        }
-                    )
+            if message_type == 'pong':
+                pass
+            elif message_type == 'ping':
+                await self.send(text_data=json.dumps({'type': 'pong'}))
+            elif message_type == 'update_order_status':
+                # Broadcast to every counter of the order like any other write
+                await self.update_order_status(str(data.get('order_id')), data.get('status'))
+            elif message_type == 'update_item_statuses':
+                # Bump many items (e.g. a whole ticket) in one commit
+                orders = await call_storage(update_item_statuses, data.get('changes') or [])
+                if orders is None:
+                    await self.send(text_data=json.dumps({
+                        'error': 'Failed to update item statuses'
+                    }))
+            elif message_type == 'get_order':
+                # Client couldn't apply a patch and wants the whole order again
+                await self.send_order(str(data.get('order_id')))
             else:
                 # Handle unknown message types gracefully
                 print(f"Unknown message type: {message_type}")
@@ -76,79 +263,170 @@ class OrderConsumer(AsyncWebsocketConsumer):
             print(f"Error in WebSocket receive: {e}")
             # Don't close the connection, just log the error
     
-    async def order_status_update(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'order_status_update',
-            'order_id': event['order_id'],
-            'status': event['status']
-        }))
-    
     async def new_order(self, event):
-        # Only send new order if it has items for this counter
-        order = event['order']
-        if self.counter_id and self.has_items_for_counter(order, self.counter_id):
-            await self.send(text_data=json.dumps({
-                'type': 'new_order',
-                'order': order
-            }))
-        elif not self.counter_id:
-            # Send to all if no specific counter
-            await self.send(text_data=json.dumps({
-                'type': 'new_order',
-                'order': order
-            }))
+        # Already projected to this counter's items and encoded by the sender
+        await self.queue_frame(event)
     
     async def order_update(self, event):
-        # Only send order update if it has items for this counter
-        order = event['order']
-        if self.counter_id and self.has_items_for_counter(order, self.counter_id):
-            await self.send(text_data=json.dumps({
-                'type': 'order_update',
-                'order': order
-            }))
-        elif not self.counter_id:
-            # Send to all if no specific counter
-            await self.send(text_data=json.dumps({
-                'type': 'order_update',
-                'order': order
-            }))
+        await self.queue_frame(event)
+    
+    async def order_patch(self, event):
+        await self.queue_frame(event)
+    
+    async def order_deleted(self, event):
+        await self.queue_frame(event)
+    
+    async def order_batch(self, event):
+        # Several orders' events sent to the group in one message
+        for message in unbatch(event):
+            await self.queue_frame(message)
+    
+    async def queue_frame(self, event):
+        """Queue an order event for the next batch (sent right away if coalescing is off)"""
+        if not self.alive:
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        event = dict(event, queued_at=now)
+        if self.counter_id:
+            # Number it as it arrives, so the replay buffer keeps arrival order
+            event['seq'], event['frame'] = replay_buffer.record(self.counter_id, event)
+        
+        outbox = self.outbox
+        if event['type'] in SUPERSEDING_MESSAGES:
+            outbox[:] = [queued for queued in outbox if queued['order_id'] != event['order_id']]
+        outbox.append(event)
+        
+        config = websocket_settings()
+        if len(outbox) > config['SEND_QUEUE_LIMIT']:
+            self.shed_outbox(config['SEND_QUEUE_LIMIT'])
+        
+        window = config['COALESCE_WINDOW_MS'] / 1000
+        if self.outbox_started is None:
+            self.outbox_started = now
+        deadline = min(now + window, self.outbox_started + config['COALESCE_MAX_LATENCY_MS'] / 1000)
+        if self.outbox_timer is not None:
+            self.outbox_timer.cancel()
+        self.outbox_timer = loop.call_at(deadline, self.start_flush)
     
-    def get_current_orders_for_counter(self):
-        """Get current orders filtered by counter"""
-        if not self.counter_id:
-            return OrderDataStorage.get_all_orders()
+    def shed_outbox(self, limit):
+        """Shrink a send queue over its limit: merge events per order, else resync"""
+        outbox = self.outbox
+        counts = {}
+        first_queued = {}
+        for event in outbox:
+            counts[event['order_id']] = counts.get(event['order_id'], 0) + 1
+            first_queued.setdefault(event['order_id'], event['queued_at'])
         
-        all_orders = OrderDataStorage.get_all_orders()
-        filtered_orders = []
+        if len(counts) < len(outbox):
+            # One refresh per order, where its last event was, keeps seqs in order
+            remaining = dict(counts)
+            merged = []
+            for event in outbox:
+                order_id = event['order_id']
+                remaining[order_id] -= 1
+                if remaining[order_id]:
+                    continue
+                if counts[order_id] > 1:
+                    event = {
+                        'type': 'order_refresh',
+                        'order_id': order_id,
+                        'seq': event.get('seq'),
+                        'queued_at': first_queued[order_id]
+                    }
+                merged.append(event)
+            metrics.inc('ws_events_merged_total', len(outbox) - len(merged), counter=self.counter_id)
+            self.outbox = outbox = merged
         
-        for order in all_orders:
-            # Filter items to show only those assigned to this counter
-            relevant_items = [
-                item for item in order.get('items', []) 
-                if item.get('assigned_counter') == self.counter_id
-            ]
-            
-            # Only include order if it has items for this counter
-            if relevant_items:
-                # Create a copy of the order with only relevant items
-                filtered_order = order.copy()
-                filtered_order['items'] = relevant_items
-                filtered_orders.append(filtered_order)
-        
-        return filtered_orders
-    
-    def has_items_for_counter(self, order, counter_id):
-        """Check if order has items assigned to this counter"""
-        return any(
-            item.get('assigned_counter') == counter_id 
-            for item in order.get('items', [])
-        )
+        if len(outbox) > limit:
+            metrics.inc('ws_events_dropped_total', len(outbox), counter=self.counter_id)
+            metrics.inc('ws_resyncs_total', counter=self.counter_id)
+            self.outbox = []
+            self.resync = True
+    
+    def start_flush(self):
+        self.outbox_timer = None
+        if self.flush_task is None or self.flush_task.done():
+            # Keep a reference so the flush task isn't garbage collected mid-send
+            self.flush_task = asyncio.ensure_future(self.flush_outbox())
+    
+    async def flush_outbox(self):
+        """Send queued order events until none are left: a lone event as-is, several as one batch frame"""
+        async with self.send_lock:
+            while self.outbox or self.resync:
+                if self.resync:
+                    self.resync = False
+                    self.discard_outbox()
+                    await self.send_initial_data(None)
+                    continue
+                
+                outbox = self.outbox
+                self.discard_outbox()
+                frames = await asyncio.gather(*(self.event_frame(event) for event in outbox))
+                if len(frames) == 1:
+                    await self.send(text_data=frames[0])
+                else:
+                    # Frames are already JSON, so the batch is built without re-encoding them
+                    await self.send(text_data='{"type":"batch","events":[' + ','.join(frames) + ']}')
+                oldest = min(event['queued_at'] for event in outbox)
+                metrics.observe(
+                    'ws_send_lag_seconds',
+                    asyncio.get_running_loop().time() - oldest,
+                    counter=self.counter_id
+                )
+    
+    async def event_frame(self, event):
+        """Frame to send for a queued event, reading merged orders from storage"""
+        if event['type'] != 'order_refresh':
+            return event['frame']
+        order = await call_storage(OrderDataStorage.get_order, event['order_id'])
+        if order and self.counter_id:
+            order = filter_order_for_counter(order, self.counter_id)
+        if order:
+            message = {'type': 'order_update', 'order': order}
+        else:
+            message = {'type': 'order_deleted', 'order_id': event['order_id']}
+        if event['seq'] is not None:
+            message = dict(seq=event['seq'], **message)
+        return encode_frame(message)
+    
+    def discard_outbox(self):
+        if self.outbox_timer is not None:
+            self.outbox_timer.cancel()
+        self.outbox = []
+        self.outbox_started = None
+        self.outbox_timer = None
+    
+    async def send_order(self, order_id):
+        """Send one order, filtered by counter, or its deletion if it is gone"""
+        # Anything queued about the order is older than what we send now
+        await self.flush_outbox()
+        async with self.send_lock:
+            order = await call_storage(OrderDataStorage.get_order, order_id)
+            if order and self.counter_id:
+                order = filter_order_for_counter(order, self.counter_id)
+            if order:
+                await self.send(text_data=json.dumps({
+                    'type': 'order_update',
+                    'order': order
+                }))
+            else:
+                await self.send(text_data=json.dumps({
+                    'type': 'order_deleted',
+                    'order_id': order_id
+                }))
+    
+    async def get_changes_for_counter(self, since):
+        """Get orders changed since a store version (all orders if None), filtered by counter"""
+        if since is None:
+            # A version no client can be at always gets the full set
+            since = -1
+        return await call_storage(OrderDataStorage.get_changes, since, self.counter_id)
     
-    def update_order_status(self, order_id, status):
-        """Update order status in storage"""
+    async def update_order_status(self, order_id, status):
+        """Update order status in storage and queue its broadcast"""
         try:
-            return OrderDataStorage.update_order_status(order_id, status)
+            return await call_storage(update_order_status, order_id, status)
         except Exception as e:
             print(f"Error updating order status: {e}")
             return False
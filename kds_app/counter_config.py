@@ -1,122 +1,264 @@
-# Dynamic counter configuration with in-memory storage
+# Dynamic counter configuration, persisted and shared by every worker
 # Users create all counters through the frontend - no predefined counters
 
-# Dynamic counters storage (user-created counters only)
-COUNTERS = {}
-NEXT_COUNTER_ID = 1
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .file_lock import InterProcessLock
+
+
+class CounterRegistry:
+    """Counters and their category assignments, shared by every worker.
+
+    The registry is a JSON file, rewritten atomically under an inter-process
+    lock; each write bumps its ``version``. Every process caches the parsed
+    file together with a PIN index and a category -> counters index, and
+    revalidates the cache with a single ``os.stat`` per read: a write by any
+    worker replaces the file, changing its inode. The cache keeps the file
+    it was read from open, so that inode can't be reused by a later write.
+    Writes by this process update the cache directly.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._process_lock = InterProcessLock(f"{path}.lock")
+        self._reload_lock = threading.Lock()
+        self._cache = None  # (stamp, open file, state)
+
+    @staticmethod
+    def _stamp(st):
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    @staticmethod
+    def _build(data):
+        """Parsed registry file -> state with indexes"""
+        counters = {int(cid): counter for cid, counter in data.get('counters', {}).items()}
+        categories = {int(cid): cats for cid, cats in data.get('categories', {}).items()}
+        category_counters = {}
+        for counter_id, cats in categories.items():
+            for category in cats:
+                ids = category_counters.setdefault(category, [])
+                if counter_id not in ids:
+                    ids.append(counter_id)
+        return {
+            'version': data.get('version', 0),
+            'next_id': data.get('next_id', 1),
+            'counters': counters,
+            'categories': categories,
+            'pins': {counter['pin']: counter_id for counter_id, counter in counters.items()},
+            'category_counters': category_counters,
+        }
+
+    def _load(self):
+        """Read the file into the cache unless the cache already matches it"""
+        with self._reload_lock:
+            try:
+                f = open(self.path, 'rb')
+            except FileNotFoundError:
+                if self._cache is not None and self._cache[0] is None:
+                    return self._cache[2]
+                cache = (None, None, self._build({}))
+            else:
+                stamp = self._stamp(os.fstat(f.fileno()))
+                if self._cache is not None and self._cache[0] == stamp:
+                    f.close()
+                    return self._cache[2]
+                try:
+                    data = json.loads(f.read() or b'{}')
+                except ValueError as e:
+                    print(f"Error reading counters: {e}")
+                    data = {}
+                cache = (stamp, f, self._build(data))
+            old, self._cache = self._cache, cache
+            if old is not None and old[1] is not None:
+                old[1].close()
+            return cache[2]
+
+    def state(self):
+        """Current registry state; treat it as read-only"""
+        cache = self._cache
+        if cache is not None:
+            try:
+                stamp = self._stamp(os.stat(self.path))
+            except FileNotFoundError:
+                stamp = None
+            if stamp == cache[0]:
+                return cache[2]
+        return self._load()
+
+    @contextmanager
+    def writing(self):
+        """Context for a change: yields a copy of the state to edit, then saves it if it changed"""
+        with self._process_lock:
+            current = self._load()
+            data = {
+                'version': current['version'] + 1,
+                'next_id': current['next_id'],
+                'counters': {cid: dict(counter) for cid, counter in current['counters'].items()},
+                'categories': {cid: list(cats) for cid, cats in current['categories'].items()},
+            }
+            yield data
+            if all(data[key] == current[key] for key in ('next_id', 'counters', 'categories')):
+                # Nothing changed (or the change was refused)
+                return
+            tmp_file = f"{self.path}.tmp"
+            with open(tmp_file, 'w') as f:
+                json.dump(data, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.path)
+            self._load()
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> CounterRegistry:
+    """Return the process-wide counter registry from settings.KDS_COUNTERS"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                config = getattr(settings, 'KDS_COUNTERS', {})
+                _registry = CounterRegistry(config.get('FILE', 'counters.json'))
+    return _registry
 
-# Category-Counter mapping for automatic item assignment
-CATEGORY_ASSIGNMENTS = {}  # {counter_id: [category1, category2, ...]}
 
 def get_counter_name(counter_id):
     """Get counter name by ID"""
-    return COUNTERS.get(counter_id, {}).get("name", "Unknown Counter")
+    return get_registry().state()['counters'].get(counter_id, {}).get("name", "Unknown Counter")
 
 def get_counter_pin(counter_id):
     """Get counter PIN by ID"""
-    return COUNTERS.get(counter_id, {}).get("pin", "")
+    return get_registry().state()['counters'].get(counter_id, {}).get("pin", "")
 
 def get_all_counters():
     """Get all available counters"""
+    state = get_registry().state()
     return [
         {
             "id": counter_id,
             "name": data["name"],
             "pin": data["pin"],
             "description": data["description"],
-            "categories": CATEGORY_ASSIGNMENTS.get(counter_id, [])
+            "categories": state['categories'].get(counter_id, [])
         }
-        for counter_id, data in COUNTERS.items()
+        for counter_id, data in state['counters'].items()
     ]
 
 def validate_counter_credentials(counter_id, pin):
     """Validate counter credentials"""
-    return counter_id in COUNTERS and str(pin) == COUNTERS[counter_id]["pin"]
+    counter = get_registry().state()['counters'].get(counter_id)
+    return counter is not None and str(pin) == counter["pin"]
 
 def create_counter(name, pin, description=""):
     """Create a new counter"""
-    global NEXT_COUNTER_ID
-    
-    # Check if PIN already exists
-    for existing_counter in COUNTERS.values():
-        if existing_counter["pin"] == str(pin):
+    registry = get_registry()
+    # Cheap rejection without taking the lock
+    if str(pin) in registry.state()['pins']:
+        return None, "PIN already exists"
+
+    with registry.writing() as data:
+        # Check again: another worker may have taken the PIN meanwhile
+        if str(pin) in registry.state()['pins']:
             return None, "PIN already exists"
-    
-    # Create new counter
-    counter_id = NEXT_COUNTER_ID
-    COUNTERS[counter_id] = {
-        "name": name,
-        "pin": str(pin),
-        "description": description
-    }
-    NEXT_COUNTER_ID += 1
-    
+
+        # Create new counter
+        counter_id = data['next_id']
+        data['counters'][counter_id] = {
+            "name": name,
+            "pin": str(pin),
+            "description": description
+        }
+        data['next_id'] += 1
+
     return counter_id, "Counter created successfully"
 
 def update_counter(counter_id, name=None, pin=None, description=None):
     """Update an existing counter"""
-    if counter_id not in COUNTERS:
-        return False, "Counter not found"
-    
-    # Check if new PIN conflicts with existing counters
-    if pin:
-        for cid, counter in COUNTERS.items():
-            if cid != counter_id and counter["pin"] == str(pin):
-                return False, "PIN already exists"
-    
-    # Update fields
-    if name is not None:
-        COUNTERS[counter_id]["name"] = name
-    if pin is not None:
-        COUNTERS[counter_id]["pin"] = str(pin)
-    if description is not None:
-        COUNTERS[counter_id]["description"] = description
-    
+    registry = get_registry()
+    with registry.writing() as data:
+        if counter_id not in data['counters']:
+            return False, "Counter not found"
+
+        # Check if new PIN conflicts with existing counters
+        if pin and registry.state()['pins'].get(str(pin), counter_id) != counter_id:
+            return False, "PIN already exists"
+
+        # Update fields
+        counter = data['counters'][counter_id]
+        if name is not None:
+            counter["name"] = name
+        if pin is not None:
+            counter["pin"] = str(pin)
+        if description is not None:
+            counter["description"] = description
+
     return True, "Counter updated successfully"
 
 def delete_counter(counter_id):
-    """Delete a counter"""
-    if counter_id not in COUNTERS:
-        return False, "Counter not found"
-    
-    del COUNTERS[counter_id]
+    """Delete a counter and its category assignments"""
+    with get_registry().writing() as data:
+        if counter_id not in data['counters']:
+            return False, "Counter not found"
+
+        del data['counters'][counter_id]
+        data['categories'].pop(counter_id, None)
     return True, "Counter deleted successfully"
 
 def reset_to_defaults():
     """Reset counters to empty state"""
-    global COUNTERS, NEXT_COUNTER_ID, CATEGORY_ASSIGNMENTS
-    COUNTERS = {}
-    CATEGORY_ASSIGNMENTS = {}
-    NEXT_COUNTER_ID = 1
+    with get_registry().writing() as data:
+        data['counters'] = {}
+        data['categories'] = {}
+        data['next_id'] = 1
     return True, "All counters deleted"
 
 # Category management functions
 def assign_categories_to_counter(counter_id, categories):
     """Assign categories to a counter"""
-    if counter_id not in COUNTERS:
-        return False, "Counter not found"
-    
-    CATEGORY_ASSIGNMENTS[counter_id] = categories
+    with get_registry().writing() as data:
+        if counter_id not in data['counters']:
+            return False, "Counter not found"
+
+        data['categories'][counter_id] = list(categories)
     return True, "Categories assigned successfully"
 
 def get_categories_for_counter(counter_id):
     """Get categories assigned to a counter"""
-    return CATEGORY_ASSIGNMENTS.get(counter_id, [])
+    return get_registry().state()['categories'].get(counter_id, [])
+
+def get_counters_for_category(category):
+    """Get IDs of all counters handling a category"""
+    return get_registry().state()['category_counters'].get(category, [])
 
 def get_counter_for_category(category):
     """Get counter ID for a specific category"""
-    for counter_id, categories in CATEGORY_ASSIGNMENTS.items():
-        if category in categories:
-            return counter_id
-    return None
+    counters = get_counters_for_category(category)
+    return counters[0] if counters else None
 
 def get_all_categories():
     """Get all unique categories across all counters"""
-    all_categories = set()
-    for categories in CATEGORY_ASSIGNMENTS.values():
-        all_categories.update(categories)
-    return sorted(list(all_categories))
-
-def auto_assign_counter_for_item(category):
-    """Automatically assign counter for an item based on its category"""
-    return get_counter_for_category(category)
+    return sorted(get_registry().state()['category_counters'])
+
+def auto_assign_counter_for_item(category, open_items=None):
+    """Automatically assign counter for an item based on its category
+
+    When several counters handle the category, the one with the fewest
+    open items in ``open_items`` ({counter_id: count}) wins; ties go to the
+    counter the category was assigned to first. The winner's count is
+    bumped so the next item of a batch sees it.
+    """
+    counters = get_counters_for_category(category)
+    if not counters:
+        return None
+    if len(counters) == 1 or open_items is None:
+        return counters[0]
+    counter_id = min(counters, key=lambda cid: open_items.get(cid, 0))
+    open_items[counter_id] = open_items.get(counter_id, 0) + 1
+    return counter_id
@@ -1,170 +1,144 @@
-import json
-import os
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .metrics import metrics
+from .storage import get_backend
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def storage_executor() -> ThreadPoolExecutor:
+    """Bounded thread pool for storage calls made from async code"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'KDS_STORAGE', {}).get('ASYNC_THREADS', 4),
+                    thread_name_prefix='order-storage'
+                )
+    return _executor
+
+
+async def call_storage(func, *args):
+    """Run a blocking ``OrderDataStorage`` call without stalling the event loop"""
+    started = time.monotonic()
+    try:
+        return await sync_to_async(func, thread_sensitive=False, executor=storage_executor())(*args)
+    finally:
+        # Includes time spent waiting for a free thread
+        metrics.observe('storage_call_seconds', time.monotonic() - started, call=func.__name__)
+
 
 class OrderDataStorage:
-    """Simple file-based storage for orders"""
-    
-    DATA_FILE = 'orders_data.json'
-    
-    @classmethod
-    def _load_data(cls) -> Dict:
-        """Load data from file"""
-        if os.path.exists(cls.DATA_FILE):
-            try:
-                with open(cls.DATA_FILE, 'r') as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, IOError):
-                return {'orders': {}, 'next_id': 1}
-        return {'orders': {}, 'next_id': 1}
-    
-    @classmethod
-    def _save_data(cls, data: Dict):
-        """Save data to file"""
-        try:
-            with open(cls.DATA_FILE, 'w') as f:
-                json.dump(data, f, indent=2)
-        except IOError as e:
-            print(f"Error saving data: {e}")
-    
+    """Order storage used by the views and WebSocket consumers.
+
+    Every call is delegated to the backend configured in
+    ``settings.KDS_STORAGE`` (see ``kds_app.storage``).
+    """
+
     @classmethod
     def create_order(cls, order_data: Dict) -> str:
         """Create a new order and return its ID"""
-        data = cls._load_data()
-        order_id = str(data['next_id'])
-        
-        # Calculate total amount from items and add IDs to items
-        items = order_data.get('items', [])
-        total_amount = 0
-        
-        for i, item in enumerate(items):
-            # Add ID to each item if not present
-            if 'id' not in item:
-                item['id'] = f"{order_id}_{i}"
-            # Add status if not present
-            if 'status' not in item:
-                item['status'] = 'pending'
-            # Calculate total amount
-            price = item.get('price', 0) or 0
-            quantity = item.get('quantity', 1) or 1
-            total_amount += price * quantity
-        
-        order = {
-            'id': order_id,
-            'order_number': f"ORD-{order_id.zfill(4)}",
-            'items': items,
-            'status': 'pending',
-            'created_at': datetime.now().isoformat(),
-            'updated_at': datetime.now().isoformat(),
-            'customer_name': order_data.get('customer_name', ''),
-            'table_number': order_data.get('table_number', ''),
-            'notes': order_data.get('notes', ''),
-            'total_amount': total_amount,
-            'estimated_time': order_data.get('estimated_time', 15)
-        }
-        
-        data['orders'][order_id] = order
-        data['next_id'] += 1
-        cls._save_data(data)
-        
-        return order_id
-    
+        return get_backend().create_order(order_data)
+
+    @classmethod
+    def create_orders(cls, orders_data: List[Dict]) -> List[Dict]:
+        """Create several orders in one storage transaction and return them"""
+        return get_backend().create_orders(orders_data)
+
     @classmethod
     def get_order(cls, order_id: str) -> Optional[Dict]:
         """Get order by ID"""
-        data = cls._load_data()
-        return data['orders'].get(order_id)
-    
+        return get_backend().get_order(order_id)
+
     @classmethod
     def get_all_orders(cls) -> List[Dict]:
         """Get all orders"""
-        data = cls._load_data()
-        return list(data['orders'].values())
-    
+        return get_backend().get_all_orders()
+
     @classmethod
     def get_orders_by_status(cls, status: str) -> List[Dict]:
         """Get orders by status"""
-        data = cls._load_data()
-        return [order for order in data['orders'].values() if order['status'] == status]
-    
+        return get_backend().get_orders_by_status(status)
+
+    @classmethod
+    def get_orders_for_counter(cls, counter_id) -> List[Dict]:
+        """Get orders with items assigned to a counter, keeping only those items"""
+        return get_backend().get_orders_for_counter(counter_id)
+
+    @classmethod
+    def get_changes(cls, since: int, counter_id=None) -> Dict:
+        """Get orders changed and deleted after store version ``since``"""
+        return get_backend().get_changes(since, counter_id)
+
     @classmethod
     def update_order_status(cls, order_id: str, status: str) -> bool:
         """Update order status"""
-        data = cls._load_data()
-        
-        if order_id in data['orders']:
-            data['orders'][order_id]['status'] = status
-            data['orders'][order_id]['updated_at'] = datetime.now().isoformat()
-            cls._save_data(data)
-            return True
-        
-        return False
-    
+        return get_backend().update_order_status(order_id, status)
+
     @classmethod
     def update_order(cls, order_id: str, updates: Dict) -> bool:
         """Update order with new data"""
-        data = cls._load_data()
-        
-        if order_id in data['orders']:
-            data['orders'][order_id].update(updates)
-            data['orders'][order_id]['updated_at'] = datetime.now().isoformat()
-            cls._save_data(data)
-            return True
-        
-        return False
-    
+        return get_backend().update_order(order_id, updates)
+
+    @classmethod
+    def patch_item_statuses(cls, changes: List[Dict]) -> Optional[List[Dict]]:
+        """Apply many item status changes in one commit and return the changed orders"""
+        return get_backend().patch_item_statuses(changes)
+
     @classmethod
     def delete_order(cls, order_id: str) -> bool:
         """Delete order"""
-        data = cls._load_data()
-        
-        if order_id in data['orders']:
-            del data['orders'][order_id]
-            cls._save_data(data)
-            return True
-        
-        return False
-    
+        return get_backend().delete_order(order_id)
+
+    @classmethod
+    def delete_orders_if_unchanged(cls, versions: Dict[str, int], before_delete=None) -> List[Dict]:
+        """Delete the orders not changed since the given versions and return them"""
+        return get_backend().delete_orders_if_unchanged(versions, before_delete)
+
     @classmethod
     def clear_all_orders(cls):
         """Clear all orders"""
-        data = {'orders': {}, 'next_id': 1}
-        cls._save_data(data)
-    
+        get_backend().clear_all_orders()
+
     @classmethod
     def update_item_status(cls, order_id: str, item_index: int, status: str) -> bool:
         """Update status of a specific item in an order"""
-        data = cls._load_data()
-        
-        if order_id in data['orders']:
-            order = data['orders'][order_id]
-            if item_index < len(order['items']):
-                order['items'][item_index]['status'] = status
-                order['updated_at'] = datetime.now().isoformat()
-                
-                # Check if all items are ready
-                all_items_ready = all(
-                    item.get('status') == 'ready' 
-                    for item in order['items']
-                )
-                
-                if all_items_ready:
-                    order['status'] = 'ready_to_serve'
-                elif any(item.get('status') == 'in_progress' for item in order['items']):
-                    order['status'] = 'in_progress'
-                else:
-                    order['status'] = 'pending'
-                
-                cls._save_data(data)
-                return True
-        
-        return False
-    
+        return get_backend().update_item_status(order_id, item_index, status)
+
+    @classmethod
+    def patch_item_status(cls, order_id: str, item_index: int, status: str) -> Optional[Dict]:
+        """Update status of a specific item and return the change as an order patch"""
+        return get_backend().patch_item_status(order_id, item_index, status)
+
+    @classmethod
+    def get_open_item_counts(cls) -> Dict:
+        """Items each counter still has to prepare"""
+        return get_backend().get_open_item_counts()
+
     @classmethod
     def get_ready_to_serve_orders(cls) -> List[Dict]:
         """Get orders that are ready to serve (all items ready)"""
-        data = cls._load_data()
-        return [order for order in data['orders'].values() if order['status'] == 'ready_to_serve']
+        return get_backend().get_ready_to_serve_orders()
 
+    @classmethod
+    def get_file_sizes(cls) -> Dict[str, int]:
+        """Bytes on disk of each file the backend keeps"""
+        return get_backend().get_file_sizes()
+
+    @classmethod
+    def flush(cls):
+        """Write any buffered changes to durable storage"""
+        get_backend().flush()
+
+    @classmethod
+    def compact(cls):
+        """Compact the backend's on-disk logs. Run while the server is stopped."""
+        get_backend().compact()
@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from kds_app.order_archive import archive_finished_orders, archive_settings
+
+
+class Command(BaseCommand):
+    help = 'Move finished (served or ready to serve) orders into the daily order archive.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-minutes', type=int, default=None,
+            help='Only archive orders not updated for this long '
+                 '(default: KDS_ARCHIVE AFTER_MINUTES)'
+        )
+
+    def handle(self, *args, **options):
+        minutes = options['older_than_minutes']
+        if minutes is None:
+            minutes = archive_settings()['AFTER_MINUTES']
+        archived = archive_finished_orders(timedelta(minutes=minutes))
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {archived} orders to {archive_settings()['DIR']}"
+        ))
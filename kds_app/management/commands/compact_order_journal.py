@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from kds_app.data_storage import OrderDataStorage
+
+
+class Command(BaseCommand):
+    help = ('Fold the order journal (or SQLite WAL) into the main data file. '
+            'Run while the server is stopped.')
+
+    def handle(self, *args, **options):
+        OrderDataStorage.compact()
+        self.stdout.write(self.style.SUCCESS(
+            f"Compacted order storage ({len(OrderDataStorage.get_all_orders())} orders)"
+        ))
@@ -0,0 +1,171 @@
+import asyncio
+import bisect
+import math
+import threading
+import weakref
+from typing import Dict, List, Tuple
+
+# How often the event loop lag probe runs, in seconds
+LOOP_LAG_INTERVAL = 0.5
+
+# Upper bounds of the histogram buckets every summary is counted into, in seconds
+HISTOGRAM_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+# Prepended to metric names in the Prometheus exposition
+PROMETHEUS_PREFIX = 'kds_'
+
+
+class Metrics:
+    """Process-wide counters, gauges and summaries for the KDS.
+
+    Every metric has a name and optional labels (e.g. ``counter=3``).
+    Summaries keep count, sum, last and max of the observed values, and
+    count them into ``HISTOGRAM_BUCKETS`` for the Prometheus histograms.
+    Recording is a dict update under a lock, cheap enough to leave on.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple, float] = {}
+        self._gauges: Dict[Tuple, float] = {}
+        self._summaries: Dict[Tuple, Dict[str, float]] = {}
+        # Observations per bucket, not cumulative; the last one is +Inf
+        self._buckets: Dict[Tuple, List[int]] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict) -> Tuple:
+        return (name,) + tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Add to a counter"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """Set a gauge to its current value"""
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def add_gauge(self, name: str, delta: float, **labels):
+        """Move a gauge up or down"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + delta
+
+    def clear_gauge(self, name: str):
+        """Forget every labelled value of a gauge, before setting the current ones"""
+        with self._lock:
+            for key in [key for key in self._gauges if key[0] == name]:
+                del self._gauges[key]
+
+    def observe(self, name: str, value: float, **labels):
+        """Record one value of a summary"""
+        key = self._key(name, labels)
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = self._summaries[key] = {'count': 0, 'sum': 0.0, 'last': 0.0, 'max': 0.0}
+                self._buckets[key] = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+            self._buckets[key][bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+            summary['count'] += 1
+            summary['sum'] += value
+            summary['last'] = value
+            summary['max'] = max(summary['max'], value)
+
+    def snapshot(self) -> Dict:
+        """All metrics as JSON-friendly dicts: {'name': value} or {'name{label=value}': value}"""
+        def label(key):
+            name, labels = key[0], key[1:]
+            if not labels:
+                return name
+            return name + '{' + ','.join(f'{k}={v}' for k, v in labels) + '}'
+
+        with self._lock:
+            return {
+                'counters': {label(key): value for key, value in self._counters.items()},
+                'gauges': {label(key): value for key, value in self._gauges.items()},
+                'summaries': {label(key): dict(summary) for key, summary in self._summaries.items()},
+            }
+
+    def prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format; summaries become histograms"""
+        with self._lock:
+            counters = sorted(self._counters.items(), key=_sort_key)
+            gauges = sorted(self._gauges.items(), key=_sort_key)
+            histograms = sorted(
+                ((key, dict(summary), list(self._buckets[key])) for key, summary in self._summaries.items()),
+                key=_sort_key
+            )
+
+        lines = []
+        typed = set()
+
+        def sample(name, metric_type, labels, value, suffix=''):
+            name = PROMETHEUS_PREFIX + name
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {metric_type}')
+            lines.append(f'{name}{suffix}{_prometheus_labels(labels)} {_prometheus_value(value)}')
+
+        for key, value in counters:
+            sample(key[0], 'counter', key[1:], value)
+        for key, value in gauges:
+            sample(key[0], 'gauge', key[1:], value)
+        for key, summary, buckets in histograms:
+            cumulative = 0
+            for bound, count in zip(HISTOGRAM_BUCKETS + (math.inf,), buckets):
+                cumulative += count
+                sample(key[0], 'histogram', key[1:] + (('le', bound),), cumulative, '_bucket')
+            sample(key[0], 'histogram', key[1:], summary['sum'], '_sum')
+            sample(key[0], 'histogram', key[1:], summary['count'], '_count')
+        return '\n'.join(lines) + '\n'
+
+
+def _sort_key(item) -> Tuple:
+    # Label values mix types (counter ids are ints or strings); compare them as text
+    return tuple(str(part) for part in item[0])
+
+
+def _prometheus_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _prometheus_labels(labels) -> str:
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        text = _prometheus_value(value) if isinstance(value, (int, float)) else str(value)
+        text = text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{text}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+metrics = Metrics()
+
+_monitored_loops = weakref.WeakSet()
+
+
+async def _probe_loop_lag():
+    """Measure how late the event loop wakes us up after a sleep"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+        metrics.observe('event_loop_lag_seconds', lag)
+
+
+def monitor_event_loop(loop):
+    """Start the lag probe on ``loop`` once; call from a coroutine running on it"""
+    if loop in _monitored_loops:
+        return
+    _monitored_loops.add(loop)
+    loop.create_task(_probe_loop_lag())
@@ -0,0 +1,310 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .metrics import metrics
+from .storage.base import counter_tickets, order_counter_ids
+
+
+def counter_group_name(counter_id) -> str:
+    """Channel layer group of the kitchen displays for a counter"""
+    return f'kitchen_display_counter_{counter_id}'
+
+
+def encode_frame(message) -> str:
+    """Encode a WebSocket message once, to be forwarded as-is by every consumer"""
+    return json.dumps(message, separators=(',', ':'))
+
+
+def group_message(message_type, order_id, frame) -> Dict:
+    """Channel layer message carrying a pre-encoded frame about one order.
+
+    Consumers forward ``frame`` without decoding or re-encoding it;
+    ``order_id`` lets them coalesce messages about the same order, and
+    ``id`` tells the replay buffer it has already numbered the message.
+    """
+    return {'type': message_type, 'id': uuid.uuid4().hex, 'order_id': order_id, 'frame': frame}
+
+
+def batch_message(messages: List[Dict]) -> Dict:
+    """Channel layer message carrying several ``group_message``s to one group.
+
+    Receivers handle each of ``messages`` as if it had been sent on its own.
+    """
+    return {'type': 'order_batch', 'messages': messages}
+
+
+def unbatch(message: Dict) -> List[Dict]:
+    """The single-order messages a channel layer message stands for"""
+    if message.get('type') == 'order_batch':
+        return message['messages']
+    return [message]
+
+
+class ReplayBuffer:
+    """Numbers the broadcasts each counter's group delivers here and keeps the latest ones.
+
+    Broadcasts are numbered by the process that delivers them, since with a
+    channel layer shared by several workers every worker receives them, and
+    a display only ever sees the numbers of the worker it is connected to.
+    Once a display of a counter connects, ``follow`` keeps this process in
+    the counter's group, so every later broadcast is numbered even while no
+    display is connected. Whoever handles a broadcast first (the follower
+    or a display) gives it the counter's next ``seq``; the others get the
+    same frame by message id.
+
+    The last ``size`` frames are kept so a display that reconnects with the
+    ``epoch`` and last ``seq`` it saw can be sent just what it missed. The
+    epoch changes whenever the process restarts, since sequence numbers
+    start over. The seqs of the last ``id_history`` message ids (4 x
+    ``size`` by default) are remembered apart from the frames, so a
+    handler running far behind still gets the seq its message was given
+    after the frame itself has been dropped.
+    """
+
+    def __init__(self, size: int, id_history: Optional[int] = None):
+        self.size = size
+        self.id_history = id_history or 4 * size
+        self.epoch = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._seqs: Dict[object, int] = {}
+        self._frames: Dict[object, deque] = {}
+        # Message id -> seq for the last id_history messages, oldest id first in the deque
+        self._numbered: Dict[object, Dict[str, int]] = {}
+        self._numbered_ids: Dict[object, deque] = {}
+        self._loop = None
+        self._followers: Dict[object, asyncio.Future] = {}
+
+    async def follow(self, counter_id):
+        """Number every broadcast to the counter from now on; call from the server loop"""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._followers = {}
+        joined = self._followers.get(counter_id)
+        if joined is None:
+            joined = self._followers[counter_id] = loop.create_future()
+            loop.create_task(self._follower(counter_id, joined))
+        await asyncio.shield(joined)
+
+    async def _follower(self, counter_id, joined):
+        channel_layer = get_channel_layer()
+        group = counter_group_name(counter_id)
+        try:
+            channel = await channel_layer.new_channel()
+            await channel_layer.group_add(group, channel)
+        except Exception as e:
+            self._followers.pop(counter_id, None)
+            joined.set_exception(e)
+            return
+        with self._lock:
+            # Broadcasts from before we joined were never numbered here
+            self._seqs[counter_id] = self._seqs.get(counter_id, 0) + 1
+            self._frames.pop(counter_id, None)
+            self._numbered.pop(counter_id, None)
+            self._numbered_ids.pop(counter_id, None)
+        joined.set_result(None)
+
+        # Renew the membership well before the layer's group expiry ends it,
+        # by the clock, since a busy counter may never go quiet long enough
+        loop = asyncio.get_running_loop()
+        renew_every = getattr(channel_layer, 'group_expiry', 86400) / 2
+        renewed = loop.time()
+        try:
+            while True:
+                wait = renewed + renew_every - loop.time()
+                if wait <= 0:
+                    await channel_layer.group_add(group, channel)
+                    renewed = loop.time()
+                    continue
+                try:
+                    message = await asyncio.wait_for(channel_layer.receive(channel), wait)
+                except asyncio.TimeoutError:
+                    continue
+                for message in unbatch(message):
+                    if 'id' in message and 'frame' in message:
+                        self.record(counter_id, message)
+        except Exception as e:
+            print(f"Error following counter {counter_id} broadcasts: {e}")
+            # The next display to connect starts a new follower, after a gap
+            if self._followers.get(counter_id) is joined:
+                del self._followers[counter_id]
+
+    def record(self, counter_id, message: Dict) -> Tuple[int, str]:
+        """Number a group message once, keep its frame, and return (seq, numbered frame)"""
+        with self._lock:
+            numbered = self._numbered.setdefault(counter_id, {})
+            seq = numbered.get(message['id'])
+            if seq is not None:
+                # Same message, so the same frame, whether or not it is still kept
+                return seq, f'{{"seq":{seq},' + message['frame'][1:]
+            seq = self._seqs.get(counter_id, 0) + 1
+            self._seqs[counter_id] = seq
+            # Frames are JSON objects, so the seq can be spliced in without re-encoding
+            frame = f'{{"seq":{seq},' + message['frame'][1:]
+            frames = self._frames.get(counter_id)
+            if frames is None:
+                frames = self._frames[counter_id] = deque(maxlen=self.size)
+            frames.append((seq, frame))
+            ids = self._numbered_ids.get(counter_id)
+            if ids is None:
+                ids = self._numbered_ids[counter_id] = deque()
+            if len(ids) == self.id_history:
+                del numbered[ids.popleft()]
+            ids.append(message['id'])
+            numbered[message['id']] = seq
+        return seq, frame
+
+    def last_seq(self, counter_id) -> int:
+        with self._lock:
+            return self._seqs.get(counter_id, 0)
+
+    def frames_after(self, counter_id, seq: int) -> Optional[Tuple[int, List[str]]]:
+        """Return (last seq, frames after ``seq``), or None if they are no longer all kept"""
+        with self._lock:
+            last_seq = self._seqs.get(counter_id, 0)
+            frames = self._frames.get(counter_id, ())
+            oldest = frames[0][0] if frames else last_seq + 1
+            if seq > last_seq or seq < oldest - 1:
+                return None
+            return last_seq, [frame for frame_seq, frame in frames if frame_seq > seq]
+
+
+replay_buffer = ReplayBuffer(getattr(settings, 'KDS_WEBSOCKET', {}).get('REPLAY_BUFFER_SIZE', 256))
+
+
+async def dispatch(frames):
+    """Send messages to kitchen displays, all groups at once.
+
+    ``frames`` maps counter id -> ``group_message``. Await this directly
+    from async code.
+    """
+    channel_layer = get_channel_layer()
+    await asyncio.gather(*(
+        _group_send(channel_layer, counter_id, message)
+        for counter_id, message in frames.items()
+    ))
+
+
+async def _group_send(channel_layer, counter_id, message):
+    started = time.perf_counter()
+    await channel_layer.group_send(counter_group_name(counter_id), message)
+    metrics.observe('group_send_seconds', time.perf_counter() - started, counter=counter_id)
+    metrics.inc('group_messages_total', len(unbatch(message)), counter=counter_id)
+
+
+class NotificationDispatcher:
+    """Hands notifications from sync code to the server's event loop.
+
+    Consumers bind the loop they run on. From then on ``submit`` only puts
+    the frames on a queue, and returns without waiting. One worker task on
+    the loop sends them in submission order. Until a loop is bound
+    (management commands, tests, WSGI), ``submit`` sends synchronously in a
+    single ``async_to_sync`` hop.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._queue = None
+
+    def bind_loop(self, loop):
+        """Use ``loop`` for sending; must be called from a coroutine on that loop"""
+        if loop is self._loop:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        loop.create_task(self._worker(self._queue))
+
+    async def _worker(self, queue):
+        while True:
+            frames, submitted = await queue.get()
+            try:
+                await dispatch(frames)
+            except Exception as e:
+                print(f"Error notifying WebSocket clients: {e}")
+            else:
+                # Time from the change to every group having it, queueing included
+                metrics.observe('fanout_seconds', time.perf_counter() - submitted)
+
+    def submit(self, frames):
+        loop, queue = self._loop, self._queue
+        if loop is not None and loop.is_running():
+            loop.call_soon_threadsafe(queue.put_nowait, (frames, time.perf_counter()))
+        else:
+            started = time.perf_counter()
+            async_to_sync(dispatch)(frames)
+            metrics.observe('fanout_seconds', time.perf_counter() - started)
+
+
+dispatcher = NotificationDispatcher()
+
+
+def notify_counters(frames):
+    """Send pre-encoded frames to kitchen displays without blocking on the sends"""
+    if frames:
+        dispatcher.submit(frames)
+
+
+def order_frames(message_type, order):
+    """Messages carrying each counter's projection of ``order``: only its items"""
+    frames = {}
+    for counter_id, ticket in counter_tickets(order).items():
+        frames[counter_id] = group_message(message_type, order['id'], encode_frame({
+            'type': message_type,
+            'order': ticket
+        }))
+    return frames
+
+
+def notify_new_order(order):
+    """Notify WebSocket clients about new order"""
+    notify_counters(order_frames('new_order', order))
+
+
+def batch_order_frames(message_type, orders):
+    """One ``batch_message`` per counter with its projection of each of ``orders``"""
+    messages = {}
+    for order in orders:
+        for counter_id, message in order_frames(message_type, order).items():
+            messages.setdefault(counter_id, []).append(message)
+    return {counter_id: batch_message(batch) for counter_id, batch in messages.items()}
+
+
+def notify_new_orders(orders):
+    """Notify WebSocket clients about several new orders, one message per counter"""
+    notify_counters(batch_order_frames('new_order', orders))
+
+
+def notify_order_updates(orders):
+    """Notify WebSocket clients about several updated orders, one message per counter"""
+    notify_counters(batch_order_frames('order_update', orders))
+
+
+def notify_order_update(order):
+    """Notify WebSocket clients about order update"""
+    notify_counters(order_frames('order_update', order))
+
+
+def notify_order_deleted(order):
+    """Notify WebSocket clients that an order has left the store"""
+    message = group_message('order_deleted', order['id'], encode_frame({
+        'type': 'order_deleted',
+        'order_id': order['id']
+    }))
+    notify_counters({counter_id: message for counter_id in order_counter_ids(order)})
+
+
+def notify_order_patch(patch):
+    """Notify WebSocket clients about an item status change with just the changed fields"""
+    message = {key: value for key, value in patch.items() if key != 'counters'}
+    message['type'] = 'order_patch'
+    message = group_message('order_patch', patch['order_id'], encode_frame(message))
+    notify_counters({counter_id: message for counter_id in patch['counters']})
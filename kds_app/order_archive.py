@@ -0,0 +1,206 @@
+import json
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+from django.conf import settings
+
+from .data_storage import OrderDataStorage
+from .file_lock import InterProcessLock
+from .notifications import notify_order_deleted
+
+# Orders in these states are finished and may leave the hot store
+FINISHED_STATUSES = ('served', 'ready_to_serve')
+
+# Longest date range a single archive query may cover
+MAX_RANGE_DAYS = 31
+
+
+class OrderArchive:
+    """Date-partitioned cold storage for finished orders.
+
+    Each day gets an append-only ``orders-YYYY-MM-DD.jsonl`` file holding the
+    orders created that day, and ``index.jsonl`` maps order ids to the day
+    they were filed under, so a lookup by id reads a single day file.
+    Appends hold an inter-process lock, so several workers can archive into
+    the same directory.
+
+    Order ids start again at 1 after ``clear_all_orders``; lookups by id
+    return the most recently archived order with that id.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._process_lock = None
+        self._index: Dict[str, str] = {}
+        self._index_offset = 0
+
+    def _day_file(self, day: date) -> str:
+        return os.path.join(self.directory, f"orders-{day.isoformat()}.jsonl")
+
+    def _index_file(self) -> str:
+        return os.path.join(self.directory, 'index.jsonl')
+
+    def _locked(self) -> InterProcessLock:
+        if self._process_lock is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._process_lock = InterProcessLock(os.path.join(self.directory, '.lock'))
+        return self._process_lock
+
+    @staticmethod
+    def _read_lines(path: str, offset: int = 0):
+        """Yield (record, end offset) for each complete JSON line after ``offset``"""
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # an append still in progress
+                offset += len(line)
+                try:
+                    yield json.loads(line), offset
+                except json.JSONDecodeError:
+                    continue
+
+    @staticmethod
+    def _append_lines(path: str, records: List[Dict]):
+        with open(path, 'a') as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def order_day(order: Dict) -> date:
+        """Day an order is filed under: the day it was created"""
+        return datetime.fromisoformat(order['created_at']).date()
+
+    def add_orders(self, orders: List[Dict]):
+        """Append orders to their day files, then record them in the index"""
+        by_day: Dict[date, List[Dict]] = {}
+        for order in orders:
+            by_day.setdefault(self.order_day(order), []).append(order)
+
+        with self._locked():
+            for day, day_orders in by_day.items():
+                self._append_lines(self._day_file(day), day_orders)
+            self._append_lines(self._index_file(), [
+                {'id': order['id'], 'day': self.order_day(order).isoformat()}
+                for order in orders
+            ])
+
+    def _day_for_order(self, order_id: str) -> Optional[str]:
+        with self._lock:
+            # Pick up entries added since we last looked, by any worker
+            for entry, offset in self._read_lines(self._index_file(), self._index_offset):
+                self._index[entry['id']] = entry['day']
+                self._index_offset = offset
+            return self._index.get(order_id)
+
+    def get_order(self, order_id: str) -> Optional[Dict]:
+        """Get an archived order by ID"""
+        day = self._day_for_order(str(order_id))
+        if day is None:
+            return None
+        found = None
+        for order, _ in self._read_lines(self._day_file(date.fromisoformat(day))):
+            if order['id'] == str(order_id):
+                found = order
+        return found
+
+    def get_orders(self, date_from: date, date_to: date) -> List[Dict]:
+        """Get archived orders created between two dates, inclusive"""
+        orders = []
+        day = date_from
+        while day <= date_to:
+            # An order archived twice (after a crash mid-archival) is listed once
+            day_orders = {}
+            for order, _ in self._read_lines(self._day_file(day)):
+                day_orders[(order['id'], order['created_at'])] = order
+            orders.extend(day_orders.values())
+            day += timedelta(days=1)
+        return orders
+
+
+_archive: Optional[OrderArchive] = None
+_archive_lock = threading.Lock()
+_last_run: Optional[float] = None
+_running = threading.Lock()
+
+
+def archive_settings() -> Dict:
+    config = {'DIR': 'order_archive', 'AFTER_MINUTES': 120, 'INTERVAL_SECONDS': 300}
+    config.update(getattr(settings, 'KDS_ARCHIVE', {}))
+    return config
+
+
+def get_archive() -> OrderArchive:
+    """Return the process-wide order archive from settings.KDS_ARCHIVE"""
+    global _archive
+    if _archive is None:
+        with _archive_lock:
+            if _archive is None:
+                _archive = OrderArchive(archive_settings()['DIR'])
+    return _archive
+
+
+def archive_finished_orders(older_than: Optional[timedelta] = None) -> int:
+    """Move finished orders not updated for ``older_than`` into the archive.
+
+    An order is only moved if it is still at the version we read, so a late
+    change is never overwritten by a stale copy. The archive is written
+    while the store holds its write lock, just before the orders are
+    deleted, so a crash in between leaves a duplicate rather than a lost
+    order. Returns the number of orders archived.
+    """
+    if older_than is None:
+        older_than = timedelta(minutes=archive_settings()['AFTER_MINUTES'])
+    cutoff = (datetime.now() - older_than).isoformat()
+
+    candidates = [
+        order
+        for status in FINISHED_STATUSES
+        for order in OrderDataStorage.get_orders_by_status(status)
+        if order['updated_at'] < cutoff
+    ]
+    if not candidates:
+        return 0
+
+    archived = OrderDataStorage.delete_orders_if_unchanged(
+        {order['id']: order.get('version') for order in candidates},
+        before_delete=get_archive().add_orders
+    )
+    for order in archived:
+        try:
+            notify_order_deleted(order)
+        except Exception as e:
+            print(f"Error notifying WebSocket clients: {e}")
+    return len(archived)
+
+
+def maybe_archive_finished_orders():
+    """Archive finished orders in the background if INTERVAL_SECONDS have passed.
+
+    Called on the order write path, so archival needs no separate scheduler.
+    Setting INTERVAL_SECONDS to 0 turns this off.
+    """
+    global _last_run
+    interval = archive_settings()['INTERVAL_SECONDS']
+    if not interval or (_last_run is not None and time.monotonic() - _last_run < interval):
+        return
+    if not _running.acquire(blocking=False):
+        return
+    _last_run = time.monotonic()
+
+    def run():
+        try:
+            archive_finished_orders()
+        except Exception as e:
+            print(f"Error archiving orders: {e}")
+        finally:
+            _running.release()
+
+    threading.Thread(target=run, name='order-archiver', daemon=True).start()
@@ -0,0 +1,32 @@
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .base import OrderStorageBackend
+
+DEFAULT_BACKEND = 'kds_app.storage.json_file.JSONFileBackend'
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> OrderStorageBackend:
+    """Return the process-wide order storage backend from settings.KDS_STORAGE"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                config = getattr(settings, 'KDS_STORAGE', {})
+                backend_class = import_string(config.get('BACKEND', DEFAULT_BACKEND))
+                _backend = backend_class(config.get('OPTIONS', {}))
+    return _backend
+
+
+def set_backend(backend: OrderStorageBackend):
+    """Swap the active backend, closing the previous one"""
+    global _backend
+    with _backend_lock:
+        if _backend is not None:
+            _backend.close()
+        _backend = backend
@@ -0,0 +1,338 @@
+import os
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+# Deleted orders remembered for delta sync; clients further behind get a full resync
+TOMBSTONE_LIMIT = 10000
+
+# When a backend's writes reach the disk: never forced, within a short
+# batching delay, or before the write returns
+DURABILITY_LEVELS = ('none', 'batch', 'sync')
+
+
+def build_order(order_id: str, order_data: Dict) -> Dict:
+    """Build a new order record from the data posted by the POS"""
+    # Calculate total amount from items and add IDs to items
+    items = [dict(item) for item in order_data.get('items', [])]
+    total_amount = 0
+
+    for i, item in enumerate(items):
+        # Add ID to each item if not present
+        if 'id' not in item:
+            item['id'] = f"{order_id}_{i}"
+        # Add status if not present
+        if 'status' not in item:
+            item['status'] = 'pending'
+        # Calculate total amount
+        price = item.get('price', 0) or 0
+        quantity = item.get('quantity', 1) or 1
+        total_amount += price * quantity
+
+    return {
+        'id': order_id,
+        'order_number': f"ORD-{order_id.zfill(4)}",
+        'items': items,
+        'status': 'pending',
+        'created_at': datetime.now().isoformat(),
+        'updated_at': datetime.now().isoformat(),
+        'customer_name': order_data.get('customer_name', ''),
+        'table_number': order_data.get('table_number', ''),
+        'notes': order_data.get('notes', ''),
+        'total_amount': total_amount,
+        'estimated_time': order_data.get('estimated_time', 15)
+    }
+
+
+def derive_order_status(items: List[Dict]) -> str:
+    """Work out the order status from the status of its items"""
+    # Check if all items are ready
+    all_items_ready = all(
+        item.get('status') == 'ready'
+        for item in items
+    )
+
+    if all_items_ready:
+        return 'ready_to_serve'
+    elif any(item.get('status') == 'in_progress' for item in items):
+        return 'in_progress'
+    return 'pending'
+
+
+def order_counter_ids(order: Dict) -> List:
+    """Unique counters the order's items are assigned to"""
+    return list(dict.fromkeys(
+        item['assigned_counter'] for item in order.get('items', [])
+        if item.get('assigned_counter') is not None
+    ))
+
+
+def filter_order_for_counter(order: Dict, counter_id) -> Optional[Dict]:
+    """Copy of ``order`` keeping only the items assigned to ``counter_id``"""
+    relevant_items = [
+        item for item in order.get('items', [])
+        if item.get('assigned_counter') == counter_id
+    ]
+    if not relevant_items:
+        return None
+    filtered_order = order.copy()
+    filtered_order['items'] = relevant_items
+    return filtered_order
+
+
+def counter_tickets(order: Dict) -> Dict:
+    """Each counter's ticket for ``order``: a copy keeping only that counter's items"""
+    items_by_counter: Dict = {}
+    for item in order.get('items', []):
+        counter_id = item.get('assigned_counter')
+        if counter_id is not None:
+            items_by_counter.setdefault(counter_id, []).append(item)
+    tickets = {}
+    for counter_id, items in items_by_counter.items():
+        ticket = order.copy()
+        ticket['items'] = items
+        tickets[counter_id] = ticket
+    return tickets
+
+
+def open_item_counts(order: Dict) -> Dict:
+    """Items of ``order`` each counter still has to prepare"""
+    counts: Dict = {}
+    if order.get('status') == 'served':
+        return counts
+    for item in order.get('items', []):
+        counter_id = item.get('assigned_counter')
+        if counter_id is not None and item.get('status') != 'ready':
+            counts[counter_id] = counts.get(counter_id, 0) + 1
+    return counts
+
+
+def group_item_changes(changes: List[Dict]) -> Optional[Dict[str, Dict[int, str]]]:
+    """Group ``{'order_id', 'item_index', 'status'}`` changes by order.
+
+    Returns {order_id: {item_index: status}} in the order the orders first
+    appear (the last change to an item wins), or None if a change is malformed.
+    """
+    if not isinstance(changes, list):
+        return None
+    grouped: Dict[str, Dict[int, str]] = {}
+    for change in changes:
+        try:
+            order_id = str(change['order_id'])
+            item_index = int(change['item_index'])
+            status = change['status']
+        except (KeyError, TypeError, ValueError):
+            return None
+        if not status or not isinstance(status, str):
+            return None
+        grouped.setdefault(order_id, {})[item_index] = status
+    return grouped
+
+
+def item_status_patch(order: Dict, item_index: int, prev_version: int) -> Dict:
+    """Describe an item status change to ``order`` (as stored after the change).
+
+    ``prev_version`` is the order's version just before the change, so a
+    client can tell whether its copy is the one the patch applies to.
+    """
+    item_index %= len(order['items'])
+    item = order['items'][item_index]
+    return {
+        'order_id': order['id'],
+        'item_index': item_index,
+        'item_id': item.get('id'),
+        'item_status': item['status'],
+        'order_status': order['status'],
+        'updated_at': order['updated_at'],
+        'version': order['version'],
+        'prev_version': prev_version,
+        'counters': order_counter_ids(order)
+    }
+
+
+def file_sizes(paths: Dict[str, str]) -> Dict[str, int]:
+    """Size in bytes of each named file that exists"""
+    sizes = {}
+    for name, path in paths.items():
+        try:
+            sizes[name] = os.stat(path).st_size
+        except OSError:
+            pass
+    return sizes
+
+
+class OrderStorageBackend:
+    """Interface every order storage backend implements.
+
+    Backends are built once per process from ``settings.KDS_STORAGE`` and
+    receive its ``OPTIONS`` dict. Order ids are strings of increasing
+    integers. Returned orders must be treated as read-only.
+
+    Every mutation advances a store-wide version. Each order carries the
+    version of its last change in ``version``, and deleted orders leave a
+    tombstone (``{'id', 'version', 'counters'}``) so that clients can fetch
+    only what changed since the version they last saw.
+    """
+
+    def __init__(self, options: Dict):
+        self.options = options
+
+    def create_order(self, order_data: Dict) -> str:
+        """Create a new order and return its ID"""
+        raise NotImplementedError
+
+    def create_orders(self, orders_data: List[Dict]) -> List[Dict]:
+        """Create several orders at once and return them, in the same order.
+
+        Backends override this to store the whole batch in one transaction.
+        """
+        return [self.get_order(self.create_order(order_data)) for order_data in orders_data]
+
+    def get_order(self, order_id: str) -> Optional[Dict]:
+        """Get order by ID"""
+        raise NotImplementedError
+
+    def get_all_orders(self) -> List[Dict]:
+        """Get all orders, oldest first"""
+        raise NotImplementedError
+
+    def get_orders_by_status(self, status: str) -> List[Dict]:
+        """Get orders by status"""
+        return [order for order in self.get_all_orders() if order['status'] == status]
+
+    def get_orders_for_counter(self, counter_id) -> List[Dict]:
+        """Get orders with items assigned to a counter, keeping only those items"""
+        filtered_orders = []
+        for order in self.get_all_orders():
+            filtered_order = filter_order_for_counter(order, counter_id)
+            if filtered_order:
+                filtered_orders.append(filtered_order)
+        return filtered_orders
+
+    def get_open_item_counts(self) -> Dict:
+        """Items not yet ready, per counter, across orders that are not served"""
+        counts: Dict = {}
+        for order in self.get_all_orders():
+            for counter_id, count in open_item_counts(order).items():
+                counts[counter_id] = counts.get(counter_id, 0) + count
+        return counts
+
+    def get_ready_to_serve_orders(self) -> List[Dict]:
+        """Get orders that are ready to serve (all items ready)"""
+        return self.get_orders_by_status('ready_to_serve')
+
+    def get_changes(self, since: int, counter_id=None) -> Dict:
+        """Get orders changed and deleted after version ``since``.
+
+        Returns ``{'version', 'full', 'orders', 'deleted'}``. When the
+        changes since that version are no longer known, ``full`` is True and
+        ``orders`` holds every current order instead.
+        """
+        version, changed, tombstones = self._changes_since(since)
+        if changed is None:
+            if counter_id is None:
+                orders = self.get_all_orders()
+            else:
+                orders = self.get_orders_for_counter(counter_id)
+            return {'version': version, 'full': True, 'orders': orders, 'deleted': []}
+
+        if counter_id is None:
+            orders = changed
+        else:
+            orders = [
+                filtered_order for filtered_order in
+                (filter_order_for_counter(order, counter_id) for order in changed)
+                if filtered_order
+            ]
+        deleted = [
+            tombstone['id'] for tombstone in tombstones
+            if counter_id is None or counter_id in tombstone['counters']
+        ]
+        return {'version': version, 'full': False, 'orders': orders, 'deleted': deleted}
+
+    def _changes_since(self, since: int) -> Tuple[int, Optional[List[Dict]], Optional[List[Dict]]]:
+        """Return (current version, orders changed after ``since``, tombstones after ``since``).
+
+        The current version must be read before the changes. Both lists are
+        None if ``since`` is older than the changes the backend still knows.
+        """
+        raise NotImplementedError
+
+    def update_order_status(self, order_id: str, status: str) -> bool:
+        """Update order status"""
+        return self.update_order(order_id, {'status': status})
+
+    def update_order(self, order_id: str, updates: Dict) -> bool:
+        """Update order with new data"""
+        raise NotImplementedError
+
+    def update_item_status(self, order_id: str, item_index: int, status: str) -> bool:
+        """Update status of a specific item in an order"""
+        return self.patch_item_status(order_id, item_index, status) is not None
+
+    def patch_item_status(self, order_id: str, item_index: int, status: str) -> Optional[Dict]:
+        """Update status of a specific item and describe the change.
+
+        Returns None if the order or item doesn't exist, otherwise the patch
+        built by ``item_status_patch``.
+        """
+        raise NotImplementedError
+
+    def patch_item_statuses(self, changes: List[Dict]) -> Optional[List[Dict]]:
+        """Apply many item status changes at once and return the changed orders.
+
+        ``changes`` are ``{'order_id', 'item_index', 'status'}`` dicts. If any
+        is malformed or names a missing order or item, nothing is changed
+        and None is returned. Backends override this to apply them all in
+        one commit.
+        """
+        grouped = group_item_changes(changes)
+        if not grouped:
+            return None
+        for order_id, statuses in grouped.items():
+            order = self.get_order(order_id)
+            if order is None or not all(0 <= index < len(order['items']) for index in statuses):
+                return None
+        for order_id, statuses in grouped.items():
+            for item_index, status in statuses.items():
+                self.patch_item_status(order_id, item_index, status)
+        return [self.get_order(order_id) for order_id in grouped]
+
+    def delete_order(self, order_id: str) -> bool:
+        """Delete order"""
+        raise NotImplementedError
+
+    def delete_orders_if_unchanged(self, versions: Dict[str, int], before_delete=None) -> List[Dict]:
+        """Delete the orders still at the version given in ``versions`` and return them.
+
+        Orders changed or deleted since are left alone. ``before_delete`` is
+        called with the orders about to go while no other write can change
+        them; if it raises, nothing is deleted. Backends override this to
+        make the check and the delete atomic.
+        """
+        unchanged = [
+            order for order in (self.get_order(order_id) for order_id in versions)
+            if order is not None and order.get('version') == versions[order['id']]
+        ]
+        if unchanged:
+            if before_delete is not None:
+                before_delete(unchanged)
+            for order in unchanged:
+                self.delete_order(order['id'])
+        return unchanged
+
+    def clear_all_orders(self):
+        """Clear all orders"""
+        raise NotImplementedError
+
+    def get_file_sizes(self) -> Dict[str, int]:
+        """Bytes on disk of each file the backend keeps, e.g. ``{'data': 2048}``"""
+        return {}
+
+    def flush(self):
+        """Write any buffered changes to durable storage"""
+
+    def compact(self):
+        """Reclaim space from logs kept alongside the data. Run offline."""
+
+    def close(self):
+        """Release files and connections held by the backend"""
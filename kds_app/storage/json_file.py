@@ -0,0 +1,869 @@
+import atexit
+import json
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from ..file_lock import InterProcessLock
+from ..metrics import metrics
+from .base import (
+    DURABILITY_LEVELS, TOMBSTONE_LIMIT, OrderStorageBackend, build_order, counter_tickets,
+    derive_order_status, file_sizes, group_item_changes, item_status_patch, open_item_counts,
+    order_counter_ids
+)
+
+
+def _fsync_directory(path: str):
+    """Make a rename in the directory of ``path`` durable (a no-op where unsupported)"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# Stores not closed yet; whatever they still buffer is written out at exit
+_open_backends = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_open_backends():
+    for backend in list(_open_backends):
+        backend.flush()
+
+
+class JSONFileBackend(OrderStorageBackend):
+    """File-based storage for orders with a process-resident copy.
+
+    The data file is parsed once, on first access, and every read is served
+    from memory. Every write is expressed as a mutation record that is
+    applied to the resident copy and then persisted in one of two ways,
+    chosen by ``PERSISTENCE``:
+
+    * ``'snapshot'``: a background thread rewrites ``DATA_FILE`` with the
+      latest state, so a burst of item taps costs a single file rewrite.
+    * ``'journal'``: the record is appended to ``JOURNAL_FILE``. The full
+      state is only written to ``DATA_FILE`` every ``SNAPSHOT_EVERY``
+      records, and startup replays the journal on top of that snapshot.
+
+    Each of these is also the name of a key in ``OPTIONS``.
+
+    ``DURABILITY`` decides when a write is on disk. Snapshots are always
+    written to a temporary file and renamed over ``DATA_FILE``, so a crash
+    leaves either the old or the new snapshot, never a torn one.
+
+    * ``'none'``: nothing is fsynced; a crash of the process loses nothing,
+      but a power cut can lose recent writes.
+    * ``'batch'``: snapshots are fsynced before the rename, and the
+      background writer fsyncs the journal every ``FLUSH_INTERVAL``, so at
+      most that much can be lost.
+    * ``'sync'``: a write returns only once it is on disk. Writers waiting
+      at the same time share one fsync (group commit): whoever syncs
+      first covers everything appended so far.
+
+    With ``SHARED`` enabled (journal persistence only) several worker
+    processes can use the same files. Writes hold an inter-process lock,
+    first apply whatever other workers appended to the journal, then
+    allocate the next order id and append their own record. Reads apply new
+    journal records before answering, without taking the lock.
+
+    Secondary indexes (status -> order ids, and order ids ordered by
+    version) are kept up to date on every write, so status and
+    changed-since lookups cost O(results) rather than O(all orders). Each
+    counter also has a materialized view of its tickets (order id -> order
+    keeping only that counter's items, oldest first), updated by the same
+    writes, so a counter's board is served without scanning or copying
+    other orders. The journal ``seq`` doubles as the store version.
+
+    Stored orders are never mutated in place: every write swaps in a new
+    order dict. Callers can hold on to returned orders without copying them,
+    but must treat them as read-only.
+    """
+
+    DATA_FILE = 'orders_data.json'
+    JOURNAL_FILE = 'orders_journal.jsonl'
+    PERSISTENCE = 'snapshot'
+    SHARED = False
+    SNAPSHOT_EVERY = 1000  # journal records between snapshots
+    FLUSH_INTERVAL = 0.5  # seconds to gather writes before persisting
+    DURABILITY = 'batch'
+
+    def __init__(self, options: Dict):
+        super().__init__(options)
+        self.DATA_FILE = options.get('DATA_FILE', self.DATA_FILE)
+        self.JOURNAL_FILE = options.get('JOURNAL_FILE', self.JOURNAL_FILE)
+        self.PERSISTENCE = options.get('PERSISTENCE', self.PERSISTENCE)
+        self.SHARED = options.get('SHARED', self.SHARED)
+        self.SNAPSHOT_EVERY = options.get('SNAPSHOT_EVERY', self.SNAPSHOT_EVERY)
+        self.FLUSH_INTERVAL = options.get('FLUSH_INTERVAL', self.FLUSH_INTERVAL)
+        self.DURABILITY = options.get('DURABILITY', self.DURABILITY)
+
+        if self.PERSISTENCE not in ('snapshot', 'journal'):
+            raise ValueError(f"Unknown order persistence mode: {self.PERSISTENCE}")
+        if self.SHARED and self.PERSISTENCE != 'journal':
+            raise ValueError("Shared order storage requires journal persistence")
+        if self.DURABILITY not in DURABILITY_LEVELS:
+            raise ValueError(f"Unknown order durability level: {self.DURABILITY}")
+
+        self._data: Optional[Dict] = None
+        self._lock = threading.RLock()
+        self._flush_lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self._process_lock = InterProcessLock(f"{self.JOURNAL_FILE}.lock") if self.SHARED else None
+        # _dirty: a snapshot is due; _wake: the background writer has work;
+        # _stopping: close() wants the writer gone
+        self._dirty = threading.Event()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._closed = False
+        # Highest seq known to be on disk, as a snapshot or in the journal
+        self._saved_seq = 0
+        self._synced_seq = 0
+        self._writer: Optional[threading.Thread] = None
+        self._journal = None
+        self._journal_reader = None
+        self._journal_records = 0
+        # Dicts are used as insertion-ordered sets of order ids
+        self._status_index: Dict[str, Dict[str, None]] = {}
+        # Counter id -> order id -> ticket, in order id order
+        self._counter_views: Dict[object, Dict[str, Dict]] = {}
+        # Counter id -> items not yet ready, for load balancing
+        self._open_items: Dict[object, int] = {}
+        # Order id -> version, kept in version order
+        self._version_index: Dict[str, int] = {}
+
+        # Don't lose writes still waiting for the background writer on shutdown
+        _open_backends.add(self)
+
+    @contextmanager
+    def _locked(self):
+        """Hold the process lock, and in shared mode the inter-process lock"""
+        with self._lock:
+            if self._process_lock is None:
+                yield
+            else:
+                with self._process_lock:
+                    yield
+
+    def _load_data(self) -> Dict:
+        """Load the snapshot from file and replay any journal on top of it"""
+        data = {'orders': {}, 'next_id': 1, 'seq': 0, 'tombstones': {}, 'tombstone_floor': 0}
+        started = time.perf_counter()
+        with self._locked():
+            if os.path.exists(self.DATA_FILE):
+                try:
+                    with open(self.DATA_FILE, 'r') as f:
+                        data.update(json.load(f))
+                except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                    # Snapshots are replaced atomically, so this is damage from
+                    # outside; keep the file for recovery rather than overwrite it
+                    corrupt_file = f"{self.DATA_FILE}.corrupt-{datetime.now():%Y%m%d%H%M%S}"
+                    os.replace(self.DATA_FILE, corrupt_file)
+                    print(f"Order data file is corrupt ({e}); moved it to {corrupt_file}")
+                except IOError as e:
+                    print(f"Error loading order data: {e}")
+
+            # A rotated journal is left behind if we stopped mid-snapshot
+            if os.path.exists(self._rotated_journal_file()):
+                with open(self._rotated_journal_file(), 'rb') as f:
+                    self._replay(data, self._read_records(f))
+
+            if self.SHARED:
+                # Followers need a journal to watch even before the first write
+                open(self.JOURNAL_FILE, 'a').close()
+
+            if os.path.exists(self.JOURNAL_FILE):
+                f = open(self.JOURNAL_FILE, 'rb')
+                records = self._read_records(f)
+                self._replay(data, records)
+                self._journal_records = len(records)
+                # Cut off a torn trailing write so new records start on a clean line
+                if f.tell() < os.fstat(f.fileno()).st_size:
+                    os.truncate(self.JOURNAL_FILE, f.tell())
+                if self.SHARED:
+                    # Keep following the journal for records from other workers
+                    self._journal_reader = f
+                else:
+                    f.close()
+        metrics.observe('storage_load_seconds', time.perf_counter() - started, backend='json')
+        return data
+
+    def _save_data(self, data: Dict) -> bool:
+        """Save data to file: write a temporary file, then rename it over the old one"""
+        tmp_file = f"{self.DATA_FILE}.tmp"
+        started = time.perf_counter()
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(data, f, indent=2)
+                if self.DURABILITY != 'none':
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_file, self.DATA_FILE)
+            if self.DURABILITY != 'none':
+                _fsync_directory(self.DATA_FILE)
+        except IOError as e:
+            print(f"Error saving data: {e}")
+            return False
+        metrics.observe('storage_save_seconds', time.perf_counter() - started, backend='json', kind='snapshot')
+        return True
+
+    def _rotated_journal_file(self) -> str:
+        return f"{self.JOURNAL_FILE}.1"
+
+    @staticmethod
+    def _read_records(f) -> List[Dict]:
+        """Read complete journal records from the current position of ``f``.
+
+        Stops before a trailing line that is torn or still being written, so
+        the next read picks it up from the start.
+        """
+        records = []
+        while True:
+            position = f.tell()
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                f.seek(position)
+                break
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                f.seek(position)
+                break
+        return records
+
+    def _replay(self, data: Dict, records: List[Dict], apply=None) -> bool:
+        """Apply journal records ``data`` doesn't hold yet; False on a gap"""
+        apply = apply or (lambda record: self._apply(data, record))
+        for record in records:
+            if record['op'] == 'start':
+                # Header of a journal started by a snapshot up to this seq
+                if record['seq'] > data['seq']:
+                    return False
+                continue
+            if record['seq'] <= data['seq']:
+                continue
+            if record['seq'] != data['seq'] + 1:
+                return False
+            apply(record)
+        return True
+
+    def _state(self) -> Dict:
+        """Return the resident data, loading it from disk on first use"""
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    if self._closed:
+                        raise RuntimeError("Order storage is closed")
+                    data = self._load_data()
+                    self._rebuild_indexes(data)
+                    self._data = data
+        return self._data
+
+    def _current_state(self) -> Dict:
+        """Return the resident data including other workers' latest writes"""
+        data = self._state()
+        if self.SHARED:
+            with self._lock:
+                # Load again if a reload() got in between
+                self._state()
+                self._catch_up()
+                data = self._state()
+        return data
+
+    @contextmanager
+    def _writing(self, durable: bool = True):
+        """Context for a mutation: locked and caught up with other workers.
+
+        With ``DURABILITY = 'sync'`` it waits, once unlocked, until the
+        mutation is on disk (unless ``durable`` is False).
+        """
+        with self._locked():
+            if self._closed:
+                raise RuntimeError("Order storage is closed")
+            # Loaded under the lock so a concurrent reload() can't pull it away
+            self._state()
+            if self.SHARED:
+                self._catch_up()
+            yield self._state()
+            seq = self._data['seq']
+        if durable and self.DURABILITY == 'sync':
+            self._wait_durable(seq)
+
+    def _wait_durable(self, seq: int):
+        """Block until every change up to ``seq`` is on disk"""
+        if self.PERSISTENCE == 'journal':
+            self._sync_journal(seq)
+            return
+        with self._flush_lock:
+            if self._saved_seq < seq:
+                # Whoever gets here first saves the others' changes too
+                self.flush()
+
+    def _sync_journal(self, seq: Optional[int] = None):
+        """Fsync the journal up to ``seq`` (everything appended so far if None)"""
+        with self._sync_lock:
+            if seq is not None and self._synced_seq >= seq:
+                return
+            with self._lock:
+                if self._data is None:
+                    return
+                target = self._data['seq']
+                if self._synced_seq >= target:
+                    return
+                # A duplicate descriptor stays valid if the journal is rotated meanwhile
+                fd = os.dup(self._journal.fileno()) if self._journal is not None else None
+            if fd is not None:
+                try:
+                    os.fsync(fd)
+                except OSError as e:
+                    print(f"Error syncing order journal: {e}")
+                    return
+                finally:
+                    os.close(fd)
+            self._synced_seq = max(self._synced_seq, target)
+
+    def _catch_up(self):
+        """Apply records other workers appended to the journal.
+
+        Must be called with ``_lock`` held.
+        """
+        while True:
+            if self._journal_reader is None:
+                if not os.path.exists(self.JOURNAL_FILE):
+                    return
+                self._journal_reader = open(self.JOURNAL_FILE, 'rb')
+                self._journal_records = 0
+
+            reader = self._journal_reader
+            records = self._read_records(reader)
+            try:
+                rotated = os.stat(self.JOURNAL_FILE).st_ino != os.fstat(reader.fileno()).st_ino
+            except FileNotFoundError:
+                rotated = True
+            if rotated:
+                # A snapshot moved the journal aside. Nothing more can be
+                # appended to the old file, so drain it and follow the new one.
+                records += self._read_records(reader)
+                reader.close()
+                self._journal_reader = None
+
+            self._journal_records += len(records)
+            if not self._replay(self._data, records, self._apply_indexed):
+                # We missed records that are now only in the snapshot
+                self._reset()
+                self._state()
+                return
+            if not rotated:
+                return
+
+    def _rebuild_indexes(self, data: Dict):
+        self._status_index = {}
+        self._counter_views = {}
+        self._open_items = {}
+        self._version_index = {}
+        for order in sorted(data['orders'].values(), key=lambda order: order.get('version', 0)):
+            self._index_order(order)
+        for order_id in sorted(data['orders'], key=int):
+            self._update_counter_views(order_id, None, data['orders'][order_id])
+
+    def _index_order(self, order: Dict):
+        self._status_index.setdefault(order['status'], {})[order['id']] = None
+        self._version_index[order['id']] = order.get('version', 0)
+
+    def _unindex_order(self, order: Dict):
+        self._status_index.get(order['status'], {}).pop(order['id'], None)
+        self._version_index.pop(order['id'], None)
+
+    def _update_counter_views(self, order_id: str, old: Optional[Dict], new: Optional[Dict]):
+        """Replace the tickets of an order in the views of the counters it involves"""
+        if old is not None:
+            for counter_id, count in open_item_counts(old).items():
+                self._open_items[counter_id] -= count
+        if new is not None:
+            for counter_id, count in open_item_counts(new).items():
+                self._open_items[counter_id] = self._open_items.get(counter_id, 0) + count
+        tickets = counter_tickets(new) if new is not None else {}
+        if old is not None:
+            for counter_id in order_counter_ids(old):
+                if counter_id not in tickets:
+                    self._counter_views.get(counter_id, {}).pop(order_id, None)
+        for counter_id, ticket in tickets.items():
+            view = self._counter_views.setdefault(counter_id, {})
+            # Replacing a ticket keeps its place. New orders have the highest
+            # id, so they go at the end, unless an edit moved items of an
+            # older order to this counter.
+            misplaced = order_id not in view and view and int(next(reversed(view))) > int(order_id)
+            view[order_id] = ticket
+            if misplaced:
+                self._counter_views[counter_id] = dict(sorted(view.items(), key=lambda entry: int(entry[0])))
+
+    @staticmethod
+    def _apply(data: Dict, record: Dict):
+        """Apply a single mutation record to ``data``"""
+        op = record['op']
+        orders = data['orders']
+        seq = record['seq']
+
+        if op == 'create':
+            orders[record['order']['id']] = dict(record['order'], version=seq)
+            data['next_id'] = record['next_id']
+        elif op == 'update':
+            order = dict(orders[record['order_id']], **record['updates'])
+            order['version'] = seq
+            orders[record['order_id']] = order
+        elif op == 'item_status':
+            order = dict(orders[record['order_id']])
+            items = list(order['items'])
+            items[record['item_index']] = dict(items[record['item_index']], status=record['status'])
+            order['items'] = items
+            order['status'] = record['order_status']
+            order['updated_at'] = record['updated_at']
+            order['version'] = seq
+            orders[record['order_id']] = order
+        elif op == 'item_statuses':
+            order = dict(orders[record['order_id']])
+            items = list(order['items'])
+            for item_index, status in record['statuses']:
+                items[item_index] = dict(items[item_index], status=status)
+            order['items'] = items
+            order['status'] = record['order_status']
+            order['updated_at'] = record['updated_at']
+            order['version'] = seq
+            orders[record['order_id']] = order
+        elif op == 'delete':
+            order = orders.pop(record['order_id'], None)
+            if order is not None:
+                tombstones = data['tombstones']
+                tombstones[order['id']] = {'version': seq, 'counters': order_counter_ids(order)}
+                if len(tombstones) > TOMBSTONE_LIMIT:
+                    oldest = next(iter(tombstones))
+                    data['tombstone_floor'] = tombstones.pop(oldest)['version']
+        elif op == 'clear':
+            data['orders'] = {}
+            data['next_id'] = 1
+            data['tombstones'] = {}
+            data['tombstone_floor'] = seq
+
+        data['seq'] = seq
+
+    def _apply_indexed(self, record: Dict):
+        """Apply a record to the resident data, keeping the indexes in step"""
+        data = self._data
+        order_id = record['order']['id'] if record['op'] == 'create' else record.get('order_id')
+        old = data['orders'].get(order_id)
+        if old is not None:
+            self._unindex_order(old)
+        self._apply(data, record)
+        if record['op'] == 'clear':
+            self._rebuild_indexes(data)
+            return
+        new = data['orders'].get(order_id)
+        if new is not None:
+            self._index_order(new)
+        self._update_counter_views(order_id, old, new)
+
+    def _commit(self, *records: Dict):
+        """Persist mutations together and apply them to the resident data.
+
+        Must be called inside ``_writing()``. In journal mode the records
+        are appended first: if that fails, the error is raised and the
+        resident data is left as it was.
+        """
+        seq = self._data['seq']
+        for record in records:
+            seq += 1
+            record['seq'] = seq
+
+        if self.PERSISTENCE == 'journal':
+            self._append_journal(records)
+        for record in records:
+            self._apply_indexed(record)
+
+        if self.PERSISTENCE != 'journal' or self._journal_records >= self.SNAPSHOT_EVERY:
+            self._schedule_save()
+
+    def _append_journal(self, records):
+        """Append records to the journal in one write; cost is independent of history"""
+        if self._journal is not None and self.SHARED:
+            # Another worker may have rotated the journal since our last write
+            try:
+                rotated = os.stat(self.JOURNAL_FILE).st_ino != os.fstat(self._journal.fileno()).st_ino
+            except FileNotFoundError:
+                rotated = True
+            if rotated:
+                self._journal.close()
+                self._journal = None
+        if self._journal is None:
+            self._journal = open(self.JOURNAL_FILE, 'a')
+        if self.SHARED:
+            # A worker that died mid-append left a torn line; ours must not follow it
+            self._cut_torn_tail()
+        offset = os.fstat(self._journal.fileno()).st_size
+        started = time.perf_counter()
+        try:
+            self._journal.write(''.join(json.dumps(record) + '\n' for record in records))
+            self._journal.flush()
+        except OSError as e:
+            print(f"Error appending to order journal: {e}")
+            # Drop whatever part made it out, so the next record starts on a clean line
+            try:
+                self._journal.close()
+            except OSError:
+                pass
+            self._journal = None
+            os.truncate(self.JOURNAL_FILE, offset)
+            raise
+        metrics.observe('storage_save_seconds', time.perf_counter() - started, backend='json', kind='journal')
+        if self.DURABILITY == 'batch':
+            self._start_writer()
+        if not self.SHARED:
+            # In shared mode our own records are counted as they are read back
+            self._journal_records += len(records)
+
+    def _cut_torn_tail(self):
+        """Truncate the journal after its last complete line.
+
+        Must be called with the inter-process lock held.
+        """
+        with open(self.JOURNAL_FILE, 'rb') as f:
+            end = position = f.seek(0, os.SEEK_END)
+            while position > 0:
+                step = min(position, 4096)
+                f.seek(position - step)
+                chunk = f.read(step)
+                if position == end and chunk.endswith(b'\n'):
+                    return
+                newline = chunk.rfind(b'\n')
+                if newline >= 0:
+                    position -= step - newline - 1
+                    break
+                position -= step
+        os.truncate(self.JOURNAL_FILE, position)
+
+    def _rotate_journal(self):
+        """Move the live journal aside so new records start a fresh file"""
+        if self._journal is not None:
+            if self.DURABILITY != 'none':
+                # Its records count as synced until the snapshot holds them
+                os.fsync(self._journal.fileno())
+                self._synced_seq = max(self._synced_seq, self._data['seq'])
+            self._journal.close()
+            self._journal = None
+        if os.path.exists(self.JOURNAL_FILE):
+            rotated = self._rotated_journal_file()
+            if os.path.exists(rotated):
+                # An earlier snapshot never finished; keep its records too
+                with open(self.JOURNAL_FILE, 'r') as src, open(rotated, 'a') as dst:
+                    dst.write(src.read())
+                os.remove(self.JOURNAL_FILE)
+            else:
+                os.replace(self.JOURNAL_FILE, rotated)
+        # Start the new journal right away with a header naming the snapshot
+        # it follows. Other workers tell it apart from the journal they are
+        # reading by inode, and use the header to notice when a snapshot
+        # swallowed records they never saw.
+        with open(self.JOURNAL_FILE, 'a') as f:
+            f.write(json.dumps({'op': 'start', 'seq': self._data['seq']}) + '\n')
+        self._journal_records = 0
+
+    def _schedule_save(self):
+        """Mark the store dirty and make sure the writer thread is running"""
+        self._dirty.set()
+        self._start_writer()
+
+    def _start_writer(self):
+        """Wake the background writer, starting it if needed"""
+        self._wake.set()
+        if self._writer is None or not self._writer.is_alive():
+            with self._lock:
+                if self._closed:
+                    return
+                if self._writer is None or not self._writer.is_alive():
+                    self._writer = threading.Thread(
+                        target=self._writer_loop,
+                        name='order-storage-writer',
+                        daemon=True
+                    )
+                    self._writer.start()
+
+    def _writer_loop(self):
+        """Persist the resident data whenever it has been changed"""
+        while not self._stopping.is_set():
+            self._wake.wait()
+            # Let writes arriving close together share one save;
+            # close() does the last save itself
+            if self._stopping.wait(self.FLUSH_INTERVAL):
+                return
+            self._wake.clear()
+            self.flush()
+            if self.PERSISTENCE == 'journal' and self.DURABILITY == 'batch':
+                self._sync_journal()
+
+    def flush(self):
+        """Write a snapshot of pending changes to disk now"""
+        if self._data is None:
+            return
+        with self._flush_lock:
+            # Not _writing(): close() still flushes after refusing new writes
+            with self._locked():
+                if self._data is None or not self._dirty.is_set():
+                    return
+                if self.SHARED:
+                    self._catch_up()
+                data = self._state()
+                self._dirty.clear()
+                # Orders are copy-on-write, so a shallow copy is a stable snapshot
+                snapshot = {
+                    'orders': dict(data['orders']),
+                    'next_id': data['next_id'],
+                    'seq': data['seq'],
+                    'tombstones': dict(data['tombstones']),
+                    'tombstone_floor': data['tombstone_floor']
+                }
+                if self.PERSISTENCE == 'journal':
+                    self._rotate_journal()
+                if self.SHARED:
+                    # Other workers must not rotate or load until the snapshot is down
+                    self._write_snapshot(snapshot)
+                    return
+            self._write_snapshot(snapshot)
+
+    def _write_snapshot(self, snapshot: Dict):
+        if not self._save_data(snapshot):
+            # Try again later; the rotated journal still holds these changes
+            self._schedule_save()
+            return
+        self._saved_seq = max(self._saved_seq, snapshot['seq'])
+
+        # Everything in the rotated journal is now part of the snapshot
+        if os.path.exists(self._rotated_journal_file()):
+            os.remove(self._rotated_journal_file())
+
+    def get_file_sizes(self) -> Dict[str, int]:
+        paths = {'data': self.DATA_FILE}
+        if self.PERSISTENCE == 'journal':
+            paths['journal'] = self.JOURNAL_FILE
+        return file_sizes(paths)
+
+    def compact(self):
+        """Fold the journal into a fresh snapshot.
+
+        Meant to run offline, while no server process is writing orders.
+        """
+        self.reload()
+        if self.PERSISTENCE != 'journal':
+            # Snapshots already hold everything; reload() wrote out what was pending
+            return
+        with self._writing():
+            # flush() moves the journal aside before writing the snapshot
+            self._dirty.set()
+        self.flush()
+
+    def reload(self):
+        """Drop the resident copy so the next access re-reads the data file"""
+        if self.PERSISTENCE == 'snapshot':
+            self.flush()
+        with self._lock:
+            self._reset()
+
+    def close(self):
+        """Stop the background writer, write out what is pending and drop the data.
+
+        Writes are refused from here on.
+        """
+        with self._lock:
+            self._closed = True
+        _open_backends.discard(self)
+        self._stopping.set()
+        self._wake.set()
+        writer = self._writer
+        if writer is not None and writer is not threading.current_thread():
+            writer.join()
+        self.flush()
+        if self.PERSISTENCE == 'journal' and self.DURABILITY != 'none':
+            self._sync_journal()
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        for handle in (self._journal, self._journal_reader):
+            if handle is not None:
+                handle.close()
+        self._journal = None
+        self._journal_reader = None
+        self._data = None
+        self._status_index = {}
+        self._counter_views = {}
+        self._open_items = {}
+        self._version_index = {}
+
+    def create_order(self, order_data: Dict) -> str:
+        """Create a new order and return its ID"""
+        with self._writing() as data:
+            order_id = str(data['next_id'])
+
+            order = build_order(order_id, order_data)
+            self._commit({'op': 'create', 'order': order, 'next_id': data['next_id'] + 1})
+
+        return order_id
+
+    def create_orders(self, orders_data: List[Dict]) -> List[Dict]:
+        """Create several orders in one write and return them"""
+        with self._writing() as data:
+            next_id = data['next_id']
+            records = []
+            for order_data in orders_data:
+                order = build_order(str(next_id), order_data)
+                next_id += 1
+                records.append({'op': 'create', 'order': order, 'next_id': next_id})
+            self._commit(*records)
+            orders = data['orders']
+            return [orders[record['order']['id']] for record in records]
+
+    def get_order(self, order_id: str) -> Optional[Dict]:
+        """Get order by ID"""
+        return self._current_state()['orders'].get(order_id)
+
+    def get_all_orders(self) -> List[Dict]:
+        """Get all orders"""
+        with self._lock:
+            return list(self._current_state()['orders'].values())
+
+    def get_orders_by_status(self, status: str) -> List[Dict]:
+        """Get orders by status"""
+        with self._lock:
+            orders = self._current_state()['orders']
+            order_ids = sorted(self._status_index.get(status, {}), key=int)
+            return [orders[order_id] for order_id in order_ids]
+
+    def get_orders_for_counter(self, counter_id) -> List[Dict]:
+        """Get orders with items assigned to a counter, keeping only those items"""
+        with self._lock:
+            self._current_state()
+            return list(self._counter_views.get(counter_id, {}).values())
+
+    def get_open_item_counts(self) -> Dict:
+        """Items not yet ready, per counter, across orders that are not served"""
+        with self._lock:
+            self._current_state()
+            return {counter_id: count for counter_id, count in self._open_items.items() if count}
+
+    def _changes_since(self, since: int):
+        with self._lock:
+            data = self._current_state()
+            if since < data['tombstone_floor'] or since > data['seq']:
+                return data['seq'], None, None
+
+            changed = []
+            for order_id in reversed(self._version_index):
+                if self._version_index[order_id] <= since:
+                    break
+                changed.append(data['orders'][order_id])
+            tombstones = []
+            for order_id in reversed(data['tombstones']):
+                tombstone = data['tombstones'][order_id]
+                if tombstone['version'] <= since:
+                    break
+                tombstones.append(dict(tombstone, id=order_id))
+            return data['seq'], changed[::-1], tombstones[::-1]
+
+    def update_order(self, order_id: str, updates: Dict) -> bool:
+        """Update order with new data"""
+        with self._writing() as data:
+            if order_id not in data['orders']:
+                return False
+
+            updates = dict(updates, updated_at=datetime.now().isoformat())
+            self._commit({'op': 'update', 'order_id': order_id, 'updates': updates})
+        return True
+
+    def delete_order(self, order_id: str) -> bool:
+        """Delete order"""
+        with self._writing() as data:
+            if order_id not in data['orders']:
+                return False
+
+            self._commit({'op': 'delete', 'order_id': order_id})
+        return True
+
+    def delete_orders_if_unchanged(self, versions: Dict[str, int], before_delete=None) -> List[Dict]:
+        """Delete the orders still at the version given in ``versions``, in one write"""
+        with self._writing() as data:
+            orders = data['orders']
+            unchanged = [
+                orders[order_id] for order_id, version in versions.items()
+                if order_id in orders and orders[order_id].get('version') == version
+            ]
+            if unchanged:
+                if before_delete is not None:
+                    before_delete(unchanged)
+                self._commit(*({'op': 'delete', 'order_id': order['id']} for order in unchanged))
+        return unchanged
+
+    def clear_all_orders(self):
+        """Clear all orders"""
+        with self._writing():
+            self._commit({'op': 'clear'})
+
+    def patch_item_status(self, order_id: str, item_index: int, status: str) -> Optional[Dict]:
+        """Update status of a specific item in an order and return the patch"""
+        with self._writing() as data:
+            orders = data['orders']
+
+            if order_id not in orders or item_index >= len(orders[order_id]['items']):
+                return None
+
+            prev_version = orders[order_id].get('version', 0)
+
+            items = list(orders[order_id]['items'])
+            items[item_index] = dict(items[item_index], status=status)
+
+            order_status = derive_order_status(items)
+
+            self._commit({
+                'op': 'item_status',
+                'order_id': order_id,
+                'item_index': item_index,
+                'status': status,
+                'order_status': order_status,
+                'updated_at': datetime.now().isoformat()
+            })
+            return item_status_patch(data['orders'][order_id], item_index, prev_version)
+
+    def patch_item_statuses(self, changes: List[Dict]) -> Optional[List[Dict]]:
+        """Apply many item status changes in one commit and return the changed orders"""
+        grouped = group_item_changes(changes)
+        if not grouped:
+            return None
+        with self._writing() as data:
+            orders = data['orders']
+            for order_id, statuses in grouped.items():
+                if order_id not in orders or not all(
+                    0 <= index < len(orders[order_id]['items']) for index in statuses
+                ):
+                    return None
+
+            updated_at = datetime.now().isoformat()
+            records = []
+            for order_id, statuses in grouped.items():
+                items = list(orders[order_id]['items'])
+                for item_index, status in statuses.items():
+                    items[item_index] = dict(items[item_index], status=status)
+                records.append({
+                    'op': 'item_statuses',
+                    'order_id': order_id,
+                    'statuses': list(statuses.items()),
+                    'order_status': derive_order_status(items),
+                    'updated_at': updated_at
+                })
+            self._commit(*records)
+            return [orders[order_id] for order_id in grouped]
@@ -0,0 +1,438 @@
+import json
+import sqlite3
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from ..metrics import metrics
+from .base import (
+    DURABILITY_LEVELS, TOMBSTONE_LIMIT, OrderStorageBackend, build_order, counter_tickets,
+    derive_order_status, file_sizes, group_item_changes, item_status_patch, order_counter_ids
+)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    body TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS orders_status ON orders (status, id);
+CREATE INDEX IF NOT EXISTS orders_created_at ON orders (created_at);
+
+CREATE TABLE IF NOT EXISTS order_items (
+    order_id INTEGER NOT NULL REFERENCES orders (id) ON DELETE CASCADE,
+    item_index INTEGER NOT NULL,
+    assigned_counter,
+    status TEXT,
+    PRIMARY KEY (order_id, item_index)
+);
+CREATE INDEX IF NOT EXISTS order_items_counter ON order_items (assigned_counter, order_id);
+
+CREATE TABLE IF NOT EXISTS counter_tickets (
+    assigned_counter,
+    order_id INTEGER NOT NULL REFERENCES orders (id) ON DELETE CASCADE,
+    body TEXT NOT NULL,
+    PRIMARY KEY (assigned_counter, order_id)
+);
+CREATE INDEX IF NOT EXISTS counter_tickets_order ON counter_tickets (order_id);
+
+CREATE TABLE IF NOT EXISTS order_tombstones (
+    order_id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL,
+    counters TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS order_tombstones_version ON order_tombstones (version);
+
+CREATE TABLE IF NOT EXISTS storage_meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO storage_meta (key, value) VALUES ('next_id', 1);
+INSERT OR IGNORE INTO storage_meta (key, value) VALUES ('version', 0);
+INSERT OR IGNORE INTO storage_meta (key, value) VALUES ('tombstone_floor', 0);
+"""
+
+
+class _ThreadConnection:
+    """A thread's connection, held in its thread-local storage.
+
+    The thread's locals are dropped when it exits, and with them this
+    holder, whose finalizer then closes the connection.
+    """
+
+    __slots__ = ('conn', '__weakref__')
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+
+def _release_connection(conn: sqlite3.Connection, connections: Set, lock: threading.Lock):
+    with lock:
+        connections.discard(conn)
+    conn.close()
+
+
+class SQLiteBackend(OrderStorageBackend):
+    """Order storage in a SQLite database running in WAL mode.
+
+    Orders are stored as JSON bodies next to indexed ``status`` and
+    ``created_at`` columns, and each item gets a row in ``order_items``
+    indexed by ``assigned_counter``. ``counter_tickets`` materializes each
+    counter's view of an order (the order keeping only that counter's
+    items) and is rewritten with the order, so a counter's board is read
+    without parsing or filtering other orders. Status and counter lookups
+    therefore cost O(results), and writes only touch the rows of the order
+    involved.
+    The store version lives in ``storage_meta`` and each order row records
+    the version of its last change in an indexed ``version`` column.
+
+    WAL mode lets readers keep going while a writer commits, and every
+    write runs in a ``BEGIN IMMEDIATE`` transaction, so order ids are
+    allocated safely even with several worker processes sharing the file.
+    Each thread gets its own connection, closed when the thread exits;
+    statements are prepared once per connection and reused from sqlite3's
+    statement cache.
+
+    ``DURABILITY`` sets how often SQLite syncs: ``'none'`` never,
+    ``'batch'`` at WAL checkpoints (a power cut can roll back the last
+    commits, a crash of the process can't), ``'sync'`` on every commit.
+
+    Options: ``DATABASE`` (path of the database file) and ``DURABILITY``.
+    """
+
+    DATABASE = 'orders.sqlite3'
+    DURABILITY = 'batch'
+    STATEMENT_CACHE_SIZE = 64
+    # PRAGMA synchronous for each durability level
+    SYNCHRONOUS = {'none': 'OFF', 'batch': 'NORMAL', 'sync': 'FULL'}
+
+    def __init__(self, options: Dict):
+        super().__init__(options)
+        self.DATABASE = options.get('DATABASE', self.DATABASE)
+        self.DURABILITY = options.get('DURABILITY', self.DURABILITY)
+        if self.DURABILITY not in DURABILITY_LEVELS:
+            raise ValueError(f"Unknown order durability level: {self.DURABILITY}")
+        self._local = threading.local()
+        # Connections of threads still alive, so close() can reach them all
+        self._connections: Set[sqlite3.Connection] = set()
+        self._connections_lock = threading.Lock()
+
+        conn = self._connection()
+        has_tickets = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'counter_tickets'"
+        ).fetchone()
+        conn.executescript(SCHEMA)
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(orders)')]
+        if 'version' not in columns:
+            # Databases created before orders were versioned
+            conn.execute('ALTER TABLE orders ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+        conn.execute('CREATE INDEX IF NOT EXISTS orders_version ON orders (version)')
+        if not has_tickets:
+            # Databases created before counter views were materialized
+            with self._transaction() as conn:
+                for body, in conn.execute('SELECT body FROM orders').fetchall():
+                    self._store_tickets(conn, json.loads(body))
+
+    def _connection(self) -> sqlite3.Connection:
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            conn = sqlite3.connect(
+                self.DATABASE,
+                timeout=30,
+                isolation_level=None,  # transactions are managed explicitly
+                check_same_thread=False,
+                cached_statements=self.STATEMENT_CACHE_SIZE
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'PRAGMA synchronous={self.SYNCHRONOUS[self.DURABILITY]}')
+            conn.execute('PRAGMA foreign_keys=ON')
+            holder = self._local.holder = _ThreadConnection(conn)
+            with self._connections_lock:
+                self._connections.add(conn)
+            # Close it when the thread exits, rather than keep it until close()
+            weakref.finalize(holder, _release_connection, conn, self._connections, self._connections_lock)
+        return holder.conn
+
+    @contextmanager
+    def _transaction(self):
+        """Run a write transaction, taking the database write lock up front"""
+        conn = self._connection()
+        started = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        # Includes waiting for the write lock, which other workers may hold
+        metrics.observe('storage_save_seconds', time.perf_counter() - started, backend='sqlite', kind='transaction')
+
+    @staticmethod
+    def _order_key(order_id) -> Optional[int]:
+        try:
+            return int(order_id)
+        except (TypeError, ValueError):
+            return None
+
+    def _load_order(self, conn: sqlite3.Connection, key: Optional[int]) -> Optional[Dict]:
+        if key is None:
+            return None
+        row = conn.execute('SELECT body FROM orders WHERE id = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @staticmethod
+    def _meta(conn: sqlite3.Connection, key: str) -> int:
+        return conn.execute('SELECT value FROM storage_meta WHERE key = ?', (key,)).fetchone()[0]
+
+    @classmethod
+    def _next_version(cls, conn: sqlite3.Connection) -> int:
+        """Advance the store version; call once per order changed or deleted.
+
+        A transaction that changes several orders gives each its own
+        version, just as the JSON backend gives each of its records a seq.
+        """
+        conn.execute("UPDATE storage_meta SET value = value + 1 WHERE key = 'version'")
+        return cls._meta(conn, 'version')
+
+    @staticmethod
+    def _store_tickets(conn: sqlite3.Connection, order: Dict):
+        conn.executemany(
+            'INSERT OR REPLACE INTO counter_tickets (assigned_counter, order_id, body) VALUES (?, ?, ?)',
+            [
+                (counter_id, int(order['id']), json.dumps(ticket))
+                for counter_id, ticket in counter_tickets(order).items()
+            ]
+        )
+
+    @classmethod
+    def _store_order(cls, conn: sqlite3.Connection, order: Dict, items_changed: bool = True):
+        key = int(order['id'])
+        order['version'] = cls._next_version(conn)
+        conn.execute(
+            'INSERT INTO orders (id, status, created_at, updated_at, body, version) VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET status = excluded.status, '
+            'updated_at = excluded.updated_at, body = excluded.body, version = excluded.version',
+            (key, order['status'], order['created_at'], order['updated_at'], json.dumps(order), order['version'])
+        )
+        if items_changed:
+            conn.execute('DELETE FROM counter_tickets WHERE order_id = ?', (key,))
+            conn.execute('DELETE FROM order_items WHERE order_id = ?', (key,))
+            conn.executemany(
+                'INSERT INTO order_items (order_id, item_index, assigned_counter, status) '
+                'VALUES (?, ?, ?, ?)',
+                [
+                    (key, index, item.get('assigned_counter'), item.get('status'))
+                    for index, item in enumerate(order.get('items', []))
+                ]
+            )
+        # Order-level fields are part of every ticket, so they are all rewritten
+        cls._store_tickets(conn, order)
+
+    def create_order(self, order_data: Dict) -> str:
+        """Create a new order and return its ID"""
+        with self._transaction() as conn:
+            next_id = self._meta(conn, 'next_id')
+            order_id = str(next_id)
+            self._store_order(conn, build_order(order_id, order_data))
+            conn.execute("UPDATE storage_meta SET value = ? WHERE key = 'next_id'", (next_id + 1,))
+        return order_id
+
+    def create_orders(self, orders_data: List[Dict]) -> List[Dict]:
+        """Create several orders in one transaction and return them"""
+        orders = []
+        with self._transaction() as conn:
+            next_id = self._meta(conn, 'next_id')
+            for order_data in orders_data:
+                order = build_order(str(next_id), order_data)
+                self._store_order(conn, order)
+                orders.append(order)
+                next_id += 1
+            conn.execute("UPDATE storage_meta SET value = ? WHERE key = 'next_id'", (next_id,))
+        return orders
+
+    def get_order(self, order_id: str) -> Optional[Dict]:
+        """Get order by ID"""
+        return self._load_order(self._connection(), self._order_key(order_id))
+
+    def get_all_orders(self) -> List[Dict]:
+        """Get all orders, oldest first"""
+        rows = self._connection().execute('SELECT body FROM orders ORDER BY id')
+        return [json.loads(body) for body, in rows]
+
+    def get_orders_by_status(self, status: str) -> List[Dict]:
+        """Get orders by status"""
+        rows = self._connection().execute('SELECT body FROM orders WHERE status = ? ORDER BY id', (status,))
+        return [json.loads(body) for body, in rows]
+
+    def get_orders_for_counter(self, counter_id) -> List[Dict]:
+        """Get orders with items assigned to a counter, keeping only those items"""
+        rows = self._connection().execute(
+            'SELECT body FROM counter_tickets WHERE assigned_counter = ? ORDER BY order_id',
+            (counter_id,)
+        )
+        return [json.loads(body) for body, in rows]
+
+    def get_open_item_counts(self) -> Dict:
+        """Items not yet ready, per counter, across orders that are not served"""
+        rows = self._connection().execute(
+            'SELECT i.assigned_counter, COUNT(*) FROM order_items i JOIN orders o ON o.id = i.order_id '
+            "WHERE i.assigned_counter IS NOT NULL AND i.status IS NOT 'ready' AND o.status != 'served' "
+            'GROUP BY i.assigned_counter'
+        )
+        return dict(rows.fetchall())
+
+    def _changes_since(self, since: int):
+        conn = self._connection()
+        # Read the version first: anything committed later is at worst sent twice
+        version = self._meta(conn, 'version')
+        if since < self._meta(conn, 'tombstone_floor') or since > version:
+            return version, None, None
+
+        rows = conn.execute('SELECT body FROM orders WHERE version > ? ORDER BY version', (since,))
+        changed = [json.loads(body) for body, in rows]
+        rows = conn.execute(
+            'SELECT order_id, version, counters FROM order_tombstones WHERE version > ? ORDER BY version',
+            (since,)
+        )
+        tombstones = [
+            {'id': str(order_id), 'version': tombstone_version, 'counters': json.loads(counters)}
+            for order_id, tombstone_version, counters in rows
+        ]
+        return version, changed, tombstones
+
+    def update_order(self, order_id: str, updates: Dict) -> bool:
+        """Update order with new data"""
+        with self._transaction() as conn:
+            order = self._load_order(conn, self._order_key(order_id))
+            if order is None:
+                return False
+
+            order.update(updates)
+            order['updated_at'] = datetime.now().isoformat()
+            self._store_order(conn, order, items_changed='items' in updates)
+        return True
+
+    def patch_item_status(self, order_id: str, item_index: int, status: str) -> Optional[Dict]:
+        """Update status of a specific item in an order and return the patch"""
+        with self._transaction() as conn:
+            order = self._load_order(conn, self._order_key(order_id))
+            if order is None or item_index >= len(order['items']):
+                return None
+
+            prev_version = order.get('version', 0)
+            order['items'][item_index]['status'] = status
+            order['status'] = derive_order_status(order['items'])
+            order['updated_at'] = datetime.now().isoformat()
+            self._store_order(conn, order, items_changed=False)
+            conn.execute(
+                'UPDATE order_items SET status = ? WHERE order_id = ? AND item_index = ?',
+                (status, int(order['id']), item_index % len(order['items']))
+            )
+        return item_status_patch(order, item_index, prev_version)
+
+    def patch_item_statuses(self, changes: List[Dict]) -> Optional[List[Dict]]:
+        """Apply many item status changes in one transaction and return the changed orders"""
+        grouped = group_item_changes(changes)
+        if not grouped:
+            return None
+        updated_at = datetime.now().isoformat()
+        orders = []
+        with self._transaction() as conn:
+            for order_id, statuses in grouped.items():
+                order = self._load_order(conn, self._order_key(order_id))
+                if order is None or not all(0 <= index < len(order['items']) for index in statuses):
+                    # Nothing has been written yet
+                    return None
+                for item_index, status in statuses.items():
+                    order['items'][item_index]['status'] = status
+                order['status'] = derive_order_status(order['items'])
+                order['updated_at'] = updated_at
+                orders.append((order, statuses))
+
+            for order, statuses in orders:
+                self._store_order(conn, order, items_changed=False)
+                conn.executemany(
+                    'UPDATE order_items SET status = ? WHERE order_id = ? AND item_index = ?',
+                    [(status, int(order['id']), item_index) for item_index, status in statuses.items()]
+                )
+        return [order for order, _ in orders]
+
+    def delete_order(self, order_id: str) -> bool:
+        """Delete order"""
+        key = self._order_key(order_id)
+        if key is None:
+            return False
+        with self._transaction() as conn:
+            order = self._load_order(conn, key)
+            if order is None:
+                return False
+            self._delete_order(conn, order)
+        return True
+
+    def delete_orders_if_unchanged(self, versions: Dict[str, int], before_delete=None) -> List[Dict]:
+        """Delete the orders still at the version given in ``versions``, in one transaction"""
+        with self._transaction() as conn:
+            unchanged = [
+                order for order in (
+                    self._load_order(conn, self._order_key(order_id)) for order_id in versions
+                )
+                if order is not None and order.get('version') == versions[order['id']]
+            ]
+            if unchanged:
+                if before_delete is not None:
+                    before_delete(unchanged)
+                for order in unchanged:
+                    self._delete_order(conn, order)
+        return unchanged
+
+    @classmethod
+    def _delete_order(cls, conn: sqlite3.Connection, order: Dict):
+        key = int(order['id'])
+        conn.execute('DELETE FROM orders WHERE id = ?', (key,))
+        conn.execute(
+            'INSERT OR REPLACE INTO order_tombstones (order_id, version, counters) VALUES (?, ?, ?)',
+            (key, cls._next_version(conn), json.dumps(order_counter_ids(order)))
+        )
+        # Forget the oldest tombstones beyond the limit
+        row = conn.execute(
+            'SELECT version FROM order_tombstones ORDER BY version DESC LIMIT 1 OFFSET ?',
+            (TOMBSTONE_LIMIT,)
+        ).fetchone()
+        if row:
+            conn.execute('DELETE FROM order_tombstones WHERE version <= ?', row)
+            conn.execute("UPDATE storage_meta SET value = ? WHERE key = 'tombstone_floor'", row)
+
+    def clear_all_orders(self):
+        """Clear all orders"""
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM counter_tickets')
+            conn.execute('DELETE FROM order_items')
+            conn.execute('DELETE FROM orders')
+            conn.execute('DELETE FROM order_tombstones')
+            conn.execute("UPDATE storage_meta SET value = 1 WHERE key = 'next_id'")
+            conn.execute(
+                "UPDATE storage_meta SET value = ? WHERE key = 'tombstone_floor'",
+                (self._next_version(conn),)
+            )
+
+    def get_file_sizes(self) -> Dict[str, int]:
+        return file_sizes({'database': self.DATABASE, 'wal': f'{self.DATABASE}-wal'})
+
+    def compact(self):
+        """Fold the WAL back into the database file and truncate it"""
+        self._connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
@@ -1,3 +1,1413 @@
-from django.test import TestCase
+import asyncio
+import gc
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.layers import channel_layers
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+
+from . import consumers, counter_config, middleware, notifications, order_archive, views
+from .channel_layer import LocalBrokerChannelLayer
+from .consumers import OrderConsumer
+from .counter_config import CounterRegistry
+from .data_storage import OrderDataStorage
+from .metrics import Metrics
+from .notifications import NotificationDispatcher, ReplayBuffer
+from .order_archive import OrderArchive, archive_finished_orders
+from .storage import json_file, set_backend
+from .storage.json_file import JSONFileBackend
+from .storage.sqlite import SQLiteBackend
+
+# The project has no database (DATABASES = {}), so every test case is a
+# SimpleTestCase; order storage and counters live in scratch directories.
+
+
+def order_data(*counters, **fields):
+    """Order payload with one item per assigned counter"""
+    return dict({
+        'table_number': 'T-1',
+        'items': [{'name': f'Item {i}', 'assigned_counter': counter} for i, counter in enumerate(counters)]
+    }, **fields)
+
+
+class StorageTestCase(SimpleTestCase):
+    """Gives each test a scratch directory for order storage files"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def json_backend(self, **options):
+        backend = JSONFileBackend(dict({
+            'DATA_FILE': self.path('orders.json'),
+            'JOURNAL_FILE': self.path('orders.jsonl'),
+            'FLUSH_INTERVAL': 0.01,
+        }, **options))
+        self.addCleanup(backend.close)
+        return backend
+
+    def sqlite_backend(self, **options):
+        backend = SQLiteBackend(dict({'DATABASE': self.path('orders.sqlite3')}, **options))
+        self.addCleanup(backend.close)
+        return backend
+
+    def install(self, backend):
+        """Make ``backend`` the app's order storage, with a scratch counter registry"""
+        set_backend(backend)
+        self.addCleanup(set_backend, None)
+        counter_config._registry = CounterRegistry(self.path('counters.json'))
+        self.addCleanup(setattr, counter_config, '_registry', None)
+        return backend
+
+    def read_data_file(self):
+        with open(self.path('orders.json')) as f:
+            return json.load(f)
+
+    def wait_for(self, condition, timeout=2):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("condition not met in time")
+            time.sleep(0.01)
+
+
+class DurabilityTests(StorageTestCase):
+    def test_sync_snapshot_is_on_disk_when_the_write_returns(self):
+        backend = self.json_backend(DURABILITY='sync')
+        order_id = backend.create_order(order_data(1))
+        self.assertIn(order_id, self.read_data_file()['orders'])
+
+    def test_sync_journal_is_synced_when_the_write_returns(self):
+        backend = self.json_backend(PERSISTENCE='journal', DURABILITY='sync')
+        backend.create_order(order_data(1))
+        backend.patch_item_status('1', 0, 'ready')
+        self.assertEqual(backend._synced_seq, 2)
+        with open(self.path('orders.jsonl')) as f:
+            self.assertEqual([json.loads(line)['op'] for line in f], ['create', 'item_status'])
+
+    def test_batch_snapshot_is_written_in_the_background(self):
+        backend = self.json_backend(DURABILITY='batch')
+        order_id = backend.create_order(order_data(1))
+        self.wait_for(lambda: os.path.exists(self.path('orders.json')))
+        self.assertIn(order_id, self.read_data_file()['orders'])
+
+    def test_every_level_survives_close_and_reopen(self):
+        for persistence in ('snapshot', 'journal'):
+            for durability in ('none', 'batch', 'sync'):
+                with self.subTest(persistence=persistence, durability=durability):
+                    options = {
+                        'DATA_FILE': self.path(f'{persistence}-{durability}.json'),
+                        'JOURNAL_FILE': self.path(f'{persistence}-{durability}.jsonl'),
+                        'PERSISTENCE': persistence,
+                        'DURABILITY': durability,
+                    }
+                    backend = self.json_backend(**options)
+                    for _ in range(5):
+                        backend.create_order(order_data(1))
+                    backend.patch_item_status('3', 0, 'ready')
+                    backend.close()
+                    reopened = self.json_backend(**options)
+                    self.assertEqual(len(reopened.get_all_orders()), 5)
+                    self.assertEqual(reopened.get_order('3')['items'][0]['status'], 'ready')
+
+    def test_unknown_level_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.json_backend(DURABILITY='always')
+        with self.assertRaises(ValueError):
+            self.sqlite_backend(DURABILITY='always')
+
+    def test_sqlite_synchronous_follows_the_level(self):
+        for durability, synchronous in (('none', 0), ('batch', 1), ('sync', 2)):
+            with self.subTest(durability=durability):
+                backend = self.sqlite_backend(DATABASE=self.path(f'{durability}.sqlite3'), DURABILITY=durability)
+                self.assertEqual(backend._connection().execute('PRAGMA synchronous').fetchone()[0], synchronous)
+
+    def test_snapshot_replaces_the_data_file_atomically(self):
+        backend = self.json_backend(DURABILITY='sync')
+        backend.create_order(order_data(1))
+        backend.create_order(order_data(2))
+        self.assertFalse(os.path.exists(self.path('orders.json.tmp')))
+        self.assertEqual(len(self.read_data_file()['orders']), 2)
+
+    def test_corrupt_data_file_is_moved_aside(self):
+        with open(self.path('orders.json'), 'w') as f:
+            f.write('{"orders": {')
+        backend = self.json_backend()
+        self.assertEqual(backend.get_all_orders(), [])
+        self.assertEqual(len([name for name in os.listdir(self.dir) if '.corrupt-' in name]), 1)
+
+    def test_failed_snapshot_keeps_the_rotated_journal(self):
+        backend = self.json_backend(PERSISTENCE='journal', DURABILITY='none', SNAPSHOT_EVERY=10 ** 6)
+        backend.create_order(order_data(1))
+        backend._save_data = lambda data: False
+        backend._dirty.set()
+        backend.flush()
+        self.assertTrue(os.path.exists(self.path('orders.jsonl.1')))
+        backend.close()
+        self.assertEqual(len(self.json_backend(PERSISTENCE='journal').get_all_orders()), 1)
+
+
+class JournalTests(StorageTestCase):
+    def journal_backend(self, **options):
+        return self.json_backend(**dict({'PERSISTENCE': 'journal', 'DURABILITY': 'none'}, **options))
+
+    def read_journal(self, name='orders.jsonl'):
+        with open(self.path(name)) as f:
+            return [json.loads(line) for line in f]
+
+    def test_writes_append_records_instead_of_rewriting_the_data_file(self):
+        backend = self.journal_backend()
+        backend.create_order(order_data(1, 2))
+        backend.patch_item_statuses([
+            {'order_id': '1', 'item_index': 0, 'status': 'ready'},
+            {'order_id': '1', 'item_index': 1, 'status': 'ready'},
+        ])
+        backend.delete_order('1')
+        self.assertEqual([record['seq'] for record in self.read_journal()], [1, 2, 3])
+        self.assertFalse(os.path.exists(self.path('orders.json')))
+
+    def test_startup_replays_the_journal_over_the_snapshot(self):
+        backend = self.journal_backend(SNAPSHOT_EVERY=2)
+        for _ in range(3):
+            backend.create_order(order_data(1))
+        self.wait_for(lambda: os.path.exists(self.path('orders.json')))
+        backend.patch_item_status('3', 0, 'ready')
+        backend.close()
+        self.assertEqual(self.read_data_file()['seq'], 3)
+
+        reopened = self.journal_backend()
+        self.assertEqual([order['id'] for order in reopened.get_all_orders()], ['1', '2', '3'])
+        self.assertEqual(reopened.get_order('3')['items'][0]['status'], 'ready')
+        self.assertEqual(reopened.create_order(order_data(1)), '4')
+
+    def test_torn_trailing_record_is_dropped_and_cut_off(self):
+        backend = self.journal_backend()
+        backend.create_order(order_data(1))
+        backend.create_order(order_data(1))
+        backend.close()
+        with open(self.path('orders.jsonl'), 'a') as f:
+            f.write('{"op": "create", "seq": 3, "ord')
+
+        reopened = self.journal_backend()
+        self.assertEqual(len(reopened.get_all_orders()), 2)
+        reopened.create_order(order_data(1))
+        # The next record starts on a clean line, so the journal still replays in full
+        self.assertEqual([record['seq'] for record in self.read_journal()], [1, 2, 3])
+        reopened.close()
+        self.assertEqual(len(self.journal_backend().get_all_orders()), 3)
+
+    def test_snapshot_rotates_the_journal(self):
+        backend = self.journal_backend(SNAPSHOT_EVERY=3)
+        for _ in range(3):
+            backend.create_order(order_data(1))
+        # The rotated journal goes once the snapshot holding its records is down
+        self.wait_for(lambda: os.path.exists(self.path('orders.json')))
+        self.wait_for(lambda: not os.path.exists(self.path('orders.jsonl.1')))
+        self.assertEqual(self.read_data_file()['seq'], 3)
+        # The fresh journal names the snapshot it follows
+        self.assertEqual(self.read_journal(), [{'op': 'start', 'seq': 3}])
+
+    def test_journal_left_aside_by_an_unfinished_snapshot_is_replayed(self):
+        backend = self.journal_backend()
+        backend.create_order(order_data(1))
+        backend.create_order(order_data(1))
+        backend.close()
+        os.replace(self.path('orders.jsonl'), self.path('orders.jsonl.1'))
+        with open(self.path('orders.jsonl'), 'w') as f:
+            f.write(json.dumps({'op': 'start', 'seq': 2}) + '\n')
+
+        self.assertEqual(len(self.journal_backend().get_all_orders()), 2)
+
+    def test_compact_folds_the_journal_into_a_snapshot(self):
+        backend = self.journal_backend(SNAPSHOT_EVERY=10 ** 6)
+        for _ in range(4):
+            backend.create_order(order_data(1))
+        backend.delete_order('2')
+        backend.compact()
+        self.assertEqual(sorted(self.read_data_file()['orders']), ['1', '3', '4'])
+        self.assertEqual(self.read_journal(), [{'op': 'start', 'seq': 5}])
+        backend.close()
+        self.assertEqual(len(self.journal_backend().get_all_orders()), 3)
+
+    def test_compact_rotates_the_journal_once(self):
+        backend = self.journal_backend(SNAPSHOT_EVERY=10 ** 6)
+        backend.create_order(order_data(1))
+        with mock.patch.object(backend, '_rotate_journal', wraps=backend._rotate_journal) as rotate:
+            backend.compact()
+        rotate.assert_called_once()
+        self.assertFalse(os.path.exists(self.path('orders.jsonl.1')))
+
+    def test_compact_without_a_journal_writes_only_the_snapshot(self):
+        backend = self.json_backend(FLUSH_INTERVAL=60)
+        backend.create_order(order_data(1))
+        backend.compact()
+        self.assertEqual(list(self.read_data_file()['orders']), ['1'])
+        self.assertEqual(sorted(os.listdir(self.dir)), ['orders.json'])
+
+    def test_failed_append_changes_nothing_and_is_cut_off(self):
+        backend = self.journal_backend()
+        backend.create_order(order_data(1))
+        backend._journal = FailingJournal(backend._journal)
+        with self.assertRaises(OSError):
+            backend.create_order(order_data(1))
+        self.assertEqual([order['id'] for order in backend.get_all_orders()], ['1'])
+
+        for _ in range(3):
+            backend.create_order(order_data(1))
+        self.assertEqual([record['seq'] for record in self.read_journal()], [1, 2, 3, 4])
+        backend.close()
+        self.assertEqual([order['id'] for order in self.journal_backend().get_all_orders()], ['1', '2', '3', '4'])
+
+
+class FailingJournal:
+    """Journal file that writes part of what it is given, then fails like a full disk"""
+
+    def __init__(self, journal):
+        self.journal = journal
+
+    def write(self, text):
+        self.journal.write(text[:len(text) // 2])
+        self.journal.flush()
+        raise OSError(28, 'No space left on device')
+
+    def __getattr__(self, name):
+        return getattr(self.journal, name)
+
+
+class SharedStoreTests(StorageTestCase):
+    def worker(self, **options):
+        """A JSON store as another worker process on the same files would open it"""
+        return self.json_backend(**dict({'PERSISTENCE': 'journal', 'SHARED': True, 'DURABILITY': 'none'}, **options))
+
+    def test_requires_journal_persistence(self):
+        with self.assertRaises(ValueError):
+            self.json_backend(SHARED=True)
+
+    def test_workers_see_each_others_writes(self):
+        first, second = self.worker(), self.worker()
+        self.assertEqual(second.get_all_orders(), [])
+        first.create_order(order_data(1))
+        self.assertEqual(second.get_order('1')['table_number'], 'T-1')
+        second.patch_item_status('1', 0, 'ready')
+        self.assertEqual(first.get_order('1')['items'][0]['status'], 'ready')
+        self.assertEqual(first.get_changes(0)['version'], second.get_changes(0)['version'])
+
+    def test_order_ids_are_never_handed_out_twice(self):
+        workers = [self.worker(), self.worker()]
+        created = []
+
+        def create(backend):
+            for _ in range(25):
+                created.append(backend.create_order(order_data(1)))
+
+        threads = [threading.Thread(target=create, args=(backend,)) for backend in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(created, key=int), [str(i) for i in range(1, 51)])
+        for backend in workers:
+            self.assertEqual(len(backend.get_all_orders()), 50)
+        with open(self.path('orders.jsonl')) as f:
+            self.assertEqual([json.loads(line)['seq'] for line in f], list(range(1, 51)))
+
+    def test_followers_keep_up_across_journal_rotation(self):
+        writer, reader = self.worker(SNAPSHOT_EVERY=2), self.worker()
+        reader.get_all_orders()
+        # A worker counts its own records as it reads them back, on its next write
+        for _ in range(3):
+            writer.create_order(order_data(1))
+        self.wait_for(lambda: os.path.exists(self.path('orders.json')))
+        self.assertEqual(self.read_data_file()['seq'], 3)
+        writer.create_order(order_data(1))
+        self.assertEqual([order['id'] for order in reader.get_all_orders()], ['1', '2', '3', '4'])
+        self.assertEqual(reader.create_order(order_data(1)), '5')
+
+    def test_follower_reloads_records_it_only_finds_in_the_snapshot(self):
+        writer, reader = self.worker(), self.worker()
+        reader.get_all_orders()
+        writer.create_order(order_data(1))
+        writer.compact()
+        writer.create_order(order_data(1))
+        writer.compact()
+        writer.create_order(order_data(1))
+        # Record 2 went from a journal the reader never opened straight into the snapshot
+        with mock.patch.object(reader, '_reset', wraps=reader._reset) as reset:
+            self.assertEqual([order['id'] for order in reader.get_all_orders()], ['1', '2', '3'])
+        reset.assert_called_once()
+        self.assertEqual(reader.get_changes(0)['version'], 3)
+
+    def test_torn_line_of_a_dead_worker_is_cut_before_appending(self):
+        first, second = self.worker(), self.worker()
+        first.create_order(order_data(1))
+        # Both already running, so neither cuts the line when loading
+        self.assertEqual(len(second.get_all_orders()), 1)
+        with open(self.path('orders.jsonl'), 'a') as f:
+            f.write('{"op": "create", "seq": 2, "ord')
+        second.create_order(order_data(1))
+        first.create_order(order_data(1))
+        self.assertEqual([order['id'] for order in second.get_all_orders()], ['1', '2', '3'])
+        self.assertEqual([order['id'] for order in self.worker().get_all_orders()], ['1', '2', '3'])
+
+
+class BackendCloseTests(StorageTestCase):
+    def test_close_stops_the_background_writer(self):
+        for persistence in ('snapshot', 'journal'):
+            with self.subTest(persistence=persistence):
+                backend = self.json_backend(
+                    DATA_FILE=self.path(f'{persistence}.json'),
+                    JOURNAL_FILE=self.path(f'{persistence}.jsonl'),
+                    PERSISTENCE=persistence,
+                )
+                for _ in range(3):
+                    backend.create_order(order_data(1))
+                writer = backend._writer
+                self.assertTrue(writer.is_alive())
+                backend.close()
+                self.assertFalse(writer.is_alive())
+
+    def test_close_writes_pending_changes(self):
+        backend = self.json_backend(FLUSH_INTERVAL=60)
+        backend.create_order(order_data(1))
+        backend.close()
+        self.assertEqual(len(self.read_data_file()['orders']), 1)
+
+    def test_closed_store_refuses_reads_and_writes(self):
+        backend = self.json_backend()
+        backend.create_order(order_data(1))
+        backend.close()
+        with self.assertRaises(RuntimeError):
+            backend.create_order(order_data(1))
+        with self.assertRaises(RuntimeError):
+            backend.get_order('1')
+        # Closing again is harmless
+        backend.close()
+
+    def test_writer_survives_reload(self):
+        backend = self.json_backend()
+        backend.create_order(order_data(1))
+        backend.reload()
+        backend.create_order(order_data(1))
+        self.wait_for(lambda: len(self.read_data_file()['orders']) == 2)
+        self.assertTrue(backend._writer.is_alive())
+
+
+class ResidentStoreTests(StorageTestCase):
+    def test_reads_are_served_from_memory(self):
+        backend = self.json_backend(DURABILITY='sync')
+        order_id = backend.create_order(order_data(1))
+        os.remove(self.path('orders.json'))
+        self.assertEqual(backend.get_order(order_id)['id'], order_id)
+
+    def test_returned_orders_are_not_changed_by_later_writes(self):
+        backend = self.json_backend()
+        order_id = backend.create_order(order_data(1))
+        before = backend.get_order(order_id)
+        backend.patch_item_status(order_id, 0, 'ready')
+        self.assertEqual(before['items'][0]['status'], 'pending')
+        self.assertEqual(backend.get_order(order_id)['items'][0]['status'], 'ready')
+
+    def test_exit_flushes_only_open_stores(self):
+        kept = self.json_backend(FLUSH_INTERVAL=60)
+        closed = self.json_backend(DATA_FILE=self.path('closed.json'))
+        closed.create_order(order_data(1))
+        closed.close()
+        self.assertIn(kept, json_file._open_backends)
+        self.assertNotIn(closed, json_file._open_backends)
+
+        kept.create_order(order_data(1))
+        json_file._flush_open_backends()
+        self.assertEqual(len(self.read_data_file()['orders']), 1)
+
+    def test_unused_stores_are_not_kept_alive(self):
+        backend = JSONFileBackend({'DATA_FILE': self.path('unused.json')})
+        ref = weakref.ref(backend)
+        del backend
+        gc.collect()
+        self.assertIsNone(ref())
+
+
+class SQLiteConnectionTests(StorageTestCase):
+    def run_in_thread(self, func):
+        thread = threading.Thread(target=func)
+        thread.start()
+        thread.join()
+
+    def test_connections_of_finished_threads_are_closed(self):
+        backend = self.sqlite_backend()
+        opened = []
+        for _ in range(5):
+            self.run_in_thread(lambda: opened.append(backend._connection()) or backend.create_order(order_data(1)))
+        gc.collect()
+        self.assertEqual(len(backend._connections), 1)
+        for conn in opened:
+            with self.assertRaises(sqlite3.ProgrammingError):
+                conn.execute('SELECT 1')
+        self.assertEqual(len(backend.get_all_orders()), 5)
+
+    def test_a_thread_reuses_its_connection(self):
+        backend = self.sqlite_backend()
+        self.assertIs(backend._connection(), backend._connection())
+
+    def test_close_closes_connections_of_live_threads(self):
+        backend = self.sqlite_backend()
+        conn = backend._connection()
+        backend.close()
+        self.assertEqual(len(backend._connections), 0)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute('SELECT 1')
+
+
+def without_times(value):
+    """Orders with their timestamps and versions dropped, for comparing backends"""
+    if isinstance(value, list):
+        return [without_times(item) for item in value]
+    if isinstance(value, dict):
+        return {
+            key: without_times(item) for key, item in value.items()
+            if key not in ('created_at', 'updated_at', 'version', 'prev_version')
+        }
+    return value
+
+
+class BackendParityTests(StorageTestCase):
+    """The SQLite backend answers exactly like the JSON file backend"""
+
+    def exercise(self, backend):
+        results = []
+        record = results.append
+        for counters in ((1,), (1, 2), (2, 3), (3,), (1, 1, 2)):
+            record(backend.create_order(order_data(*counters, customer_name='Ann')))
+        record(backend.create_orders([order_data(2), order_data(1, 3)]))
+        record(backend.patch_item_status('2', 1, 'ready'))
+        record(backend.patch_item_status('2', 0, 'ready'))
+        record(backend.patch_item_status('2', 5, 'ready'))
+        record(backend.patch_item_status('99', 0, 'ready'))
+        record(backend.update_item_status('5', 2, 'in_progress'))
+        record(backend.update_order_status('3', 'served'))
+        record(backend.update_order('4', {'notes': 'no onions'}))
+        record(backend.update_order('99', {'notes': 'missing'}))
+        record(backend.patch_item_statuses([
+            {'order_id': '1', 'item_index': 0, 'status': 'ready'},
+            {'order_id': '7', 'item_index': 1, 'status': 'ready'},
+        ]))
+        record(backend.patch_item_statuses([{'order_id': '1', 'item_index': 9, 'status': 'ready'}]))
+        record(backend.delete_order('6'))
+        record(backend.delete_order('6'))
+        record(backend.create_order(order_data(2)))
+        for status in ('pending', 'in_progress', 'ready_to_serve', 'served'):
+            record(backend.get_orders_by_status(status))
+        for counter_id in (1, 2, 3, 4):
+            record(backend.get_orders_for_counter(counter_id))
+        record(backend.get_open_item_counts())
+        record(backend.get_ready_to_serve_orders())
+        record(backend.get_all_orders())
+        record(backend.get_order('5'))
+        record(backend.get_order('6'))
+        return without_times(results)
+
+    def test_backends_agree(self):
+        expected = self.exercise(self.json_backend())
+        self.assertEqual(self.exercise(self.sqlite_backend()), expected)
+        self.assertEqual(self.exercise(self.json_backend(
+            DATA_FILE=self.path('journal.json'), JOURNAL_FILE=self.path('journal.jsonl'), PERSISTENCE='journal'
+        )), expected)
+
+    def test_sqlite_data_survives_reopening(self):
+        backend = self.sqlite_backend()
+        backend.create_order(order_data(1, 2))
+        backend.patch_item_status('1', 0, 'ready')
+        backend.close()
+        reopened = self.sqlite_backend()
+        self.assertEqual(reopened.get_order('1')['items'][0]['status'], 'ready')
+        self.assertEqual(reopened.create_order(order_data(1)), '2')
+
+
+def without_timestamps(value):
+    """Like ``without_times`` but keeping versions"""
+    if isinstance(value, list):
+        return [without_timestamps(item) for item in value]
+    if isinstance(value, dict):
+        return {
+            key: without_timestamps(item) for key, item in value.items()
+            if key not in ('created_at', 'updated_at')
+        }
+    return value
+
+
+class DeltaSyncTests(StorageTestCase):
+    def backends(self):
+        yield 'json', self.json_backend()
+        yield 'journal', self.json_backend(
+            DATA_FILE=self.path('journal.json'), JOURNAL_FILE=self.path('journal.jsonl'), PERSISTENCE='journal'
+        )
+        yield 'sqlite', self.sqlite_backend()
+
+    def history(self, backend):
+        backend.create_order(order_data(1))
+        backend.create_orders([order_data(1, 2), order_data(3)])
+        backend.patch_item_status('2', 1, 'ready')
+        backend.patch_item_statuses([
+            {'order_id': '1', 'item_index': 0, 'status': 'ready'},
+            {'order_id': '3', 'item_index': 0, 'status': 'in_progress'},
+        ])
+        backend.delete_order('1')
+        backend.update_order_status('2', 'served')
+
+    def test_every_order_changed_gets_its_own_version(self):
+        for name, backend in self.backends():
+            with self.subTest(backend=name):
+                self.history(backend)
+                changes = backend.get_changes(0)
+                self.assertEqual(changes['version'], 8)
+                self.assertEqual([(order['id'], order['version']) for order in changes['orders']], [('3', 6), ('2', 8)])
+                self.assertEqual(changes['deleted'], ['1'])
+
+    def test_backends_answer_since_identically(self):
+        answers = {}
+        for name, backend in self.backends():
+            self.history(backend)
+            answers[name] = [
+                without_timestamps(backend.get_changes(since, counter_id))
+                for since in range(0, 10)
+                for counter_id in (None, 1, 2, 3)
+            ]
+        self.assertEqual(answers['journal'], answers['json'])
+        self.assertEqual(answers['sqlite'], answers['json'])
+
+    def test_only_changes_after_since_are_returned(self):
+        for name, backend in self.backends():
+            with self.subTest(backend=name):
+                self.history(backend)
+                changes = backend.get_changes(7, counter_id=1)
+                self.assertFalse(changes['full'])
+                self.assertEqual([order['id'] for order in changes['orders']], ['2'])
+                self.assertEqual([item['assigned_counter'] for item in changes['orders'][0]['items']], [1])
+                self.assertEqual(backend.get_changes(8)['orders'], [])
+
+    def test_deletes_reach_only_the_counters_involved(self):
+        for name, backend in self.backends():
+            with self.subTest(backend=name):
+                self.history(backend)
+                self.assertEqual(backend.get_changes(6, counter_id=1)['deleted'], ['1'])
+                self.assertEqual(backend.get_changes(6, counter_id=3)['deleted'], [])
+
+    def test_versions_from_the_future_or_before_a_clear_get_everything(self):
+        for name, backend in self.backends():
+            with self.subTest(backend=name):
+                self.history(backend)
+                self.assertTrue(backend.get_changes(99)['full'])
+                backend.clear_all_orders()
+                backend.create_order(order_data(1))
+                changes = backend.get_changes(3)
+                self.assertTrue(changes['full'])
+                self.assertEqual([order['id'] for order in changes['orders']], ['1'])
+                self.assertFalse(backend.get_changes(9)['full'])
+
+    def test_old_tombstones_are_forgotten_past_the_limit(self):
+        for name, backend in self.backends():
+            with self.subTest(backend=name):
+                with mock.patch(f'kds_app.storage.{"sqlite" if name == "sqlite" else "json_file"}.TOMBSTONE_LIMIT', 2):
+                    for _ in range(4):
+                        backend.create_order(order_data(1))
+                    for order_id in ('1', '2', '3'):
+                        backend.delete_order(order_id)
+                self.assertTrue(backend.get_changes(4)['full'])
+                self.assertEqual(backend.get_changes(5)['deleted'], ['2', '3'])
+
+    def test_counter_endpoint_serves_changes_since_a_version(self):
+        self.install(self.json_backend())
+        self.history(OrderDataStorage)
+        response = self.client.get('/api/kds/orders/counter/1/', {'since': 6})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['version'], 8)
+        self.assertEqual([order['id'] for order in response.json()['orders']], ['2'])
+        self.assertEqual(response.json()['deleted'], ['1'])
+        self.assertEqual(self.client.get('/api/kds/orders/counter/1/', {'since': 'x'}).status_code, 400)
+
+
+class ArchiveTests(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        order_archive._archive = OrderArchive(self.path('archive'))
+        self.addCleanup(setattr, order_archive, '_archive', None)
+
+    def backends(self):
+        yield 'json', self.json_backend()
+        yield 'sqlite', self.sqlite_backend()
+
+    def served_orders(self, count):
+        for _ in range(count):
+            order_id = OrderDataStorage.create_order(order_data(1))
+            OrderDataStorage.update_order_status(order_id, 'served')
+
+    def test_finished_orders_move_to_the_archive(self):
+        for name, backend in self.backends():
+            with self.subTest(backend=name):
+                self.install(backend)
+                self.served_orders(3)
+                OrderDataStorage.create_order(order_data(1))
+                self.assertEqual(archive_finished_orders(timedelta(0)), 3)
+                self.assertEqual([order['id'] for order in OrderDataStorage.get_all_orders()], ['4'])
+                self.assertEqual(order_archive.get_archive().get_order('2')['status'], 'served')
+
+    def test_only_unchanged_orders_are_deleted(self):
+        for name, backend in self.backends():
+            with self.subTest(backend=name):
+                backend.create_order(order_data(1))
+                backend.create_order(order_data(1))
+                versions = {order['id']: order['version'] for order in backend.get_all_orders()}
+                backend.patch_item_status('1', 0, 'ready')
+                self.assertEqual([order['id'] for order in backend.delete_orders_if_unchanged(versions)], ['2'])
+                self.assertEqual(backend.get_order('1')['items'][0]['status'], 'ready')
+                self.assertIsNone(backend.get_order('2'))
+                self.assertEqual(backend.delete_orders_if_unchanged({'2': versions['2'], '99': 1}), [])
+
+    def test_a_change_made_while_archiving_is_kept(self):
+        self.install(self.json_backend())
+        self.served_orders(2)
+        real_get = OrderDataStorage.get_orders_by_status
+
+        def get_then_change(status):
+            orders = real_get(status)
+            if status == 'served':
+                # Lands between the archiver's read and its delete
+                OrderDataStorage.update_order('1', {'notes': 'comped'})
+            return orders
+
+        with mock.patch.object(OrderDataStorage, 'get_orders_by_status', side_effect=get_then_change):
+            self.assertEqual(archive_finished_orders(timedelta(0)), 1)
+        self.assertEqual(OrderDataStorage.get_order('1')['notes'], 'comped')
+        self.assertIsNone(order_archive.get_archive().get_order('1'))
+        self.assertIsNotNone(order_archive.get_archive().get_order('2'))
+
+    def test_nothing_is_deleted_if_the_archive_write_fails(self):
+        for name, backend in self.backends():
+            with self.subTest(backend=name):
+                self.install(backend)
+                self.served_orders(2)
+                with mock.patch.object(OrderArchive, 'add_orders', side_effect=OSError('disk full')):
+                    with self.assertRaises(OSError):
+                        archive_finished_orders(timedelta(0))
+                self.assertEqual(len(OrderDataStorage.get_all_orders()), 2)
+
+    def test_recent_orders_stay(self):
+        self.install(self.json_backend())
+        self.served_orders(2)
+        self.assertEqual(archive_finished_orders(timedelta(hours=1)), 0)
+        self.assertEqual(len(OrderDataStorage.get_all_orders()), 2)
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    KDS_WEBSOCKET={
+        'COALESCE_WINDOW_MS': 20, 'COALESCE_MAX_LATENCY_MS': 60, 'SEND_QUEUE_LIMIT': 100,
+        'HEARTBEAT_INTERVAL_SECONDS': 0, 'HEARTBEAT_TIMEOUT_SECONDS': 60
+    }
+)
+class ConsumerTestCase(StorageTestCase):
+    """Connects kitchen displays through a fresh in-memory channel layer, replay buffer and dispatcher"""
+
+    def setUp(self):
+        super().setUp()
+        self.install(self.json_backend())
+        patches = [mock.patch.dict(channel_layers.backends, clear=True)]
+        self.replay_buffer = ReplayBuffer(8)
+        self.dispatcher = NotificationDispatcher()
+        for module in (consumers, notifications):
+            patches.append(mock.patch.object(module, 'replay_buffer', self.replay_buffer))
+            patches.append(mock.patch.object(module, 'dispatcher', self.dispatcher))
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def connect(self, query='counter_id=1'):
+        communicator = WebsocketCommunicator(OrderConsumer.as_asgi(), f'/ws/kitchen/?{query}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive(self, communicator, timeout=1):
+        return json.loads(await communicator.receive_from(timeout))
+
+    async def events(self, communicator):
+        """Order events in the next frame, whether sent alone or as a batch"""
+        frame = await self.receive(communicator)
+        return frame['events'] if frame['type'] == 'batch' else [frame]
+
+
+class BatchStatusTests(ConsumerTestCase):
+    changes = [
+        {'order_id': '1', 'item_index': 0, 'status': 'ready'},
+        {'order_id': '1', 'item_index': 1, 'status': 'ready'},
+        {'order_id': '2', 'item_index': 0, 'status': 'preparing'},
+    ]
+
+    def test_all_changes_are_applied_together(self):
+        OrderDataStorage.create_order(order_data(1, 2))
+        OrderDataStorage.create_order(order_data(1))
+        response = self.client.post(
+            '/api/kds/orders/update-item-statuses/', {'changes': self.changes}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([order['id'] for order in response.json()['orders']], ['1', '2'])
+        self.assertEqual(
+            [item['status'] for item in OrderDataStorage.get_order('1')['items']], ['ready', 'ready']
+        )
+        self.assertEqual(OrderDataStorage.get_order('2')['items'][0]['status'], 'preparing')
+
+    def test_one_bad_change_rejects_them_all(self):
+        OrderDataStorage.create_order(order_data(1, 2))
+        OrderDataStorage.create_order(order_data(1))
+        version = OrderDataStorage.get_changes(0)['version']
+        for bad in ({'order_id': '2', 'item_index': 5, 'status': 'ready'},
+                    {'order_id': '99', 'item_index': 0, 'status': 'ready'},
+                    {'order_id': '1', 'item_index': 0}):
+            with self.subTest(bad=bad):
+                response = self.client.post(
+                    '/api/kds/orders/update-item-statuses/',
+                    {'changes': self.changes + [bad]}, content_type='application/json'
+                )
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(OrderDataStorage.get_changes(0)['version'], version)
+        self.assertEqual(self.client.post(
+            '/api/kds/orders/update-item-statuses/', {'changes': []}, content_type='application/json'
+        ).status_code, 400)
+
+    async def test_websocket_changes_reach_every_counter_involved(self):
+        OrderDataStorage.create_order(order_data(1, 2))
+        OrderDataStorage.create_order(order_data(1))
+        first, second = await self.connect('counter_id=1'), await self.connect('counter_id=2')
+        for communicator in (first, second):
+            self.assertEqual((await self.receive(communicator))['type'], 'initial_data')
+
+        with mock.patch.object(notifications, 'dispatch', wraps=notifications.dispatch) as dispatch:
+            await first.send_json_to({'type': 'update_item_statuses', 'changes': self.changes})
+            events = await self.events(first)
+            # Counter 1 gets both orders in one message; counter 2 only its item of order 1
+            self.assertEqual([event['type'] for event in events], ['order_update', 'order_update'])
+            self.assertEqual([event['order']['id'] for event in events], ['1', '2'])
+            self.assertEqual(
+                [item['status'] for item in events[0]['order']['items']], ['ready']
+            )
+            events = await self.events(second)
+            self.assertEqual([event['order']['id'] for event in events], ['1'])
+            self.assertEqual(len(events[0]['order']['items']), 1)
+            # Sent by the dispatcher's worker, in order with every other write's notifications
+            self.assertEqual(dispatch.call_count, 1)
+
+        await first.send_json_to({'type': 'update_item_statuses', 'changes': [self.changes[0], {'order_id': '99'}]})
+        self.assertEqual(await self.receive(first), {'error': 'Failed to update item statuses'})
+        self.assertTrue(await second.receive_nothing(0.05))
+        await first.disconnect()
+        await second.disconnect()
+
+
+@override_settings(KDS_ARCHIVE={'INTERVAL_SECONDS': 0})
+class BatchCreateTests(ConsumerTestCase):
+    url = '/api/kds/orders/batch-create/'
+
+    def setUp(self):
+        super().setUp()
+        for name, pin in (('Grill', '1111'), ('Fryer', '2222'), ('Bar', '3333')):
+            counter_id, _ = counter_config.create_counter(name, pin)
+            counter_config.assign_categories_to_counter(counter_id, ['drinks'] if name == 'Bar' else ['burgers'])
+
+    def batch(self):
+        return {'orders': [
+            {'table_number': 'T-1', 'items': [
+                {'name': 'Burger', 'category': 'burgers'},
+                {'name': 'Cola', 'category': 'drinks'},
+                {'name': 'Cake', 'category': 'desserts'},
+            ]},
+            {'table_number': 'T-2', 'items': [
+                {'name': 'Burger', 'category': 'burgers'},
+                {'name': 'Burger', 'category': 'burgers'},
+            ]},
+        ]}
+
+    def test_orders_must_be_a_non_empty_list_of_objects(self):
+        for body in ({}, {'orders': []}, {'orders': 'T-1'}, {'orders': [1]}, [{'table_number': 'T-1'}]):
+            with self.subTest(body=body):
+                response = self.client.post(self.url, body, content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(OrderDataStorage.get_all_orders(), [])
+
+    def test_items_of_the_batch_are_spread_over_shared_counters(self):
+        response = self.client.post(self.url, self.batch(), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        orders = response.json()
+        self.assertEqual([order['id'] for order in orders], ['1', '2'])
+        # Each burger goes to whichever grill has fewer open items, counting the batch so far
+        self.assertEqual(
+            [[item['assigned_counter'] for item in order['items']] for order in orders], [[1, 3, None], [2, 1]]
+        )
+        self.assertEqual(OrderDataStorage.get_all_orders(), orders)
+
+    def test_the_batch_is_one_commit_and_one_message_per_counter(self):
+        with mock.patch.object(OrderDataStorage, 'create_orders', wraps=OrderDataStorage.create_orders) as create, \
+                mock.patch.object(notifications, 'notify_counters') as notify:
+            self.client.post(self.url, self.batch(), content_type='application/json')
+        create.assert_called_once()
+        notify.assert_called_once()
+        frames = notify.call_args[0][0]
+        self.assertEqual(sorted(frames), [1, 2, 3])
+        self.assertEqual({message['type'] for message in frames.values()}, {'order_batch'})
+        orders_by_counter = {
+            counter_id: [event['order_id'] for event in message['messages']] for counter_id, message in frames.items()
+        }
+        self.assertEqual(orders_by_counter, {1: ['1', '2'], 2: ['2'], 3: ['1']})
+
+    async def test_displays_get_the_batch_in_one_frame(self):
+        communicator = await self.connect('counter_id=1')
+        await self.receive(communicator)
+        response = await self.async_client.post(self.url, self.batch(), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        frame = await self.receive(communicator)
+        self.assertEqual(frame['type'], 'batch')
+        self.assertEqual([(event['type'], event['order']['id']) for event in frame['events']], [
+            ('new_order', '1'), ('new_order', '2')
+        ])
+        # Only this counter's items of each order
+        self.assertEqual([len(event['order']['items']) for event in frame['events']], [1, 1])
+        await communicator.disconnect()
+
+
+def broadcast(order_id):
+    """Group message about one order, as the notify_* helpers send it"""
+    return notifications.group_message('order_update', order_id, notifications.encode_frame({'type': 'order_update'}))
+
+
+class ReplayBufferTests(SimpleTestCase):
+    def test_messages_are_numbered_once(self):
+        buffer = ReplayBuffer(4)
+        message = broadcast('1')
+        self.assertEqual(buffer.record(1, message), (1, '{"seq":1,"type":"order_update"}'))
+        self.assertEqual(buffer.record(1, broadcast('2'))[0], 2)
+        self.assertEqual(buffer.record(1, message)[0], 1)
+        # Each counter has its own numbers
+        self.assertEqual(buffer.record(2, message)[0], 1)
+        self.assertEqual(buffer.last_seq(1), 2)
+
+    def test_late_duplicates_keep_their_seq_after_the_frame_is_dropped(self):
+        buffer = ReplayBuffer(2, id_history=4)
+        messages = [broadcast(str(i)) for i in range(5)]
+        for message in messages[:4]:
+            buffer.record(1, message)
+        self.assertEqual(buffer.record(1, messages[0]), (1, '{"seq":1,"type":"order_update"}'))
+        self.assertEqual(buffer.last_seq(1), 4)
+        # Past id_history the oldest ids are forgotten
+        buffer.record(1, messages[4])
+        self.assertEqual(buffer.record(1, messages[0])[0], 6)
+
+    def test_frames_after_a_seq(self):
+        buffer = ReplayBuffer(3)
+        for i in range(5):
+            buffer.record(1, broadcast(str(i)))
+        self.assertEqual(buffer.frames_after(1, 3), (5, [
+            '{"seq":4,"type":"order_update"}', '{"seq":5,"type":"order_update"}'
+        ]))
+        self.assertEqual(buffer.frames_after(1, 2)[1][0], '{"seq":3,"type":"order_update"}')
+        self.assertEqual(buffer.frames_after(1, 5), (5, []))
+        # Frames no longer kept, or seqs never given, can't be replayed
+        self.assertIsNone(buffer.frames_after(1, 1))
+        self.assertIsNone(buffer.frames_after(1, 6))
+        self.assertEqual(buffer.frames_after(2, 0), (0, []))
+
+
+class ResumeTests(ConsumerTestCase):
+    async def wait_for_seq(self, seq):
+        for _ in range(100):
+            if self.replay_buffer.last_seq(1) >= seq:
+                return
+            await asyncio.sleep(0.01)
+        self.fail(f"seq {seq} never reached")
+
+    async def test_reconnecting_display_gets_only_what_it_missed(self):
+        OrderDataStorage.create_order(order_data(1))
+        communicator = await self.connect()
+        initial = await self.receive(communicator)
+        self.assertEqual((initial['epoch'], initial['seq']), (self.replay_buffer.epoch, 1))
+
+        notifications.notify_order_update(OrderDataStorage.get_order('1'))
+        events = await self.events(communicator)
+        self.assertEqual([event['seq'] for event in events], [2])
+        await communicator.disconnect()
+
+        # Numbered by the follower while no display is connected
+        for order_id in ('1', '1'):
+            notifications.notify_order_update(OrderDataStorage.get_order(order_id))
+        await self.wait_for_seq(4)
+
+        communicator = await self.connect(f'counter_id=1&epoch={self.replay_buffer.epoch}&last_seq=2')
+        resume = await self.receive(communicator)
+        self.assertEqual(resume['type'], 'resume')
+        self.assertEqual((resume['epoch'], resume['seq']), (self.replay_buffer.epoch, 4))
+        self.assertEqual([event['seq'] for event in resume['events']], [3, 4])
+        self.assertEqual(resume['events'][0]['type'], 'order_update')
+        await communicator.disconnect()
+
+    async def test_status_changes_over_the_socket_are_replayed(self):
+        OrderDataStorage.create_order(order_data(1, 2))
+        first, second = await self.connect('counter_id=1'), await self.connect('counter_id=2')
+        for communicator in (first, second):
+            await self.receive(communicator)
+        await first.send_json_to({'type': 'update_order_status', 'order_id': 1, 'status': 'preparing'})
+        await first.send_json_to({'type': 'update_order_status', 'order_id': 99, 'status': 'preparing'})
+        # Every counter of the order gets its full ticket, numbered like any broadcast
+        for communicator in (first, second):
+            events = await self.events(communicator)
+            self.assertEqual([(event['type'], event['seq']) for event in events], [('order_update', 2)])
+            self.assertEqual(events[0]['order']['status'], 'preparing')
+            self.assertTrue(await communicator.receive_nothing(0.05))
+        await first.disconnect()
+
+        communicator = await self.connect(f'counter_id=1&epoch={self.replay_buffer.epoch}&last_seq=1')
+        resume = await self.receive(communicator)
+        self.assertEqual(resume['type'], 'resume')
+        self.assertEqual([event['order']['status'] for event in resume['events']], ['preparing'])
+        await communicator.disconnect()
+        await second.disconnect()
+
+    async def test_unknown_epoch_or_lost_frames_get_a_snapshot(self):
+        OrderDataStorage.create_order(order_data(1))
+        communicator = await self.connect()
+        await self.receive(communicator)
+        for _ in range(10):
+            notifications.notify_order_update(OrderDataStorage.get_order('1'))
+        await self.wait_for_seq(11)
+        await communicator.disconnect()
+
+        for query in ('epoch=old&last_seq=10', f'epoch={self.replay_buffer.epoch}&last_seq=1'):
+            with self.subTest(query=query):
+                communicator = await self.connect(f'counter_id=1&{query}')
+                initial = await self.receive(communicator)
+                self.assertEqual(initial['type'], 'initial_data')
+                self.assertEqual(initial['seq'], 11)
+                self.assertEqual([order['id'] for order in initial['orders']], ['1'])
+                await communicator.disconnect()
+
+
+class FollowerTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        patch = mock.patch.dict(channel_layers.backends, clear=True)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    async def test_membership_is_renewed_while_the_counter_is_busy(self):
+        with self.settings(CHANNEL_LAYERS={'default': {
+            'BACKEND': 'kds_app.channel_layer.LocalBrokerChannelLayer',
+            'CONFIG': {'path': os.path.join(self.dir, 'channels.sock'), 'group_expiry': 0.2},
+        }}):
+            channel_layer = channel_layers['default']
+            try:
+                buffer = ReplayBuffer(8)
+                await buffer.follow(1)
+                # A broadcast every 20 ms never leaves the follower waiting for a renewal
+                for i in range(30):
+                    await channel_layer.group_send(notifications.counter_group_name(1), broadcast(str(i)))
+                    await asyncio.sleep(0.02)
+                await asyncio.sleep(0.05)
+                self.assertEqual(buffer.last_seq(1), 31)
+            finally:
+                await channel_layer.close()
+
+
+class BrokerLayerTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+
+    def layer(self):
+        layer = LocalBrokerChannelLayer(path=os.path.join(self.dir, 'channels.sock'))
+        self.addCleanup(async_to_sync(layer.close))
+        return layer
+
+    async def test_group_messages_reach_other_workers(self):
+        first, second = self.layer(), self.layer()
+        channel = await second.new_channel()
+        await second.group_add('kitchen', channel)
+        await first.group_send('kitchen', {'type': 'hello'})
+        self.assertEqual(await asyncio.wait_for(second.receive(channel), 1), {'type': 'hello'})
+        # The first worker to reach for the broker hosts it
+        self.assertIsNotNone(second._server)
+        self.assertIsNone(first._server)
+
+        await second.group_discard('kitchen', channel)
+        await first.group_send('kitchen', {'type': 'gone'})
+        await first.send(channel, {'type': 'direct'})
+        self.assertEqual(await asyncio.wait_for(second.receive(channel), 1), {'type': 'direct'})
+
+    async def test_a_worker_takes_over_when_the_broker_host_exits(self):
+        host, receiver, sender = self.layer(), self.layer(), self.layer()
+        await host.group_send('kitchen', {'type': 'hosting'})
+        channel = await receiver.new_channel()
+        await receiver.group_add('kitchen', channel)
+        await sender.group_send('kitchen', {'type': 'before'})
+        self.assertEqual(await asyncio.wait_for(receiver.receive(channel), 1), {'type': 'before'})
+        self.assertIsNotNone(host._server)
+
+        await host.close()
+        # The receiver sends nothing itself, yet its membership reaches the new broker
+        received = None
+        for _ in range(40):
+            await sender.group_send('kitchen', {'type': 'after'})
+            try:
+                received = await asyncio.wait_for(receiver.receive(channel), 0.05)
+                break
+            except asyncio.TimeoutError:
+                pass
+        self.assertEqual(received, {'type': 'after'})
+        self.assertTrue(receiver._server is not None or sender._server is not None)
+
+class CoalescingTests(ConsumerTestCase):
+    def patch(self, order_id, status):
+        notifications.notify_order_patch(OrderDataStorage.patch_item_status(order_id, 0, status))
+
+    async def connected(self):
+        communicator = await self.connect()
+        self.assertEqual((await self.receive(communicator))['type'], 'initial_data')
+        return communicator
+
+    async def test_a_lone_event_is_sent_as_is(self):
+        OrderDataStorage.create_order(order_data(1))
+        communicator = await self.connected()
+        self.patch('1', 'preparing')
+        frame = await self.receive(communicator)
+        self.assertEqual(frame['type'], 'order_patch')
+        self.assertEqual(frame['seq'], 2)
+        await communicator.disconnect()
+
+    async def test_events_close_together_share_one_frame(self):
+        for _ in range(3):
+            OrderDataStorage.create_order(order_data(1))
+        communicator = await self.connected()
+        # Room enough for the three patches however slowly they land
+        config = dict(settings.KDS_WEBSOCKET, COALESCE_WINDOW_MS=300, COALESCE_MAX_LATENCY_MS=300)
+        with self.settings(KDS_WEBSOCKET=config):
+            for order_id in ('1', '2', '3'):
+                self.patch(order_id, 'preparing')
+        frame = await self.receive(communicator)
+        self.assertEqual(frame['type'], 'batch')
+        self.assertEqual([event['order_id'] for event in frame['events']], ['1', '2', '3'])
+        self.assertEqual([event['seq'] for event in frame['events']], [2, 3, 4])
+        self.assertTrue(await communicator.receive_nothing(0.05))
+        await communicator.disconnect()
+
+    async def test_a_full_update_replaces_queued_events_about_the_order(self):
+        OrderDataStorage.create_order(order_data(1))
+        OrderDataStorage.create_order(order_data(1))
+        communicator = await self.connected()
+        self.patch('1', 'preparing')
+        self.patch('2', 'preparing')
+        self.patch('1', 'ready')
+        notifications.notify_order_update(OrderDataStorage.get_order('1'))
+        events = await self.events(communicator)
+        self.assertEqual(
+            [(event['type'], event['seq']) for event in events], [('order_patch', 3), ('order_update', 5)]
+        )
+        self.assertEqual(events[1]['order']['items'][0]['status'], 'ready')
+        await communicator.disconnect()
+
+    async def test_a_steady_stream_is_still_sent_within_the_latency_limit(self):
+        OrderDataStorage.create_order(order_data(1))
+        communicator = await self.connected()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        # Each event arrives well inside the window, so only the latency limit ends the batch
+        with self.settings(KDS_WEBSOCKET=dict(settings.KDS_WEBSOCKET, COALESCE_WINDOW_MS=500)):
+            while not communicator.output_queue.qsize():
+                self.patch('1', 'preparing')
+                await asyncio.sleep(0.002)
+                self.assertLess(loop.time() - started, 0.4)
+        self.assertGreater(len(await self.events(communicator)), 1)
+        await communicator.disconnect()
+
+
+class SheddingTests(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        for _ in range(4):
+            OrderDataStorage.create_order(order_data(1, 1))
+        # Events wait long enough for the queue to outgrow the limit
+        config = dict(
+            settings.KDS_WEBSOCKET, SEND_QUEUE_LIMIT=3, COALESCE_WINDOW_MS=100, COALESCE_MAX_LATENCY_MS=200
+        )
+        override = self.settings(KDS_WEBSOCKET=config)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    async def connected(self):
+        communicator = await self.connect()
+        self.assertEqual((await self.receive(communicator))['type'], 'initial_data')
+        return communicator
+
+    async def test_events_about_one_order_are_merged_into_a_refresh(self):
+        communicator = await self.connected()
+        for index, status in ((0, 'preparing'), (1, 'preparing'), (0, 'ready'), (1, 'ready')):
+            notifications.notify_order_patch(OrderDataStorage.patch_item_status('1', index, status))
+        notifications.notify_order_patch(OrderDataStorage.patch_item_status('2', 0, 'ready'))
+        events = await self.events(communicator)
+        # The refresh is read from storage when sent, and keeps the seq of the last event it replaces
+        self.assertEqual(
+            [(event['type'], event['seq']) for event in events], [('order_update', 5), ('order_patch', 6)]
+        )
+        self.assertEqual([item['status'] for item in events[0]['order']['items']], ['ready', 'ready'])
+        await communicator.disconnect()
+
+    async def test_a_refreshed_order_that_is_gone_is_sent_as_deleted(self):
+        communicator = await self.connected()
+        for status in ('preparing', 'ready', 'served', 'ready'):
+            notifications.notify_order_patch(OrderDataStorage.patch_item_status('1', 0, status))
+        OrderDataStorage.delete_order('1')
+        frame = await self.receive(communicator)
+        self.assertEqual(frame, {'seq': 5, 'type': 'order_deleted', 'order_id': '1'})
+        await communicator.disconnect()
+
+    async def test_too_many_orders_queued_are_replaced_by_a_snapshot(self):
+        communicator = await self.connected()
+        notifications.notify_order_updates(OrderDataStorage.get_all_orders())
+        frame = await self.receive(communicator)
+        self.assertEqual(frame['type'], 'initial_data')
+        self.assertTrue(frame['full'])
+        self.assertEqual([order['id'] for order in frame['orders']], ['1', '2', '3', '4'])
+        self.assertEqual(frame['seq'], 5)
+        self.assertTrue(await communicator.receive_nothing(0.15))
+        await communicator.disconnect()
+
+
+class CounterRegistryTests(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.registry = counter_config._registry = CounterRegistry(self.path('counters.json'))
+        self.addCleanup(setattr, counter_config, '_registry', None)
+
+    def other_worker(self):
+        """The registry as another process sees it"""
+        return CounterRegistry(self.path('counters.json'))
+
+    def test_unchanged_file_is_not_parsed_again(self):
+        counter_config.create_counter('Grill', '1111')
+        with mock.patch.object(CounterRegistry, '_build', wraps=CounterRegistry._build) as build:
+            first = self.other_worker()
+            state = first.state()
+            self.assertIs(first.state(), state)
+            self.assertEqual(build.call_count, 1)
+        self.assertEqual(state['counters'][1]['name'], 'Grill')
+
+    def test_writes_by_other_workers_are_seen_on_the_next_read(self):
+        other = self.other_worker()
+        self.assertEqual(other.state()['counters'], {})
+        counter_id, _ = counter_config.create_counter('Grill', '1111')
+        counter_config.assign_categories_to_counter(counter_id, ['burgers'])
+        self.assertEqual(other.state()['counters'][counter_id]['pin'], '1111')
+        self.assertEqual(other.state()['category_counters'], {'burgers': [counter_id]})
+        self.assertEqual(other.state()['version'], 2)
+
+    def test_pins_stay_unique_across_workers(self):
+        counter_config.create_counter('Grill', '1111')
+        counter_config._registry = self.other_worker()
+        self.assertEqual(counter_config.create_counter('Bar', '1111'), (None, "PIN already exists"))
+        self.assertEqual(counter_config.create_counter('Bar', '2222')[0], 2)
+        self.assertEqual(counter_config.update_counter(2, pin='1111'), (False, "PIN already exists"))
+        self.assertEqual(self.registry.state()['pins'], {'1111': 1, '2222': 2})
+
+    def test_refused_or_empty_changes_leave_the_file_alone(self):
+        counter_config.create_counter('Grill', '1111')
+        before = os.stat(self.path('counters.json'))
+        self.assertEqual(counter_config.update_counter(99, name='Bar'), (False, "Counter not found"))
+        counter_config.update_counter(1, name='Grill')
+        after = os.stat(self.path('counters.json'))
+        self.assertEqual((before.st_ino, before.st_mtime_ns), (after.st_ino, after.st_mtime_ns))
+        self.assertEqual(self.registry.state()['version'], 1)
+
+    def test_items_go_to_the_least_busy_counter_of_their_category(self):
+        for name, pin in (('Grill', '1111'), ('Fryer', '2222')):
+            counter_id, _ = counter_config.create_counter(name, pin)
+            counter_config.assign_categories_to_counter(counter_id, ['burgers', 'sides'])
+        self.assertEqual(counter_config.get_counters_for_category('burgers'), [1, 2])
+        open_items = {1: 3, 2: 2}
+        self.assertEqual(
+            [counter_config.auto_assign_counter_for_item('burgers', open_items) for _ in range(3)], [2, 1, 2]
+        )
+        self.assertIsNone(counter_config.auto_assign_counter_for_item('drinks', open_items))
+        counter_config.delete_counter(1)
+        self.assertEqual(counter_config.get_all_categories(), ['burgers', 'sides'])
+        self.assertEqual(counter_config.get_counter_for_category('sides'), 2)
+
+
+class HeartbeatTests(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        OrderDataStorage.create_order(order_data(1))
+        override = self.settings(KDS_WEBSOCKET=dict(
+            settings.KDS_WEBSOCKET, HEARTBEAT_INTERVAL_SECONDS=0.05, HEARTBEAT_TIMEOUT_SECONDS=0.15
+        ))
+        override.enable()
+        self.addCleanup(override.disable)
+        self.metrics = Metrics()
+        patch = mock.patch.object(consumers, 'metrics', self.metrics)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def metric(self, kind, name):
+        return self.metrics.snapshot()[kind].get(name, 0)
+
+    async def test_answering_pings_keeps_the_display_connected(self):
+        communicator = await self.connect()
+        self.assertEqual((await self.receive(communicator))['type'], 'initial_data')
+        self.assertEqual(self.metric('gauges', 'ws_connections{counter=1}'), 1)
+        for _ in range(6):
+            self.assertEqual(await self.receive(communicator), {'type': 'ping', 'interval': 0.05})
+            await communicator.send_json_to({'type': 'pong'})
+        self.assertEqual(self.metric('counters', 'ws_connections_reaped_total{counter=1}'), 0)
+        await communicator.disconnect()
+        self.assertEqual(self.metric('gauges', 'ws_connections{counter=1}'), 0)
+
+    async def test_a_display_that_stops_answering_is_closed(self):
+        communicator = await self.connect()
+        await self.receive(communicator)
+        frames = []
+        while True:
+            output = await communicator.receive_output(1)
+            if output['type'] == 'websocket.close':
+                break
+            frames.append(json.loads(output['text']))
+        self.assertTrue(frames)
+        self.assertTrue(all(frame['type'] == 'ping' for frame in frames))
+        self.assertEqual(self.metric('counters', 'ws_connections_reaped_total{counter=1}'), 1)
+        self.assertEqual(self.metric('gauges', 'ws_connections{counter=1}'), 0)
+        # Out of the group, where only the replay follower is left
+        self.assertEqual(len(channel_layers['default'].groups[notifications.counter_group_name(1)]), 1)
+
+    async def test_a_display_still_receiving_a_long_send_is_kept(self):
+        real_changes = OrderConsumer.get_changes_for_counter
+
+        async def slow_changes(consumer, since):
+            # Holds the send lock for longer than the timeout
+            await asyncio.sleep(0.4)
+            return await real_changes(consumer, since)
+
+        with mock.patch.object(OrderConsumer, 'get_changes_for_counter', slow_changes):
+            communicator = await self.connect()
+            self.assertEqual((await self.receive(communicator))['type'], 'initial_data')
+        self.assertEqual((await self.receive(communicator))['type'], 'ping')
+        await communicator.send_json_to({'type': 'pong'})
+        self.assertEqual((await self.receive(communicator))['type'], 'ping')
+        self.assertEqual(self.metric('counters', 'ws_connections_reaped_total{counter=1}'), 0)
+        await communicator.disconnect()
+
+
+
+class MembershipTests(ConsumerTestCase):
+    async def test_display_membership_outlives_the_group_expiry(self):
+        OrderDataStorage.create_order(order_data(1))
+        with self.settings(CHANNEL_LAYERS={'default': {
+            'BACKEND': 'kds_app.channel_layer.LocalBrokerChannelLayer',
+            'CONFIG': {'path': os.path.join(self.dir, 'channels.sock'), 'group_expiry': 0.2},
+        }}):
+            channel_layer = channel_layers['default']
+            try:
+                # No heartbeat here, and still renewed
+                communicator = await self.connect()
+                self.assertEqual((await self.receive(communicator))['type'], 'initial_data')
+                await asyncio.sleep(0.5)
+                notifications.notify_order_update(OrderDataStorage.get_order('1'))
+                self.assertEqual([event['order']['id'] for event in await self.events(communicator)], ['1'])
+                await communicator.disconnect()
+            finally:
+                await channel_layer.close()
+
+class MetricsTests(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.metrics = Metrics()
+        for module in (middleware, views):
+            patch = mock.patch.object(module, 'metrics', self.metrics)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def samples(self, text):
+        """Prometheus exposition -> {'name{labels}': value}, checking each TYPE comes before its samples"""
+        samples = {}
+        typed = []
+        for line in text.splitlines():
+            if line.startswith('# TYPE '):
+                name = line.split()[2]
+                self.assertNotIn(name, typed)
+                typed.append(name)
+                continue
+            name, value = line.rsplit(' ', 1)
+            self.assertTrue(name.startswith(typed[-1]), line)
+            samples[name] = float(value)
+        return samples
+
+    def test_exposition_format(self):
+        self.metrics.inc('orders_total', counter=1)
+        self.metrics.inc('orders_total', 2, counter=1)
+        self.metrics.set_gauge('open_items', 4, counter='2')
+        for value in (0.003, 0.2, 0.2, 20):
+            self.metrics.observe('storage_call_seconds', value, call='get_order')
+        text = self.metrics.prometheus()
+        self.assertIn('# TYPE kds_orders_total counter\n', text)
+        self.assertIn('# TYPE kds_open_items gauge\n', text)
+        self.assertIn('# TYPE kds_storage_call_seconds histogram\n', text)
+
+        samples = self.samples(text)
+        self.assertEqual(samples['kds_orders_total{counter="1"}'], 3)
+        self.assertEqual(samples['kds_open_items{counter="2"}'], 4)
+        histogram = 'kds_storage_call_seconds_bucket{call="get_order",le="%s"}'
+        buckets = [samples[histogram % bound] for bound in ('0.0025', '0.005', '0.1', '0.25', '10', '+Inf')]
+        # Buckets count every value up to their bound, so they never go down
+        self.assertEqual(buckets, [0, 1, 1, 3, 3, 4])
+        self.assertEqual(samples['kds_storage_call_seconds_count{call="get_order"}'], 4)
+        self.assertAlmostEqual(samples['kds_storage_call_seconds_sum{call="get_order"}'], 20.403)
+
+    def test_label_values_are_escaped(self):
+        self.metrics.inc('errors_total', reason='bad "quote"\\n')
+        self.assertIn('kds_errors_total{reason="bad \\"quote\\"\\\\n"} 1\n', self.metrics.prometheus())
+
+    def test_requests_are_labelled_by_url_name(self):
+        self.client.get('/api/kds/orders/')
+        self.client.get('/api/kds/orders/')
+        self.client.get('/no-such-page/')
+        counters = self.metrics.snapshot()['counters']
+        # Labelled with the route, whatever the outcome
+        self.assertEqual(counters['http_requests_total{endpoint=orders-list,method=GET,status=401}'], 2)
+        self.assertEqual(counters['http_requests_total{endpoint=unmatched,method=GET,status=404}'], 1)
+        self.assertEqual(
+            self.metrics.snapshot()['summaries']['http_request_seconds{endpoint=orders-list,method=GET}']['count'], 2
+        )
+
+    def test_storage_gauges_are_refreshed_on_scrape(self):
+        self.install(self.json_backend(DURABILITY='sync'))
+        self.metrics.set_gauge('open_items', 7, counter='99')
+        for name, pin in (('Grill', '1111'), ('Bar', '2222')):
+            counter_config.create_counter(name, pin)
+        OrderDataStorage.create_order(order_data(1, 1))
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        samples = self.samples(response.content.decode())
+        # Counters that are gone are dropped, idle ones report 0
+        self.assertNotIn('kds_open_items{counter="99"}', samples)
+        self.assertEqual(samples['kds_open_items{counter="1"}'], 2)
+        self.assertEqual(samples['kds_open_items{counter="2"}'], 0)
+        self.assertIn('kds_storage_file_bytes{file="data"}', samples)
@@ -17,4 +17,5 @@ urlpatterns = [
     path('counters/<int:counter_id>/categories/', views.assign_categories_endpoint, name='assign_categories'),
     path('counters/<int:counter_id>/categories/get/', views.get_categories_endpoint, name='get_categories'),
     path('categories/all/', views.get_all_categories_endpoint, name='get_all_categories'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
@@ -1,16 +1,19 @@
+from django.http import HttpResponse
 from rest_framework import viewsets, status
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from .data_storage import OrderDataStorage
+from .order_archive import get_archive, maybe_archive_finished_orders, MAX_RANGE_DAYS
 from .counter_config import (
     get_counter_name, get_all_counters, validate_counter_credentials,
     create_counter, update_counter, delete_counter, reset_to_defaults,
     assign_categories_to_counter, get_categories_for_counter, get_all_categories,
-    auto_assign_counter_for_item
+    auto_assign_counter_for_item, get_counters_for_category
 )
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from .metrics import metrics
+from .notifications import notify_new_order, notify_new_orders, notify_order_update, notify_order_updates, notify_order_deleted, notify_order_patch
+from datetime import date
 import json
 
 
@@ -45,6 +48,8 @@ class OrderViewSet(viewsets.ViewSet):
         # Notify WebSocket clients
         self._notify_new_order(order)
         
+        maybe_archive_finished_orders()
+        
         return Response(order, status=status.HTTP_201_CREATED)
     
     def update(self, request, pk=None):
@@ -64,9 +69,11 @@ class OrderViewSet(viewsets.ViewSet):
     
     def destroy(self, request, pk=None):
         """Delete order"""
+        order = OrderDataStorage.get_order(pk)
         success = OrderDataStorage.delete_order(pk)
         
         if success:
+            self._notify_order_deleted(order)
             return Response(status=status.HTTP_204_NO_CONTENT)
         
         return Response(
@@ -119,50 +126,58 @@ class OrderViewSet(viewsets.ViewSet):
     
     @action(detail=False, methods=['get'], url_path='counter/(?P<counter_id>[^/.]+)', permission_classes=[AllowAny])
     def orders_by_counter(self, request, counter_id=None):
-        """Get orders for a specific counter - only items assigned to this counter"""
+        """Get orders for a specific counter - only items assigned to this counter.
+        
+        With ?since=<version>, only orders changed or deleted after that store version.
+        """
         try:
             counter_id = int(counter_id)
-            all_orders = OrderDataStorage.get_all_orders()
-            
-            # Filter orders to show only those with items assigned to this counter
-            filtered_orders = []
-            for order in all_orders:
-                # Filter items to show only those assigned to this counter
-                relevant_items = [
-                    item for item in order.get('items', []) 
-                    if item.get('assigned_counter') == counter_id
-                ]
-                
-                # Only include order if it has items for this counter
-                if relevant_items:
-                    # Create a copy of the order with only relevant items
-                    filtered_order = order.copy()
-                    filtered_order['items'] = relevant_items
-                    filtered_orders.append(filtered_order)
-            
-            return Response(filtered_orders)
         except ValueError:
             return Response(
                 {'error': 'Invalid counter ID'}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
-    
-    @action(detail=False, methods=['post'], url_path='create', permission_classes=[AllowAny])
-    def create_order(self, request):
-        """Create a new order with automatic counter assignment based on categories"""
-        order_data = request.data.copy()
         
-        # Auto-assign counters based on item categories
-        if 'items' in order_data:
-            for item in order_data['items']:
+        since = request.query_params.get('since')
+        if since is None:
+            filtered_orders = OrderDataStorage.get_orders_for_counter(counter_id)
+            return Response(filtered_orders)
+        
+        try:
+            since = int(since)
+        except ValueError:
+            return Response(
+                {'error': 'Invalid since version'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        return Response(OrderDataStorage.get_changes(since, counter_id))
+    
+    @staticmethod
+    def _assign_counters(orders):
+        """Auto-assign counters to the items of ``orders`` based on their categories"""
+        open_items = None
+        for order_data in orders:
+            for item in order_data.get('items', []):
                 if 'category' in item and 'assigned_counter' not in item:
+                    # Shared stations go to whichever has the shortest queue
+                    if open_items is None and len(get_counters_for_category(item['category'])) > 1:
+                        open_items = OrderDataStorage.get_open_item_counts()
                     # Try to auto-assign counter based on category
-                    assigned_counter = auto_assign_counter_for_item(item['category'])
+                    assigned_counter = auto_assign_counter_for_item(item['category'], open_items)
                     if assigned_counter:
                         item['assigned_counter'] = assigned_counter
                     else:
                         # If no counter found for category, set to None (manual assignment needed)
                         item['assigned_counter'] = None
+    
+    @action(detail=False, methods=['post'], url_path='create', permission_classes=[AllowAny])
+    def create_order(self, request):
+        """Create a new order with automatic counter assignment based on categories"""
+        order_data = request.data.copy()
+        
+        # Auto-assign counters based on item categories
+        self._assign_counters([order_data])
         
         order_id = OrderDataStorage.create_order(order_data)
         
@@ -175,36 +190,73 @@ class OrderViewSet(viewsets.ViewSet):
         except Exception as e:
             print(f"Error notifying WebSocket clients: {e}")
         
+        maybe_archive_finished_orders()
+        
         return Response(order, status=status.HTTP_201_CREATED)
     
+    @action(detail=False, methods=['post'], url_path='batch-create', permission_classes=[AllowAny])
+    def create_orders_batch(self, request):
+        """Create several orders at once (e.g. queued by an offline POS), in one storage transaction"""
+        orders_data = request.data.get('orders') if isinstance(request.data, dict) else None
+        if not isinstance(orders_data, list) or not orders_data:
+            return Response(
+                {'error': 'orders must be a non-empty list'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not all(isinstance(order_data, dict) for order_data in orders_data):
+            return Response(
+                {'error': 'Each order must be an object'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        orders_data = [dict(order_data) for order_data in orders_data]
+        for order_data in orders_data:
+            if isinstance(order_data.get('items'), list):
+                order_data['items'] = [dict(item) for item in order_data['items']]
+        
+        # Route every item of the batch in one pass
+        self._assign_counters(orders_data)
+        
+        orders = OrderDataStorage.create_orders(orders_data)
+        
+        # One message per counter for the whole batch
+        try:
+            notify_new_orders(orders)
+        except Exception as e:
+            print(f"Error notifying WebSocket clients: {e}")
+        
+        maybe_archive_finished_orders()
+        
+        return Response(orders, status=status.HTTP_201_CREATED)
+    
     @action(detail=False, methods=['post'], url_path='update-item-status', permission_classes=[AllowAny])
     def update_item_status(self, request):
         """Update status of a specific item in an order"""
         order_id = request.data.get('order_id')
         item_index = request.data.get('item_index')
-        status = request.data.get('status')
+        item_status = request.data.get('status')
         
-        if not all([order_id, item_index is not None, status]):
+        if not all([order_id, item_index is not None, item_status]):
             return Response(
                 {'error': 'order_id, item_index, and status are required'}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        success = OrderDataStorage.update_item_status(str(order_id), int(item_index), status)
+        patch = OrderDataStorage.patch_item_status(str(order_id), int(item_index), item_status)
         
-        if success:
+        if patch:
             # Get updated order
             order = OrderDataStorage.get_order(str(order_id))
             
-            # Notify WebSocket clients about the update
+            # Notify WebSocket clients with just the changed fields
             try:
-                self._notify_order_update(order)
+                self._notify_order_patch(patch)
             except Exception as e:
                 print(f"Error notifying WebSocket clients: {e}")
             
             return Response({
                 'success': True, 
-                'message': f'Item {item_index} status updated to {status}',
+                'message': f'Item {item_index} status updated to {item_status}',
                 'order': order
             })
         else:
@@ -213,51 +265,89 @@ class OrderViewSet(viewsets.ViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
     
+    @action(detail=False, methods=['post'], url_path='update-item-statuses', permission_classes=[AllowAny])
+    def update_item_statuses(self, request):
+        """Update the status of many items, across orders, in one commit"""
+        changes = request.data.get('changes') if isinstance(request.data, dict) else None
+        if not isinstance(changes, list) or not changes:
+            return Response(
+                {'error': 'changes must be a non-empty list of {order_id, item_index, status}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        orders = OrderDataStorage.patch_item_statuses(changes)
+        
+        if orders is None:
+            return Response(
+                {'error': 'Failed to update item statuses'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # One message per counter for all the changed orders
+        try:
+            notify_order_updates(orders)
+        except Exception as e:
+            print(f"Error notifying WebSocket clients: {e}")
+        
+        return Response({
+            'success': True,
+            'message': f'{len(changes)} item statuses updated',
+            'orders': orders
+        })
+    
     @action(detail=False, methods=['get'], url_path='ready-to-serve', permission_classes=[AllowAny])
     def ready_to_serve_orders(self, request):
         """Get orders that are ready to serve"""
         orders = OrderDataStorage.get_ready_to_serve_orders()
         return Response(orders)
     
+    @action(detail=False, methods=['get'], url_path='archive')
+    def archived_orders(self, request):
+        """Get archived orders created between date_from and date_to (YYYY-MM-DD)"""
+        try:
+            date_from = date.fromisoformat(request.query_params.get('date_from', ''))
+            date_to = date.fromisoformat(request.query_params.get('date_to') or date_from.isoformat())
+        except ValueError:
+            return Response(
+                {'error': 'date_from (and optionally date_to) must be dates in YYYY-MM-DD format'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if date_to < date_from or (date_to - date_from).days >= MAX_RANGE_DAYS:
+            return Response(
+                {'error': f'Date range must be ascending and at most {MAX_RANGE_DAYS} days'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        orders = get_archive().get_orders(date_from, date_to)
+        return Response(orders)
+    
+    @action(detail=False, methods=['get'], url_path='archive/(?P<order_id>[^/.]+)')
+    def archived_order(self, request, order_id=None):
+        """Get a specific archived order"""
+        order = get_archive().get_order(order_id)
+        if order:
+            return Response(order)
+        return Response(
+            {'error': 'Archived order not found'}, 
+            status=status.HTTP_404_NOT_FOUND
+        )
+    
     def _notify_new_order(self, order):
         """Notify WebSocket clients about new order"""
-        channel_layer = get_channel_layer()
-        
-        # Get all unique counter IDs from the order items
-        counter_ids = set()
-        for item in order.get('items', []):
-            if item.get('assigned_counter'):
-                counter_ids.add(item['assigned_counter'])
-        
-        # Send to each counter-specific group
-        for counter_id in counter_ids:
-            async_to_sync(channel_layer.group_send)(
-                f'kitchen_display_counter_{counter_id}',
-                {
-                    'type': 'new_order',
-                    'order': order
-                }
-            )
+        notify_new_order(order)
     
     def _notify_order_update(self, order):
         """Notify WebSocket clients about order update"""
-        channel_layer = get_channel_layer()
-        
-        # Get all unique counter IDs from the order items
-        counter_ids = set()
-        for item in order.get('items', []):
-            if item.get('assigned_counter'):
-                counter_ids.add(item['assigned_counter'])
-        
-        # Send to each counter-specific group
-        for counter_id in counter_ids:
-            async_to_sync(channel_layer.group_send)(
-                f'kitchen_display_counter_{counter_id}',
-                {
-                    'type': 'order_update',
-                    'order': order
-                }
-            )
+        notify_order_update(order)
+    
+    def _notify_order_patch(self, patch):
+        """Notify WebSocket clients about an item status change"""
+        notify_order_patch(patch)
+    
+    def _notify_order_deleted(self, order):
+        """Notify WebSocket clients about order deletion"""
+        notify_order_deleted(order)
 
 
 @api_view(['POST'])
@@ -465,3 +555,30 @@ def get_all_categories_endpoint(request):
             {'error': str(e)}, 
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
+
+def refresh_storage_gauges():
+    """Set the gauges read from storage on demand, so they cost nothing between scrapes"""
+    # Every counter gets a value, idle ones 0; ids are compared as text
+    open_items = {str(counter['id']): 0 for counter in get_all_counters()}
+    for counter_id, count in OrderDataStorage.get_open_item_counts().items():
+        open_items[str(counter_id)] = open_items.get(str(counter_id), 0) + count
+    metrics.clear_gauge('open_items')
+    for counter_id, count in open_items.items():
+        metrics.set_gauge('open_items', count, counter=counter_id)
+    metrics.clear_gauge('storage_file_bytes')
+    for file, size in OrderDataStorage.get_file_sizes().items():
+        metrics.set_gauge('storage_file_bytes', size, file=file)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def metrics_view(request):
+    """Get this worker's runtime metrics, e.g. event loop lag"""
+    refresh_storage_gauges()
+    return Response(metrics.snapshot())
+
+
+def prometheus_metrics_view(request):
+    """This worker's metrics in the Prometheus text format, for scraping"""
+    refresh_storage_gauges()
+    return HttpResponse(metrics.prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -47,6 +47,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Outermost, so request timings include every other middleware
+    'kds_app.middleware.RequestMetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -182,9 +184,96 @@ CORS_ALLOW_CREDENTIALS = True
 CORS_ALLOW_ALL_HEADERS = True
 CORS_ALLOW_ALL_METHODS = True
 
-# Channel Layers Configuration (In-Memory for real-time updates)
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+# Channel Layers Configuration
+# The in-memory layer only reaches WebSockets held by the same process. When
+# running several workers, set KDS_CHANNEL_LAYER=local: workers then share
+# groups through a broker on the Unix socket at KDS_CHANNEL_SOCKET, hosted by
+# one of them. Group memberships expire after KDS_CHANNEL_GROUP_EXPIRY seconds.
+if config('KDS_CHANNEL_LAYER', default='memory') == 'local':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'kds_app.channel_layer.LocalBrokerChannelLayer',
+            'CONFIG': {
+                'path': config('KDS_CHANNEL_SOCKET', default=str(BASE_DIR / 'kds_channels.sock')),
+                'group_expiry': config('KDS_CHANNEL_GROUP_EXPIRY', default=86400, cast=int),
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {
+                'group_expiry': config('KDS_CHANNEL_GROUP_EXPIRY', default=86400, cast=int),
+            },
+        },
+    }
+
+# Order Storage Configuration
+# BACKEND picks where orders live:
+#   kds_app.storage.json_file.JSONFileBackend - JSON file, kept in memory
+#   kds_app.storage.sqlite.SQLiteBackend      - SQLite database in WAL mode
+# JSON file options: PERSISTENCE is 'snapshot' (rewrite DATA_FILE in the
+# background after changes) or 'journal' (append each change to JOURNAL_FILE
+# and only write a full snapshot every SNAPSHOT_EVERY changes). Set SHARED
+# (journal only) when running several uvicorn workers: writes then take a
+# cross-process file lock and order ids are allocated atomically.
+# SQLite options: DATABASE is the database file; it is always multi-worker safe.
+# DURABILITY (both backends) trades write latency for safety against power
+# loss: 'none' never fsyncs, 'batch' fsyncs in the background within about
+# half a second, 'sync' fsyncs before a write returns, sharing one fsync
+# between writes that arrive together. Run benchmarks/storage_durability.py
+# to see what each costs on your disk.
+# Compact the journal or WAL offline with `python manage.py compact_order_journal`.
+# WebSocket consumers run storage calls on a pool of ASYNC_THREADS threads.
+KDS_STORAGE = {
+    'BACKEND': config('KDS_STORAGE_BACKEND', default='kds_app.storage.json_file.JSONFileBackend'),
+    'ASYNC_THREADS': config('KDS_STORAGE_ASYNC_THREADS', default=4, cast=int),
+    'OPTIONS': {
+        'PERSISTENCE': config('KDS_STORAGE_PERSISTENCE', default='snapshot'),
+        'SHARED': config('KDS_STORAGE_SHARED', default=False, cast=bool),
+        'DATA_FILE': config('KDS_DATA_FILE', default='orders_data.json'),
+        'JOURNAL_FILE': config('KDS_JOURNAL_FILE', default='orders_journal.jsonl'),
+        'SNAPSHOT_EVERY': config('KDS_SNAPSHOT_EVERY', default=1000, cast=int),
+        'DATABASE': config('KDS_SQLITE_DATABASE', default='orders.sqlite3'),
+        'DURABILITY': config('KDS_STORAGE_DURABILITY', default='batch'),
     },
 }
+
+# Counter Registry Configuration
+# Counters, their PINs and category assignments are kept in FILE, shared by
+# every worker. Each worker caches it in memory and picks up changes made by
+# the others on its next read.
+KDS_COUNTERS = {
+    'FILE': config('KDS_COUNTERS_FILE', default='counters.json'),
+}
+
+# Order Archive Configuration
+# Finished orders (served or ready_to_serve) not updated for AFTER_MINUTES are
+# moved out of order storage into one file per day under DIR. This runs every
+# INTERVAL_SECONDS as orders come in (0 turns that off), or on demand with
+# `python manage.py archive_orders`.
+KDS_ARCHIVE = {
+    'DIR': config('KDS_ARCHIVE_DIR', default='order_archive'),
+    'AFTER_MINUTES': config('KDS_ARCHIVE_AFTER_MINUTES', default=120, cast=int),
+    'INTERVAL_SECONDS': config('KDS_ARCHIVE_INTERVAL_SECONDS', default=300, cast=int),
+}
+
+# Kitchen Display WebSocket Configuration
+# Order events for a display are held for COALESCE_WINDOW_MS after the latest
+# one (at most COALESCE_MAX_LATENCY_MS after the first) and sent as a single
+# batch frame. Set COALESCE_WINDOW_MS to 0 to send every event immediately.
+# Each counter's last REPLAY_BUFFER_SIZE broadcasts are kept so a display that
+# reconnects is sent only what it missed instead of all of its orders.
+# A display that falls more than SEND_QUEUE_LIMIT events behind gets its
+# queued events merged per order, and failing that a fresh full snapshot.
+# Displays are pinged every HEARTBEAT_INTERVAL_SECONDS (0 turns this off) and
+# dropped if a ping goes unanswered for HEARTBEAT_TIMEOUT_SECONDS.
+KDS_WEBSOCKET = {
+    'COALESCE_WINDOW_MS': config('KDS_WS_COALESCE_WINDOW_MS', default=15, cast=int),
+    'COALESCE_MAX_LATENCY_MS': config('KDS_WS_COALESCE_MAX_LATENCY_MS', default=60, cast=int),
+    'REPLAY_BUFFER_SIZE': config('KDS_WS_REPLAY_BUFFER_SIZE', default=256, cast=int),
+    'SEND_QUEUE_LIMIT': config('KDS_WS_SEND_QUEUE_LIMIT', default=100, cast=int),
+    'HEARTBEAT_INTERVAL_SECONDS': config('KDS_WS_HEARTBEAT_INTERVAL_SECONDS', default=20, cast=int),
+    'HEARTBEAT_TIMEOUT_SECONDS': config('KDS_WS_HEARTBEAT_TIMEOUT_SECONDS', default=60, cast=int),
+}
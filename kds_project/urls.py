@@ -23,10 +23,12 @@ from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
 )
+from kds_app.views import prometheus_metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/kds/', include('kds_app.urls')),
+    path('metrics', prometheus_metrics_view, name='prometheus_metrics'),
     path('api/auth/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/auth/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('kitchen_login.html', TemplateView.as_view(template_name='kitchen_login.html'), name='kitchen_login'),